@@ -0,0 +1,96 @@
+"""
+Aborting the mapping of a chunk whose first reads don't align.
+===============================================================
+
+Author: Andrés García García @ Sept 2018
+
+A badly trimmed or mislabelled chunk (or a whole run with the wrong index)
+still goes through the whole mapping, hours per chunk, before its alignment
+rate is seen in the summary of HISAT2.
+
+Here the SAM records written by HISAT2 are passed through on their way to
+'samtools sort' (or to the SAM file), counting the aligned and unaligned
+reads ('monitor_alignments'):
+
+    - Only the primary alignment of each read (or mate) is counted, so that
+      the rate is the one of the summary of HISAT2 ("overall alignment rate").
+      The reads collapsed by `script.collapse.py` count as many times as their
+      copies.
+    - After the first CHECK_READS reads (or at the end of the chunk, if it has
+      fewer), the alignment rate is compared with the minimum one. If it's
+      lower, the rest of the records are not read, and the command exits with
+      ABORTED_EXIT_CODE (see `tasks.py`). HISAT2 is stopped by the broken pipe.
+    - Otherwise, the rest of the records are copied as they are, in blocks.
+
+The records written before aborting are complete, so the programs after this
+one finish cleanly, and the exit code of the whole command is the one of
+the monitor.
+
+See `script.alignment_monitor.py` for the command line interface.
+
+"""
+
+import shutil
+from typing import Dict, BinaryIO
+
+from collapse import COPIES_QNAME
+
+
+VERSION = '0.1'
+
+# The reads whose alignment rate is checked
+CHECK_READS = 100000
+
+# The alignment rate below which the mapping is aborted, if none is given
+MIN_ALIGNMENT_RATE = 0.2
+
+# The bytes copied at once after checking the rate
+BLOCK_BYTES = 1024**2
+
+# The flags of the secondary and supplementary alignments
+NOT_PRIMARY = 0x100 | 0x800
+
+# The flag of the unaligned reads
+UNMAPPED = 0x4
+
+
+def monitor_alignments(sam_in: BinaryIO,
+                       sam_out: BinaryIO,
+                       min_rate: float,
+                       check_reads: int = CHECK_READS) -> Dict[str, object]:
+    """Copy the SAM records, checking the alignment rate of the first reads.
+
+    Input:
+        sam_in, sam_out: Where to read the SAM records from, and to write them.
+        min_rate: The minimum alignment rate (from 0 to 1) of the first reads.
+        check_reads: How many reads are checked.
+    Output: The number of reads checked, the aligned ones and their rate,
+            and whether the rate is at least the minimum (if not, the rest
+            of the records were not copied).
+    """
+    reads = aligned = 0
+
+    for line in sam_in:
+        sam_out.write(line)
+        if line.startswith(b'@'):
+            continue
+
+        qname, flag, _ = line.split(b'\t', 2)
+        flag = int(flag)
+        if flag & NOT_PRIMARY:
+            continue
+
+        match = COPIES_QNAME.match(qname)
+        copies = int(match.group(2)) if match else 1
+        reads += copies
+        aligned += 0 if flag & UNMAPPED else copies
+        if reads >= check_reads:
+            break
+
+    rate = aligned / reads if reads else 1.0
+    passed = rate >= min_rate
+    if passed:
+        shutil.copyfileobj(sam_in, sam_out, BLOCK_BYTES)
+
+    return {'reads': reads, 'aligned': aligned, 'rate': rate, 'passed': passed}
+# ---
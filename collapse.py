@@ -0,0 +1,212 @@
+"""
+Collapsing the duplicate reads before mapping.
+==============================================
+
+Author: Andrés García García @ Sept 2018
+
+After the trimming, the sequences have an awful lot of repetition, and yet
+HISAT2 aligns every copy of the same read (or pair of reads) again. Here the
+reads of a chunk with exactly the same sequence (both sequences, for pairs)
+are collapsed into a single read, the first one found, with the number of
+copies appended to its name:
+
+    @<name>_x<copies> <comment>
+
+so only the unique reads are mapped. HISAT2 keeps the names in the SAM
+records, and 'tag_counts' moves the number of copies back from the name to
+the tag COUNT_TAG (e.g. 'XC:i:12') of every alignment of the read, so the
+counts can be restored downstream (e.g. the reads of a feature are the sum
+of the tags of its alignments, not the number of alignments). The quality of
+the copies is not merged, the one of the first copy is kept.
+
+The unique reads are counted in a hash table kept in memory. If the table
+grows larger than the given size, it is spilled to disk: its entries are
+appended to a number of partition files (SPILL_PARTITIONS), chosen by the
+hash of the sequence, and the table is emptied. At the end, each partition
+is read back and merged on its own, so the memory used is about the size
+given, or the size of a partition, whichever is larger.
+
+See `script.collapse.py` for the command line interface.
+
+"""
+
+import re
+import zlib
+import tempfile
+from pathlib import Path
+from itertools import chain
+from collections import OrderedDict
+from typing import Union, List, Tuple, Dict, Iterator, BinaryIO, Optional
+
+from fastq import read_mates, CHUNK_READS
+
+
+VERSION = '0.1'
+
+# The SAM tag with the number of copies of each read
+COUNT_TAG = 'XC'
+
+# The files among which the table is spilled
+SPILL_PARTITIONS = 64
+
+# Maximum size of the table in memory (in bytes)
+MAX_TABLE_BYTES = 2 * 1024**3
+
+# An estimate of the memory used by each entry of the table, besides the records
+ENTRY_OVERHEAD = 250
+
+# The number of copies appended to the name, before the mate suffix '/1' or '/2'
+COPIES_NAME = re.compile(rb'^(\S*?)(/[12])?(\s.*)?$')
+COPIES_QNAME = re.compile(rb'^(.*)_x(\d+)$')
+
+
+def keyed_reads(chunks: Iterator[Tuple[List[bytes], ...]]) -> Iterator[Tuple[bytes, List[bytes]]]:
+    """The reads (or pairs) of the chunks, as from 'read_mates' or
+    'read_interleaved' (see `fastq.py`).
+
+    Output: Generates the key of each read (its sequence, or both sequences)
+            and its lines (4 per mate).
+    """
+    for chunk in chunks:
+        for i in range(0, len(chunk[0]), 4):
+            mates = [lines[i:i+4] for lines in chunk]
+            yield b'\t'.join(lines[1] for lines in mates), list(chain.from_iterable(mates))
+# ---
+
+def read_pairs(inputs: List[str], chunk_reads: int = CHUNK_READS) -> Iterator[Tuple[bytes, List[bytes]]]:
+    """The reads of the FASTQ files (or the pairs, if two are given), as
+    'keyed_reads'. The inputs are given as to 'read_mates' (see `fastq.py`)."""
+    return keyed_reads(read_mates(inputs, chunk_reads))
+# ---
+
+def copies_name(header: bytes, copies: int) -> bytes:
+    """Append the number of copies to the name in the header of a read."""
+    name, mate, comment = COPIES_NAME.match(header).groups()
+    return name + b'_x%d' % copies + (mate or b'') + (comment or b'')
+# ---
+
+def write_read(output: BinaryIO, lines: List[bytes], copies: int):
+    """Write the lines of a read (or pair), with its number of copies in the names."""
+    lines = list(lines)
+    for i in range(0, len(lines), 4):
+        lines[i] = copies_name(lines[i], copies)
+    output.write(b'\n'.join(lines) + b'\n')
+# ---
+
+def spill(table: Dict[bytes, list], partitions: List[BinaryIO]):
+    """Append the entries of the table to the partition files of their keys."""
+    for key, (copies, lines) in table.items():
+        partition = partitions[zlib.crc32(key) % len(partitions)]
+        partition.write(b'%d\t%d\n' % (copies, len(lines)) + b'\n'.join(lines) + b'\n')
+# ---
+
+def read_partition(partition: BinaryIO) -> Iterator[Tuple[bytes, int, List[bytes]]]:
+    """The (key, copies, lines) of the entries spilled to the partition file."""
+    partition.seek(0)
+    for header in partition:
+        copies, n_lines = (int(field) for field in header.split(b'\t'))
+        lines = [partition.readline().rstrip(b'\n') for _ in range(n_lines)]
+        yield b'\t'.join(lines[1::4]), copies, lines
+# ---
+
+def collapse_reads(reads: Iterator[Tuple[bytes, List[bytes]]],
+                   outputs: List[BinaryIO],
+                   max_table_bytes: int = MAX_TABLE_BYTES,
+                   spill_dir: Optional[Union[str, Path]] = None) -> Dict[str, int]:
+    """Collapse the reads with the same key, and write one read of each key.
+
+    Input:
+        reads: The (key, lines) of the reads, as from 'read_pairs'.
+        outputs: Where to write the unique reads: one output, or one for each
+                 mate. A single output for pairs gets them interleaved.
+        max_table_bytes: The size of the table above which it is spilled.
+        spill_dir: Where to write the partition files. Default: the
+                   temporary directory of the system ($TMPDIR).
+    Output: The number of reads, of unique reads, and of times the table was
+            spilled.
+    """
+    table = OrderedDict()
+    table_bytes = 0
+    counts = {'reads': 0, 'unique': 0, 'spills': 0}
+
+    def write(lines, copies):
+        """Write the read (or pair) to the outputs."""
+        counts['unique'] += 1
+        if len(outputs) == 1:
+            write_read(outputs[0], lines, copies)
+        else:
+            for i, output in enumerate(outputs):
+                write_read(output, lines[4*i:4*i+4], copies)
+    # ---
+
+    with tempfile.TemporaryDirectory(dir=spill_dir, prefix='collapse.') as tmp_dir:
+        partitions = []
+
+        for key, lines in reads:
+            counts['reads'] += 1
+            entry = table.get(key)
+            if entry:
+                entry[0] += 1
+                continue
+
+            table[key] = [1, lines]
+            table_bytes += ENTRY_OVERHEAD + len(key) + sum(len(line) for line in lines)
+
+            if table_bytes > max_table_bytes:
+                if not partitions:
+                    partitions = [open(Path(tmp_dir) / f'{i}.spill', 'w+b')
+                                      for i in range(SPILL_PARTITIONS)]
+                spill(table, partitions)
+                table.clear()
+                table_bytes = 0
+                counts['spills'] += 1
+
+        if not partitions:
+            for copies, lines in table.values():
+                write(lines, copies)
+            return counts
+
+        # Merge each partition on its own
+        spill(table, partitions)
+        table.clear()
+        for partition in partitions:
+            merged = OrderedDict()
+            for key, copies, lines in read_partition(partition):
+                entry = merged.get(key)
+                if entry:
+                    entry[0] += copies
+                else:
+                    merged[key] = [copies, lines]
+            for copies, lines in merged.values():
+                write(lines, copies)
+            partition.close()
+
+    return counts
+# ---
+
+def tag_counts(sam_in: BinaryIO, sam_out: BinaryIO) -> Dict[str, int]:
+    """Move the number of copies of each read from its name to the COUNT_TAG tag.
+
+    Input: The SAM records of collapsed reads, and where to write them.
+    Output: The number of alignments, and the sum of their copies.
+    """
+    counts = {'alignments': 0, 'copies': 0}
+    tag = COUNT_TAG.encode('ascii')
+
+    for line in sam_in:
+        if line.startswith(b'@'):
+            sam_out.write(line)
+            continue
+
+        qname, rest = line.rstrip(b'\n').split(b'\t', 1)
+        match = COPIES_QNAME.match(qname)
+        copies = int(match.group(2)) if match else 1
+        if match:
+            qname = match.group(1)
+
+        sam_out.write(qname + b'\t' + rest + b'\t' + tag + b':i:%d\n' % copies)
+        counts['alignments'] += 1
+        counts['copies'] += copies
+
+    return counts
+# ---
@@ -0,0 +1,495 @@
+"""
+Statistics of FASTQ files.
+==========================
+
+Author: Andrés García García @ Sept 2018
+
+The quality check (`script.quality_check.py`) runs FastQC once per FASTQ file,
+starting a Java virtual machine each time, and then MultiQC is needed to put
+together several hundreds of reports.
+
+This module computes the same basic statistics as FastQC, reading the FASTQ
+files in chunks of many reads and processing each chunk at once with NumPy,
+so the memory used doesn't depend on the size of the file:
+
+    - The distribution of the qualities at each position of the reads.
+    - The composition (A, C, G, T, N) at each position of the reads.
+    - The distribution of the lengths of the reads.
+    - The distribution of the GC content of the reads.
+    - The overrepresented sequences.
+
+The statistics of a file are kept as a dictionary of counts ('new_stats'),
+updated with every chunk ('update_stats'). The counts of several files can be
+added ('merge_stats') and summarized into a report ('summarize').
+
+See `script.fastq_stats.py` for the command line interface.
+
+Sampling the reads
+------------------
+To decide quickly if a sequencing run is good, there is no need to look at
+every read. 'reservoir_sample' draws a uniform random sample of a fixed number
+of reads from one or several FASTQ files (e.g. all the chunks of a sample)
+in a single pass, without knowing in advance how many reads there are. The
+statistics of the sample are then given with their confidence intervals
+('confidence').
+
+The chunks of each sample (e.g. 'mm1L_ATCACG_L003_R1_001.fastq' of the sample
+'mm1L') are told apart by their names ('sample_of'), and so are the mates of each
+sample ('group_of'), the same way by every script that groups them.
+
+"""
+
+import re
+import sys
+import gzip
+import math
+from itertools import islice, chain
+from collections import Counter
+from pathlib import Path
+from typing import Union, Generator, Iterator, Tuple, Dict, List, Optional, BinaryIO
+
+import numpy as np
+
+
+# The qualities are encoded as ASCII characters, from this offset (Phred+33)
+PHRED_OFFSET = 33
+
+# Qualities from 0 to 93 (characters '!' to '~')
+N_QUALITIES = 94
+
+# The index of each base in the composition counts. Anything else counts as N.
+BASES = b'ACGTN'
+BASE_INDEX = np.full(256, BASES.index(b'N'), dtype=np.uint8)
+for i, base in enumerate(BASES):
+    BASE_INDEX[base] = i
+    BASE_INDEX[ord(chr(base).lower())] = i
+
+# Reads per chunk
+CHUNK_READS = 100_000
+
+# As in FastQC, the overrepresented sequences are searched in the first reads
+# of the file, truncating the long reads.
+OVERREPRESENTED_READS = 100_000
+OVERREPRESENTED_LENGTH = 50
+
+# Fraction of the reads above which a sequence is overrepresented
+OVERREPRESENTED_FRACTION = 0.001
+
+
+def sample_of(file_name: Union[str, Path]) -> str:
+    """The sample of a FASTQ file (or of a report of it), e.g. 'mm1L' of
+    'mm1L_ATCACG_L003_R1_001.fastq'.
+
+    Names without the 'mmXY' prefix are grouped by the part before the first '_'.
+    """
+    name = Path(file_name).name
+    match = re.match(r'mm\d+[LR]', name)
+    return match.group(0) if match else name.split('_')[0]
+# ---
+
+def group_of(file_name: Union[str, Path]) -> str:
+    """The sample and mate of a FASTQ file, e.g. 'mm1L_R1' of 'mm1L_ATCACG_L003_R1_001.fastq',
+    whatever its lane and chunk. Single files are grouped by their sample only."""
+    mate = re.search(r'_(R[12])[_.]', Path(file_name).name)
+    return f'{sample_of(file_name)}_{mate.group(1)}' if mate else sample_of(file_name)
+# ---
+
+def open_binary(path: Union[str, Path], mode: str):
+    """Open the file (FASTQ or SAM) in binary mode, '-' being the standard
+    input or output, to stream the reads between programs."""
+    if str(path) == '-':
+        stream = sys.stdin if mode == 'rb' else sys.stdout
+        return open(stream.fileno(), mode, buffering=1024**2, closefd=False)
+    return open(path, mode, buffering=1024**2)
+# ---
+
+def open_fastq(path: Union[str, Path]):
+    """Open the FASTQ file for reading in binary mode, decompressing it if needed."""
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb', buffering=1024**2)
+# ---
+
+def to_matrix(lines: List[bytes], width: int) -> np.ndarray:
+    """Put the lines in the rows of a matrix of bytes, padding them with zeros."""
+    padded = b''.join(line.ljust(width, b'\0') for line in lines)
+    return np.frombuffer(padded, dtype=np.uint8).reshape(len(lines), width)
+# ---
+
+def read_records(path: Union[str, Path],
+                 chunk_reads: int = CHUNK_READS) -> Generator[List[bytes], None, None]:
+    """Read the records of the FASTQ file in chunks of reads.
+
+    Output: Generates, for each chunk, the list of its lines (4 per read),
+            without the line ends.
+    """
+    with open_fastq(path) as fastq:
+        while True:
+            lines = [line.rstrip(b'\r\n') for line in islice(fastq, 4 * chunk_reads)]
+            if len(lines) < 4:
+                return
+            # An incomplete record at the end of the file is left out
+            yield lines[:len(lines) - len(lines) % 4]
+# ---
+
+def read_mates(inputs: List[str], chunk_reads: int = CHUNK_READS) -> Iterator[Tuple[List[bytes], ...]]:
+    """Read the records of a FASTQ file, or of the pairs of two files, in chunks of reads.
+
+    Input: A file, or two with the mates, each of them possibly a list of
+           files separated by commas (as HISAT2 takes them).
+    Output: Generates, for each chunk, a tuple with the lines of each mate
+            (as 'read_records').
+    """
+    return zip(*(chain.from_iterable(read_records(path, chunk_reads) for path in files.split(','))
+                     for files in inputs))
+# ---
+
+def read_interleaved(stream: BinaryIO,
+                     n_mates: int,
+                     chunk_reads: int = CHUNK_READS) -> Iterator[Tuple[List[bytes], ...]]:
+    """Read the records of a FASTQ stream (e.g. the standard input, see
+    'open_binary'), with the mates of the pairs interleaved if 'n_mates' is 2.
+
+    Output: Generates the chunks of reads, as 'read_mates'.
+    """
+    lines = (line.rstrip(b'\r\n') for line in stream)
+    while True:
+        chunk = list(islice(lines, 4 * n_mates * chunk_reads))
+        chunk = chunk[:len(chunk) - len(chunk) % (4 * n_mates)]
+        if not chunk:
+            return
+        yield tuple([line for i in range(4 * mate, len(chunk), 4 * n_mates)
+                              for line in chunk[i:i+4]]
+                        for mate in range(n_mates))
+# ---
+
+def to_arrays(lines: List[bytes]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The sequences, qualities and lengths of the reads (see 'read_chunks')."""
+    sequences = lines[1::4]
+    qualities = lines[3::4]
+    lengths = np.fromiter((len(s) for s in sequences),
+                          dtype=np.int64,
+                          count=len(sequences))
+    width = int(lengths.max()) if len(lengths) else 0
+
+    quality_matrix = to_matrix(qualities, width).astype(np.int16) - PHRED_OFFSET
+    return to_matrix(sequences, width), quality_matrix, lengths
+# ---
+
+def read_chunks(path: Union[str, Path],
+                chunk_reads: int = CHUNK_READS
+                ) -> Generator[Tuple[np.ndarray, np.ndarray, np.ndarray], None, None]:
+    """Read the FASTQ file in chunks of reads.
+
+    Input:
+        path: The FASTQ file (may be compressed with gzip).
+        chunk_reads: The number of reads in each chunk.
+    Output: Generates, for each chunk, a tuple with:
+        - The sequences, as a matrix of bytes (a row per read, padded with zeros).
+        - The qualities (Phred scores), as a matrix of the same shape.
+        - The lengths of the reads.
+    """
+    for lines in read_records(path, chunk_reads):
+        yield to_arrays(lines)
+# ---
+
+def new_stats(max_length: int = 0) -> Dict[str, object]:
+    """Empty counts of the statistics of a FASTQ file."""
+    return {'reads': 0,
+            'bases': 0,
+            # [position, quality]
+            'quality': np.zeros((max_length, N_QUALITIES), dtype=np.int64),
+            # [position, base]
+            'composition': np.zeros((max_length, len(BASES)), dtype=np.int64),
+            # [length]
+            'length': np.zeros(max_length + 1, dtype=np.int64),
+            # [GC percent]
+            'gc': np.zeros(101, dtype=np.int64),
+            # The number of first reads whose sequences are counted, and the counts
+            'sampled': 0,
+            'sequences': Counter(),
+            # The files counted, whose sequences were pruned (see 'file_stats')
+            'files': 0}
+# ---
+
+def grow(counts: np.ndarray, size: int) -> np.ndarray:
+    """Make the first dimension of the counts at least this size, padding with zeros."""
+    if counts.shape[0] >= size:
+        return counts
+    padding = np.zeros((size - counts.shape[0],) + counts.shape[1:], dtype=counts.dtype)
+    return np.concatenate([counts, padding])
+# ---
+
+def update_stats(stats: Dict[str, object],
+                 sequences: np.ndarray,
+                 qualities: np.ndarray,
+                 lengths: np.ndarray):
+    """Add a chunk of reads (as returned from 'read_chunks') to the statistics."""
+    n_reads, width = sequences.shape
+    if not n_reads:
+        return
+
+    # Only the positions inside each read, not the padding
+    inside = np.arange(width)[np.newaxis, :] < lengths[:, np.newaxis]
+    positions = np.broadcast_to(np.arange(width), sequences.shape)[inside]
+
+    qualities = np.clip(qualities[inside], 0, N_QUALITIES - 1)
+    quality = np.bincount(positions * N_QUALITIES + qualities,
+                          minlength=width * N_QUALITIES).reshape(width, N_QUALITIES)
+
+    bases = BASE_INDEX[sequences]
+    composition = np.bincount(positions * len(BASES) + bases[inside],
+                              minlength=width * len(BASES)).reshape(width, len(BASES))
+
+    # GC content of each read, in percent
+    gc_bases = ((bases == BASES.index(b'G')) | (bases == BASES.index(b'C'))) & inside
+    gc_percent = np.round(100 * gc_bases.sum(axis=1) / np.maximum(lengths, 1)).astype(np.int64)
+
+    stats['quality'] = grow(stats['quality'], width)
+    stats['quality'][:width] += quality
+    stats['composition'] = grow(stats['composition'], width)
+    stats['composition'][:width] += composition
+    stats['length'] = grow(stats['length'], width + 1)
+    stats['length'] += np.bincount(lengths, minlength=stats['length'].shape[0])
+    stats['gc'] += np.bincount(gc_percent, minlength=101)
+
+    to_count = max(0, OVERREPRESENTED_READS - stats['sampled'])
+    if to_count > 0:
+        stats['sequences'].update(row[:min(length, OVERREPRESENTED_LENGTH)].tobytes()
+                                      for row, length in zip(sequences[:to_count],
+                                                             lengths[:to_count]))
+        stats['sampled'] += min(to_count, n_reads)
+
+    stats['reads'] += n_reads
+    stats['bases'] += int(lengths.sum())
+# ---
+
+def merge_stats(stats: Dict[str, object], other: Dict[str, object]) -> Dict[str, object]:
+    """Add up the statistics of two (sets of) files."""
+    merged = new_stats()
+
+    for key in ('quality', 'composition', 'length'):
+        size = max(stats[key].shape[0], other[key].shape[0])
+        merged[key] = grow(stats[key], size) + grow(other[key], size)
+
+    merged['gc'] = stats['gc'] + other['gc']
+    merged['reads'] = stats['reads'] + other['reads']
+    merged['bases'] = stats['bases'] + other['bases']
+    merged['sampled'] = stats['sampled'] + other['sampled']
+    merged['sequences'] = stats['sequences'] + other['sequences']
+    merged['files'] = stats['files'] + other['files']
+
+    return merged
+# ---
+
+def file_stats(path: Union[str, Path], chunk_reads: int = CHUNK_READS) -> Dict[str, object]:
+    """The statistics of a FASTQ file.
+
+    Only the overrepresented sequences are kept, so that the statistics of
+    hundreds of files can be merged in little memory. Their counts are exact
+    for the file. But once merged, a sequence only adds the counts of the
+    files where it is overrepresented: the counts of the merged statistics are
+    lower bounds, and a sequence barely overrepresented in all the files
+    together may be missed (see 'summarize').
+    """
+    stats = new_stats()
+    for sequences, qualities, lengths in read_chunks(path, chunk_reads):
+        update_stats(stats, sequences, qualities, lengths)
+
+    stats['sequences'] = Counter({sequence: count
+                                      for sequence, count in stats['sequences'].items()
+                                      if count > OVERREPRESENTED_FRACTION * stats['sampled']})
+    stats['files'] = 1
+    return stats
+# ---
+
+def percentiles(histograms: np.ndarray, fractions: List[float]) -> np.ndarray:
+    """Percentiles of the values from their histograms (one per row)."""
+    cumulative = histograms.cumsum(axis=1)
+    totals = cumulative[:, -1:]
+    return np.stack([(cumulative < np.maximum(totals * f, 1)).sum(axis=1)
+                         for f in fractions], axis=1)
+# ---
+
+def summarize(stats: Dict[str, object]) -> Dict[str, object]:
+    """Summarize the statistics in a report that can be written as JSON.
+
+    Output: A dictionary with:
+        reads, bases: The totals.
+        per_position_quality: For each position of the reads (starting from 1),
+                              the mean, the 10th, 25th, 50th, 75th and 90th
+                              percentiles of the quality (as in FastQC).
+        per_position_composition: For each position, the percent of A, C, G, T and N.
+        length_distribution: The number of reads of each length.
+        gc_distribution: The number of reads with each GC percent (0 to 100).
+        mean_gc: The mean GC percent of the reads.
+        overrepresented_sequences: The sequences found in more than 0.1% of
+                                   the first reads, with their count and percent.
+        overrepresented_lower_bounds: Whether those counts and percents are
+                                      lower bounds, for the statistics of
+                                      several files (see 'file_stats').
+    """
+    quality = stats['quality']
+    reads_at = quality.sum(axis=1)
+    covered = reads_at > 0
+
+    mean_quality = (quality * np.arange(N_QUALITIES)).sum(axis=1) / np.maximum(reads_at, 1)
+    quality_percentiles = percentiles(quality, [0.1, 0.25, 0.5, 0.75, 0.9])
+
+    composition = stats['composition']
+    composition_percent = 100 * composition / np.maximum(composition.sum(axis=1, keepdims=True), 1)
+
+    sampled = max(stats['sampled'], 1)
+    overrepresented = [{'sequence': sequence.decode('ascii', 'replace'),
+                        'count': count,
+                        'percent': round(100 * count / sampled, 3)}
+                           for sequence, count in stats['sequences'].most_common()
+                           if count > OVERREPRESENTED_FRACTION * sampled]
+
+    gc = stats['gc']
+
+    return {'reads': int(stats['reads']),
+            'bases': int(stats['bases']),
+            'per_position_quality': [
+                {'position': int(i) + 1,
+                 'mean': round(float(mean_quality[i]), 2),
+                 'p10': int(quality_percentiles[i, 0]),
+                 'p25': int(quality_percentiles[i, 1]),
+                 'median': int(quality_percentiles[i, 2]),
+                 'p75': int(quality_percentiles[i, 3]),
+                 'p90': int(quality_percentiles[i, 4])}
+                     for i in np.flatnonzero(covered)],
+            'per_position_composition': [
+                dict(position=int(i) + 1,
+                     **{chr(base): round(float(composition_percent[i, j]), 2)
+                            for j, base in enumerate(BASES)})
+                     for i in np.flatnonzero(covered)],
+            'length_distribution': {int(length): int(count)
+                                        for length, count in enumerate(stats['length'])
+                                        if count},
+            'gc_distribution': [int(count) for count in gc],
+            'mean_gc': round(float((gc * np.arange(101)).sum() / max(gc.sum(), 1)), 2),
+            'overrepresented_sequences': overrepresented,
+            'overrepresented_lower_bounds': stats['files'] > 1}
+# ---
+
+def reservoir_sample(paths: List[Union[str, Path]],
+                     n_reads: int,
+                     seed: int = 0,
+                     chunk_reads: int = CHUNK_READS) -> Tuple[List[bytes], int]:
+    """Draw a uniform random sample of reads from the FASTQ files, in a single pass.
+
+    Input:
+        paths: The FASTQ files, sampled as if they were a single one.
+        n_reads: The size of the sample.
+        seed: The seed of the random number generator, for repeatability.
+        chunk_reads: The number of reads read at once.
+    Output: A tuple with the sampled records (the 4 lines of each read
+            joined) and the total number of reads in the files.
+
+    Reservoir sampling ("Algorithm R"): the first reads fill the sample, then
+    the i-th read replaces a random read of the sample with probability n/i.
+    The random numbers of a whole chunk are drawn at once, and only the few
+    reads that make it into the sample are handled one by one.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = []
+    seen = 0
+
+    for path in paths:
+        for lines in read_records(path, chunk_reads):
+            records = [b'\n'.join(lines[i:i+4]) for i in range(0, len(lines), 4)]
+
+            # Fill the reservoir
+            missing = max(0, n_reads - len(reservoir))
+            reservoir += records[:missing]
+
+            # Each of the remaining reads replaces a random read of the sample
+            # if the number drawn for it falls inside the sample.
+            indices = seen + np.arange(missing, len(records))
+            slots = (rng.random(len(indices)) * (indices + 1)).astype(np.int64)
+            for i in np.flatnonzero(slots < n_reads):
+                reservoir[slots[i]] = records[missing + i]
+
+            seen += len(records)
+
+    return reservoir, seen
+# ---
+
+def write_records(records: List[bytes], path: Union[str, Path]):
+    """Write the records (as returned from 'reservoir_sample') to a FASTQ file."""
+    with open(path, 'wb') as fastq:
+        for record in records:
+            fastq.write(record + b'\n')
+# ---
+
+def mean_interval(histograms: np.ndarray, 
+                  population: Optional[int] = None, 
+                  z: float = 1.96) -> Tuple[np.ndarray, np.ndarray]:
+    """Confidence interval of the mean of the values, from their histograms (one per row).
+
+    Input:
+        histograms: The counts of each value (the column index), one row per variable.
+        population: The size of the population the sample was drawn from,
+                    for the finite population correction.
+        z: The quantile of the normal distribution (1.96 for 95% confidence).
+    Output: The lower and upper limits of the interval for each row.
+    """
+    values = np.arange(histograms.shape[1])
+    n = histograms.sum(axis=1)
+    mean = (histograms * values).sum(axis=1) / np.maximum(n, 1)
+    variance = (histograms * (values - mean[:, np.newaxis])**2).sum(axis=1) / np.maximum(n - 1, 1)
+
+    error = z * np.sqrt(variance / np.maximum(n, 1))
+    if population and population > 1:
+        error *= np.sqrt(np.clip((population - n) / (population - 1), 0, 1))
+
+    return mean - error, mean + error
+# ---
+
+def proportion_interval(k: int, n: int, z: float = 1.96) -> Tuple[float, float]:
+    """Wilson confidence interval of a proportion (k successes out of n)."""
+    if not n:
+        return 0.0, 1.0
+    p = k / n
+    center = (p + z**2 / (2*n)) / (1 + z**2 / n)
+    half = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return max(0.0, center - half), min(1.0, center + half)
+# ---
+
+def confidence(stats: Dict[str, object], total_reads: int) -> Dict[str, object]:
+    """The 95% confidence intervals of the statistics of a sample of reads.
+
+    Input:
+        stats: The statistics of the sample (see 'new_stats').
+        total_reads: The number of reads the sample was drawn from.
+    Output: A dictionary with:
+        sampled_reads, total_reads, sampled_fraction.
+        mean_quality: For each position of the reads, the [lower, upper] limits
+                      of the mean quality.
+        mean_gc: The [lower, upper] limits of the mean GC percent.
+        overrepresented_sequences: For each overrepresented sequence, the
+                                   [lower, upper] limits of its percent.
+    """
+    quality = stats['quality']
+    covered = np.flatnonzero(quality.sum(axis=1) > 0)
+    quality_low, quality_high = mean_interval(quality[covered], total_reads)
+    gc_low, gc_high = mean_interval(stats['gc'][np.newaxis, :], total_reads)
+
+    sampled = stats['sampled']
+    overrepresented = dict()
+    for sequence, count in stats['sequences'].most_common():
+        if count > OVERREPRESENTED_FRACTION * sampled:
+            low, high = proportion_interval(count, sampled)
+            overrepresented[sequence.decode('ascii', 'replace')] = [round(100 * low, 3),
+                                                                     round(100 * high, 3)]
+
+    return {'sampled_reads': int(stats['reads']),
+            'total_reads': int(total_reads),
+            'sampled_fraction': round(stats['reads'] / max(total_reads, 1), 6),
+            'mean_quality': [{'position': int(i) + 1,
+                              'interval': [round(float(low), 2), round(float(high), 2)]}
+                                 for i, low, high in zip(covered, quality_low, quality_high)],
+            'mean_gc': [round(float(gc_low[0]), 2), round(float(gc_high[0]), 2)],
+            'overrepresented_sequences': overrepresented}
+# ---
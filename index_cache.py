@@ -0,0 +1,180 @@
+"""
+Keeping a copy of the genome index in the nodes.
+================================================
+
+Author: Andrés García García @ Sept 2018
+
+Every mapping task reads the genome index (several Gb, the files
+'genome_snp_tran.*.ht2') from the shared filesystem. With a whole job array
+running, that is dozens of big reads at the same time from the fileserver,
+and HISAT2 takes minutes just to start.
+
+So, the mapping job array script can ask this module for a copy of the index
+in a local directory of the node ('stage_index'), e.g. in the local disk or in
+a tmpfs like '/dev/shm'. The first task executed in a node copies the index
+there, and the following tasks in the same node just use the copy.
+
+The cache directory has a subdirectory for each cached index, named after the
+index and its fingerprint (the size and modification time of its files), so
+a changed index is copied again instead of using the stale copy:
+
+    <cache dir>
+        ├── .lock                                       (the lock of the cache)
+        ├── genome_snp_tran-<fingerprint>.lock          (held by the tasks using it)
+        └── genome_snp_tran-<fingerprint>
+               ├── .complete                            (written after the copy)
+               ├── genome_snp_tran.1.ht2
+               ...
+
+When there is not enough space for a new index, the least recently used ones
+are removed, unless a task in the node is still using them. If there is still
+not enough space, the index in the shared filesystem is used.
+
+The index files can also be read ahead into the page cache of the node
+('prewarm'), so that HISAT2 doesn't wait for the disk when loading it.
+
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+from typing import Union, List, Optional
+
+from tasks import fingerprint_files
+
+
+# Fraction of the disk of the cache that is left free after copying an index
+MIN_FREE_FRACTION = 0.1
+
+# The locks on the indices used by the current process.
+# They are released when the process finishes.
+_in_use = []
+
+
+def index_files(idx_prefix: Union[str, Path]) -> List[str]:
+    """The files of the HISAT2 index with the given prefix."""
+    idx_prefix = Path(idx_prefix)
+    return sorted(str(f) for f in idx_prefix.parent.glob(idx_prefix.name + '.*.ht2'))
+# ---
+
+def cache_key(idx_prefix: Union[str, Path]) -> str:
+    """The name of the copy of the index in the cache, e.g. 'genome_snp_tran-3f9a0c1b2d4e'.
+
+    Includes the size and modification time of the index files, so that a
+    changed index doesn't match an old copy.
+    """
+    fingerprint = {Path(file).name: stat
+                       for file, stat in fingerprint_files(index_files(idx_prefix)).items()}
+    digest = hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    return f'{Path(idx_prefix).name}-{digest[:12]}'
+# ---
+
+def evict(cache_dir: Path, needed: int) -> bool:
+    """Remove the least recently used indices until there is enough free space.
+
+    Input:
+        cache_dir: The cache directory.
+        needed: The bytes needed for the new index.
+    Output: Whether there is enough space now.
+
+    The indices in use by some task are not removed. Must be called holding
+    the lock of the cache.
+    """
+    def enough_space():
+        disk = shutil.disk_usage(cache_dir)
+        return disk.free - needed > MIN_FREE_FRACTION * disk.total
+    # ---
+
+    # Least recently used first
+    cached = sorted(cache_dir.glob('*/.complete'), key=lambda f: f.stat().st_mtime)
+
+    for marker in cached:
+        if enough_space():
+            break
+
+        entry = marker.parent
+        with open(f'{entry}.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # In use
+                continue
+            print(f'Removing the index {entry.name} from the cache.', flush=True)
+            shutil.rmtree(entry)
+
+    return enough_space()
+# ---
+
+def prewarm(files: List[str]):
+    """Ask the kernel to read the files into the page cache in the background."""
+    for file in files:
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+# ---
+
+def stage_index(idx_prefix: Union[str, Path],
+                cache_dir: Optional[Union[str, Path]] = None,
+                prewarm_index: bool = False) -> str:
+    """Get a copy of the index in the local cache of the node.
+
+    Input:
+        idx_prefix: The prefix of the index files (in the shared filesystem).
+        cache_dir: The local directory where the indices are cached. If not
+                   given, the index is not copied.
+        prewarm_index: Whether to read the index into the page cache.
+    Output: The prefix of the index to use: the one of the local copy, or the
+            given one if it couldn't be copied.
+    """
+    files = index_files(idx_prefix)
+    local_prefix = str(idx_prefix)
+
+    if cache_dir and files:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+        key = cache_key(idx_prefix)
+        entry = cache_dir / key
+
+        # Only a task at a time in the node copies or removes indices
+        with open(cache_dir / '.lock', 'w') as cache_lock:
+            fcntl.flock(cache_lock, fcntl.LOCK_EX)
+
+            if not (entry / '.complete').exists():
+                # Leftovers of a task killed while copying
+                if entry.exists():
+                    shutil.rmtree(entry)
+
+                needed = sum(Path(f).stat().st_size for f in files)
+                if evict(cache_dir, needed):
+                    print(f'Copying the index {idx_prefix} to {entry}.', flush=True)
+                    entry.mkdir()
+                    for file in files:
+                        shutil.copy2(file, entry)
+                    (entry / '.complete').touch()
+                else:
+                    print(f'WARNING: Not enough space in {cache_dir} for the index, '
+                           'using the shared one.', flush=True)
+
+            if (entry / '.complete').exists():
+                # Mark as in use until the process finishes, so it isn't removed
+                lock = open(f'{entry}.lock', 'w')
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                _in_use.append(lock)
+
+                # Recently used
+                (entry / '.complete').touch()
+                local_prefix = str(entry / Path(idx_prefix).name)
+                files = index_files(local_prefix)
+
+    if prewarm_index:
+        prewarm(files)
+
+    return local_prefix
+# ---
@@ -0,0 +1,471 @@
+"""
+Executing the job array scripts.
+================================
+
+Author: Andrés García García @ Sept 2018
+
+All the analysis scripts (`script.quality_check.py`, `script.trimming.py`,
+`script.rnaseq_map.py`, `script.sam_to_bam.py`) assemble a job array script
+and submit it to the SGE queue with 'qsub'. The generated script fetches the
+command to execute from the 'SGE_TASK_ID' environment variable.
+
+When the cluster queue is backed up, small reruns can wait for hours for work
+that would take minutes on a single big node. So, this module provides a
+local executor that runs the very same generated script on the current machine,
+setting 'SGE_TASK_ID' by itself for each task. The tasks run in a bounded pool
+of workers, as many as fit in the machine given the cores and RAM requested
+per task.
+
+The output of each task is written to a log file named like the ones produced
+by SGE (<job name>.o<job id>.<task id>), so the logs can be inspected in the
+same way.
+
+Many small commands can be packed in the same task ('batch_commands'), so
+that the overhead of scheduling and starting each task (and the Python
+interpreter, and for some tools a JVM) is paid only once per batch.
+
+The resources requested for each task can also be predicted from the resources
+used in previous runs of the same stage, as recorded by the tasks in the file
+'accounting.<stage>.jsonl' (see `tasks.py`). The memory is predicted from the
+size of the input files, and the cores from the CPU usage of the tool. The
+commands are then grouped by the resources they need and a job array is
+submitted for each group ('resource_groups'). So, small tasks don't request
+more than they need (and more of them run at the same time), and large ones
+don't get killed for lack of memory.
+
+Before the first run of a stage, the same numbers can be measured by a pilot
+run on a few chunks (`script.pipeline.py --pilot`, see `pilot.py`), which
+writes them to the file 'pilot.json'. They are used until there are enough
+previous runs of the stage.
+
+Several job arrays can also be chained task by task: the N-th task of a stage
+starts as soon as the N-th task of the previous stage finishes. In SGE this is
+done with array task dependencies (qsub -hold_jid_ad), locally by running the
+tasks of all the stages for the same task id one after another in the same
+worker.
+
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import subprocess
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+from typing import Union, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from tasks import reads_of, accounting_file, REQUEUE_EXIT_CODE
+
+
+# Rough throughput of each stage, in Mb of input per minute and per core.
+# Only used to estimate the duration of the commands when batching them.
+THROUGHPUT = {'quality_check': 300,
+              'trimming': 150,
+              'rnaseq_map': 40,
+              'sam_to_bam': 300}
+
+# Previous runs needed to predict the resources of a stage
+MIN_HISTORY = 3
+
+# Factor applied to the predicted memory, to be on the safe side
+MEMORY_MARGIN = 1.25
+
+# The resources measured by the pilot run (see `pilot.py`)
+PILOT_FILE = 'pilot.json'
+
+
+def machine_capacity() -> Tuple[int, float]:
+    """Get the resources of the current machine.
+
+    Output: A tuple with the number of cores and the amount of RAM (in Gb).
+    """
+    cores = os.cpu_count() or 1
+    ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+    return cores, ram
+# ---
+
+def job_name(script_name: Union[str, Path]) -> str:
+    """Get the name of the job array from the '#$ -N <name>' line of the script."""
+    text = Path(script_name).read_text()
+    match = re.search(r'^#\$ -N (\S+)', text, re.MULTILINE)
+
+    return match.group(1) if match else Path(script_name).stem
+# ---
+
+def max_workers(cores: int = 1, ram: float = 8) -> int:
+    """How many tasks requesting the given resources fit in the machine."""
+    machine_cores, machine_ram = machine_capacity()
+
+    workers = min(machine_cores // int(cores),
+                  int(machine_ram // float(ram)))
+    if workers < 1:
+        print(f'WARNING: A task requests {cores} cores and {ram}G of RAM but the '
+              f'machine only has {machine_cores} cores and {machine_ram:.1f}G of RAM. '
+               'Running one task at a time.', flush=True)
+        workers = 1
+
+    return workers
+# ---
+
+def input_bytes(command: str) -> int:
+    """The total size of the input reads of the command."""
+    return sum(Path(f).stat().st_size
+                   for f in reads_of(command) if Path(f).exists())
+# ---
+
+def read_accounting(stage: str) -> List[dict]:
+    """The resources used by the successful commands of previous runs of the stage."""
+    records = []
+
+    if accounting_file(stage).exists():
+        for line in accounting_file(stage).read_text().split('\n'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Empty or incomplete line
+                continue
+            if record['exit_code'] == 0 and record['input_bytes'] > 0:
+                records.append(record)
+
+    return records
+# ---
+
+def read_pilot(stage: str) -> Optional[dict]:
+    """The resources of the stage measured by the pilot run, if any."""
+    if not Path(PILOT_FILE).exists():
+        return None
+
+    pilot = json.loads(Path(PILOT_FILE).read_text())
+    return pilot['stages'].get(stage)
+# ---
+
+def stage_throughput(stage: str) -> float:
+    """The throughput of the stage, in Mb of input per minute.
+
+    The median of the previous runs if there are enough of them, otherwise
+    the one measured by the pilot run, or a rough default.
+    """
+    history = [r for r in read_accounting(stage) if r['wall_time'] > 0]
+
+    if len(history) < MIN_HISTORY:
+        pilot = read_pilot(stage)
+        return pilot['throughput'] if pilot else THROUGHPUT.get(stage, 100)
+
+    rates = sorted(r['input_bytes'] / 1024**2 / (r['wall_time'] / 60) for r in history)
+    return rates[len(rates) // 2]
+# ---
+
+def estimated_minutes(command: str, stage: str) -> float:
+    """Estimate how long the command will take, from the size of its input reads."""
+    return input_bytes(command) / 1024**2 / stage_throughput(stage)
+# ---
+
+def used_cores(records: List[dict], cores: int = 1) -> int:
+    """The cores used by the tool (90th percentile of the CPU time over the
+    wall time of the records), or the given ones if unknown."""
+    cpu_usage = sorted(r['cpu_usage'] for r in records if r['cpu_usage'] is not None)
+    if not cpu_usage:
+        return cores
+    # A bit of CPU over a whole core is just overhead.
+    return max(1, math.ceil(cpu_usage[int(0.9 * (len(cpu_usage)-1))] - 0.1))
+# ---
+
+def memory_request(baseline: float, per_byte: float, size: int) -> int:
+    """The RAM (in Gb) to request for an input of the given size.
+
+    The peak memory (in Mb) is a baseline plus an amount per byte of input,
+    with a safety margin, rounded up to a power of 2.
+    """
+    memory_gb = (baseline + per_byte * size) * MEMORY_MARGIN / 1024
+    return 2 ** max(0, math.ceil(math.log2(max(memory_gb, 1))))
+# ---
+
+def predict_resources(commands: List[str],
+                      stage: str,
+                      ram: float = 8,
+                      cores: int = 1) -> List[Tuple[int, int]]:
+    """Predict the RAM and cores each command needs from previous runs of the stage.
+
+    Input:
+        commands: The commands.
+        stage: The stage of the commands.
+        ram, cores: The resources to use if there are no previous runs.
+    Output: The (RAM in Gb, cores) for each command.
+
+    The memory is modeled as a baseline (the lowest peak memory seen) plus an
+    amount proportional to the size of the input files (the largest seen),
+    with a safety margin, and rounded up to a power of 2 so that the
+    commands fall in a few groups.
+    The cores are the ones actually used by the tool (90th percentile of
+    the CPU time over the wall time).
+    Without enough previous runs, the model fitted by the pilot run is used
+    instead, if there is one.
+    """
+    history = read_accounting(stage)
+    pilot = read_pilot(stage)
+
+    if len(history) >= MIN_HISTORY:
+        baseline = min(r['max_rss_mb'] for r in history)
+        per_byte = max((r['max_rss_mb'] - baseline) / r['input_bytes'] for r in history)
+        predicted_cores = used_cores(history, cores)
+
+        # The inputs of the later stages of a pipeline don't exist yet,
+        # for those we assume the largest input seen.
+        largest_input = max(r['input_bytes'] for r in history)
+    elif pilot:
+        print(f'Not enough previous runs of {stage}, using the resources '
+               'measured by the pilot run.', flush=True)
+        baseline, per_byte = pilot['baseline_mb'], pilot['mb_per_byte']
+        predicted_cores = pilot['cores']
+        largest_input = pilot['largest_input_bytes']
+    else:
+        print(f'Not enough previous runs of {stage} to predict the resources, '
+              f'using {ram}G of RAM and {cores} cores.', flush=True)
+        return [(ram, cores)] * len(commands)
+
+    return [(memory_request(baseline, per_byte, input_bytes(command) or largest_input),
+             predicted_cores)
+                for command in commands]
+# ---
+
+def resource_groups(commands: List[str],
+                    stage: str,
+                    ram: float = 8,
+                    cores: int = 1,
+                    auto: bool = False) -> List[Tuple[float, int, List[int]]]:
+    """Group the commands by the resources they need.
+
+    Input:
+        commands: The commands.
+        stage: The stage of the commands.
+        ram, cores: The resources requested for every command.
+        auto: Whether to predict the resources of each command from the
+              previous runs instead (see 'predict_resources').
+    Output: A list of (RAM, cores, command ids) for each group. The ids start
+            from 1. Without 'auto' there is a single group.
+    """
+    ids = list(range(1, len(commands)+1))
+
+    if not auto:
+        return [(ram, cores, ids)]
+
+    groups = dict()
+    for i, resources in zip(ids, predict_resources(commands, stage, ram, cores)):
+        groups.setdefault(resources, []).append(i)
+
+    for (group_ram, group_cores), group_ids in sorted(groups.items()):
+        print(f'    {len(group_ids)} commands need {group_ram}G of RAM and {group_cores} cores.')
+
+    return [(group_ram, group_cores, group_ids)
+                for (group_ram, group_cores), group_ids in sorted(groups.items())]
+# ---
+
+def script_file(script_name: str,
+                ram: float,
+                cores: int,
+                n_groups: int = 1) -> str:
+    """The name of the job array script of a group of commands.
+
+    If there are several groups, the resources are added to the name, e.g.
+    'script.autogenerated.trimming_jobs.16G_1c.py'.
+    """
+    if n_groups == 1:
+        return script_name
+    return re.sub(r'\.py$', f'.{ram}G_{cores}c.py', script_name)
+# ---
+
+def batch_commands(commands: List[str],
+                   batch_size: Optional[int] = None,
+                   target_minutes: Optional[float] = None,
+                   stage: Optional[str] = None,
+                   ids: Optional[List[int]] = None) -> List[List[int]]:
+    """Group the commands in batches, each one to be executed by a single task.
+
+    Input:
+        commands: The commands to group.
+        batch_size: The number of commands in each batch.
+        target_minutes: If given, consecutive commands are grouped until
+                        their estimated duration reaches this many minutes.
+                        Overrides the batch size.
+        stage: The stage of the commands, to estimate their duration.
+        ids: The ids of the commands to group (starting from 1). 
+             Default: All of them.
+    Output: The batches, as lists of command ids.
+
+    The commands keep their order, so batches of different stages made with
+    the same batch size match each other.
+    """
+    ids = ids if ids else list(range(1, len(commands)+1))
+
+    if target_minutes:
+        batches, batch, minutes = [], [], 0
+        for i in ids:
+            batch.append(i)
+            minutes += estimated_minutes(commands[i-1], stage)
+            if minutes >= float(target_minutes):
+                batches.append(batch)
+                batch, minutes = [], 0
+        if batch:
+            batches.append(batch)
+        return batches
+
+    batch_size = int(batch_size) if batch_size else 1
+    return [ids[i:i+batch_size] for i in range(0, len(ids), batch_size)]
+# ---
+
+def run_task(script_name: Union[str, Path],
+             task_id: int,
+             log_prefix: str) -> int:
+    """Run a single task of the job array script on the current machine.
+
+    Input:
+        script_name: The generated job array script.
+        task_id: The task to execute (starting from 1, as in SGE).
+        log_prefix: The prefix of the log file of the task.
+    Output: The exit code of the task.
+
+    As SGE does, a task exiting with REQUEUE_EXIT_CODE (a stalled command was
+    killed, see `tasks.py`) is executed again, appending to the same log.
+    """
+    env = dict(os.environ, SGE_TASK_ID=str(task_id))
+
+    with open(f'{log_prefix}.{task_id}', 'w') as log:
+        while True:
+            executed = subprocess.run([sys.executable, str(script_name)],
+                                      env=env,
+                                      stdout=log,
+                                      stderr=subprocess.STDOUT)
+            if executed.returncode != REQUEUE_EXIT_CODE:
+                return executed.returncode
+            print(f'Task {task_id} of {script_name} stalled, executing it again.', flush=True)
+# ---
+
+def run_local(script_name: Union[str, Path],
+              n_tasks: int,
+              cores: int = 1,
+              ram: float = 8) -> List[int]:
+    """Run all the tasks of the job array script on the current machine.
+
+    Input:
+        script_name: The generated job array script.
+        n_tasks: The number of tasks in the job array.
+        cores: The number of cores used by each task.
+        ram: The amount of RAM used by each task (in Gb).
+    Output: The exit codes of the tasks, in order.
+
+    The tasks are packed in a pool of workers so that the machine capacity
+    is not exceeded.
+    """
+    # Mimic the names of the SGE logs, using the process id as job id.
+    log_prefix = f'{job_name(script_name)}.o{os.getpid()}'
+    workers = max_workers(cores, ram)
+
+    print(f'Running {n_tasks} tasks of {script_name} locally, '
+          f'{workers} at a time. Logs: {log_prefix}.<task id>', flush=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        exit_codes = list(pool.map(lambda i: run_task(script_name, i, log_prefix),
+                                   range(1, n_tasks+1)))
+
+    failed = [i+1 for i,code in enumerate(exit_codes) if code != 0]
+    if failed:
+        print(f'{len(failed)} tasks failed: {failed}', flush=True)
+
+    return exit_codes
+# ---
+
+def run_local_chain(stages: List[Tuple[Union[str, Path], int, float]],
+                    n_tasks: int) -> List[List[int]]:
+    """Run several job array scripts on the current machine, chained task by task.
+
+    Input:
+        stages: The (script name, cores, RAM) of each stage, in order of execution.
+                All the scripts must have the same number of tasks, and the N-th
+                task of each stage must depend only on the N-th task of the
+                previous one.
+        n_tasks: The number of tasks in each job array.
+    Output: The exit codes of the tasks of each stage. A task whose previous
+            stage failed is not executed and its exit code is None.
+
+    The N-th task of a stage starts as soon as the N-th task of the previous
+    stage finishes, instead of waiting for the whole previous job array.
+    """
+    log_prefixes = [f'{job_name(script_name)}.o{os.getpid()}'
+                        for script_name, _, _ in stages]
+    # Each worker runs the whole chain, so it must fit the largest stage.
+    workers = min(max_workers(cores, ram) for _, cores, ram in stages)
+
+    print(f'Running {len(stages)} chained stages of {n_tasks} tasks locally, '
+          f'{workers} chains at a time. Logs: {", ".join(log_prefixes)}', flush=True)
+
+    def run_chain(task_id):
+        exit_codes = [None] * len(stages)
+        for i, (script_name, _, _) in enumerate(stages):
+            exit_codes[i] = run_task(script_name, task_id, log_prefixes[i])
+            if exit_codes[i] != 0:
+                print(f'Task {task_id} failed in {script_name}, '
+                       'skipping the following stages.', flush=True)
+                break
+        return exit_codes
+    # ---
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chains = list(pool.map(run_chain, range(1, n_tasks+1)))
+
+    # Transpose to get the exit codes by stage
+    return [list(codes) for codes in zip(*chains)]
+# ---
+
+def qsub(script_name: Union[str, Path],
+         hold_jid: Optional[str] = None,
+         sync: bool = False) -> str:
+    """Submit the job array script to the SGE queue.
+
+    Input:
+        script_name: The generated job array script.
+        hold_jid: The id of a job array of the same size. If given, each task
+                  of the submitted array waits only for the corresponding task
+                  of that array to finish (qsub -hold_jid_ad).
+        sync: Whether to wait for all the tasks to finish (qsub -sync y).
+    Output: The id of the submitted job array.
+    """
+    command = ['qsub', '-terse']
+    if hold_jid:
+        command += ['-hold_jid_ad', hold_jid]
+    if sync:
+        command += ['-sync', 'y']
+    command.append(str(script_name))
+
+    submitted = subprocess.run(command, stdout=subprocess.PIPE)
+    if not sync:
+        # When waiting, the exit code is the one of the tasks
+        submitted.check_returncode()
+    output = submitted.stdout.decode('UTF-8').strip()
+    # For job arrays the output looks like '<job id>.<first>-<last>:<step>',
+    # followed by the exit status of each task when waiting for them.
+    job_id = output.split('\n')[0].split('.')[0]
+    print(f'Submitted {script_name} as job {job_id}', flush=True)
+
+    return job_id
+# ---
+
+def load_script(script_name: Union[str, Path]) -> ModuleType:
+    """Import one of the pipeline scripts as a module.
+
+    The scripts have dots in their names (e.g. `script.trimming.py`), so they
+    can't be imported with the 'import' statement.
+    """
+    path = Path(__file__).parent / script_name
+    module_name = path.stem.replace('.', '_')
+
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+# ---
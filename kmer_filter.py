@@ -0,0 +1,199 @@
+"""
+Filtering the contaminant reads before mapping.
+===============================================
+
+Author: Andrés García García @ Sept 2018
+
+The reads of ribosomal RNA (and of other abundant contaminants) go through
+the whole spliced alignment against the genome, only to be discarded
+afterwards. Here they are recognized by their k-mers before mapping:
+
+    - The k-mers (K bases, encoded with 2 bits per base in an unsigned 64 bit
+      integer) of the sequences of a FASTA file of contaminants are kept in a
+      sorted array ('kmer_index'), in their canonical form (the smallest of
+      the k-mer and its reverse complement), so that both strands match. The
+      array is saved next to the FASTA file ('<fasta>.k<K>.npy') and only
+      built again if the FASTA file changes ('load_index').
+    - The k-mers of every position of a chunk of reads are computed at once
+      with NumPy, joining shorter k-mers ('canonical_kmers'), and looked up
+      in the array with a binary search ('contaminant_hits'). Most k-mers of
+      a read are not in the array, so they are first looked up in a bitset
+      of the last bases of the k-mers of the contaminants (BITSET_BITS bits),
+      and only the ones found there are searched. The k-mers with an N are
+      left out.
+    - A read (or pair, adding the hits of both mates) with at least MIN_HITS
+      hits is a contaminant ('filter_reads'). The contaminant reads are
+      written to a side file, and the rest to the output, e.g. the standard
+      output piped into HISAT2.
+
+With K = 31, a random k-mer of a read matches a k-mer of a contaminant of L
+bases with a probability of about 2 L / 4^31, so a read is practically
+never taken for a contaminant by chance.
+
+See `script.kmer_filter.py` for the command line interface.
+
+"""
+
+from pathlib import Path
+from typing import Union, List, Tuple, Dict, Iterator, BinaryIO
+
+import numpy as np
+
+from fastq import to_arrays, BASE_INDEX
+from trim import read_fasta
+
+
+VERSION = '0.1'
+
+# The length of the k-mers (at most 32, 2 bits per base)
+K = 31
+
+# The k-mers of a read (or pair) found in the contaminants to filter it out
+MIN_HITS = 2
+
+# The bits of the last bases of the k-mers in the bitset (the last 12 bases)
+BITSET_BITS = 24
+
+
+def canonical_kmers(codes: np.ndarray, k: int = K) -> Tuple[np.ndarray, np.ndarray]:
+    """The canonical k-mers at every position of the sequences.
+
+    Input: The codes of the bases of the sequences (A 0, C 1, G 2, T 3, N or
+           padding 4), one per row.
+    Output: The k-mers, and whether they are valid (without N), one row per
+            sequence and one column per position.
+    """
+    n_sequences, width = codes.shape
+    positions = max(width - k + 1, 0)
+
+    def join(first, second):
+        """The (a + b)-mers, from the (forward, reverse complement, a) a-mers
+        and the b-mers. The reverse complement of AB is that of B, then of A."""
+        (forward_a, reverse_a, a), (forward_b, reverse_b, b) = first, second
+        n = max(width - a - b + 1, 0)
+        return ((forward_a[:, :n] << np.uint64(2 * b)) | forward_b[:, a:a+n],
+                (reverse_b[:, a:a+n] << np.uint64(2 * a)) | reverse_a[:, :n],
+                a + b)
+    # ---
+
+    # The 1-mers, 2-mers, 4-mers, ... joined into the k-mers (by the binary
+    # digits of k).
+    bases = (codes & 3).astype(np.uint64)
+    power = (bases, np.uint64(3) - bases, 1)
+    kmers = None
+    for bit in range(k.bit_length()):
+        if k >> bit & 1:
+            kmers = join(kmers, power) if kmers else power
+        if k >> bit > 1:
+            power = join(power, power)
+
+    forward, reverse, _ = kmers
+
+    n_count = np.zeros((n_sequences, width + 1), dtype=np.int32)
+    np.cumsum(codes == 4, axis=1, out=n_count[:, 1:])
+    valid = (n_count[:, k:] - n_count[:, :positions]) == 0
+
+    return np.minimum(forward, reverse), valid
+# ---
+
+def kmer_array(sequences: List[str], k: int = K) -> np.ndarray:
+    """The sorted array of the distinct canonical k-mers of the sequences."""
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    for sequence in sequences:
+        codes = BASE_INDEX[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)][None, :]
+        sequence_kmers, valid = canonical_kmers(codes, k)
+        kmers.append(sequence_kmers[valid])
+
+    return np.unique(np.concatenate(kmers))
+# ---
+
+def kmer_index(kmers: np.ndarray) -> Dict[str, np.ndarray]:
+    """The index of the sorted array of k-mers: the array, and the bitset of
+    their last bases."""
+    bitset = np.zeros(2**BITSET_BITS, dtype=bool)
+    bitset[(kmers & np.uint64(2**BITSET_BITS - 1)).astype(np.int64)] = True
+    return {'kmers': kmers, 'bitset': bitset}
+# ---
+
+def index_file(fasta: Union[str, Path], k: int = K) -> Path:
+    """Where the index of the FASTA file is saved."""
+    return Path(f'{fasta}.k{k}.npy')
+# ---
+
+def load_index(fasta: Union[str, Path], k: int = K) -> Dict[str, np.ndarray]:
+    """The index of the contaminants of the FASTA file (see 'kmer_index').
+
+    The array of k-mers is saved (through a temporary file) next to the FASTA
+    file, and built again only if the FASTA file is newer.
+    """
+    saved = index_file(fasta, k)
+    if saved.exists() and saved.stat().st_mtime >= Path(fasta).stat().st_mtime:
+        return kmer_index(np.load(saved))
+
+    kmers = kmer_array([sequence for _, sequence in read_fasta(fasta)], k)
+
+    temporary = saved.with_name(saved.name + '.tmp.npy')
+    np.save(temporary, kmers)
+    temporary.replace(saved)
+    return kmer_index(kmers)
+# ---
+
+def contaminant_hits(lines: List[bytes], index: Dict[str, np.ndarray], k: int = K) -> np.ndarray:
+    """The number of k-mers of each read (of the lines of a FASTQ chunk) found in the index."""
+    sequences, _, _ = to_arrays(lines)
+    kmers, valid = canonical_kmers(BASE_INDEX[sequences], k)
+    hits = np.zeros(len(kmers), dtype=np.int64)
+    if not len(index['kmers']):
+        return hits
+
+    # Only the k-mers in the bitset may be in the array
+    candidates = valid & index['bitset'][(kmers & np.uint64(2**BITSET_BITS - 1)).astype(np.int64)]
+    reads, _ = np.nonzero(candidates)
+    kmers = kmers[candidates]
+
+    found = np.minimum(np.searchsorted(index['kmers'], kmers), len(index['kmers']) - 1)
+    np.add.at(hits, reads[index['kmers'][found] == kmers], 1)
+    return hits
+# ---
+
+def write_chunk(output: BinaryIO, chunk: Tuple[List[bytes], ...], selected: np.ndarray):
+    """Write the selected reads (or pairs, interleaved) of the chunk."""
+    records = [b'\n'.join(lines[4*i+mate_line]
+                              for lines in chunk
+                                  for mate_line in range(4))
+                   for i in np.flatnonzero(selected)]
+    if records:
+        output.write(b'\n'.join(records) + b'\n')
+# ---
+
+def filter_reads(chunks: Iterator[Tuple[List[bytes], ...]],
+                 index: np.ndarray,
+                 output: BinaryIO,
+                 contaminants: BinaryIO,
+                 min_hits: int = MIN_HITS,
+                 k: int = K) -> Dict[str, int]:
+    """Split the reads (or pairs) between the output and the contaminants file.
+
+    Input:
+        chunks: The chunks of reads, as from 'read_mates' or 'read_interleaved'
+                (see `fastq.py`).
+        index: The index of the contaminants, as from 'load_index'.
+        output, contaminants: Where to write the reads (pairs interleaved).
+        min_hits: The k-mers found in the contaminants to filter a read out.
+        k: The length of the k-mers of the index.
+    Output: The number of reads (or pairs), and of contaminant ones.
+    """
+    counts = {'reads': 0, 'contaminants': 0}
+
+    for chunk in chunks:
+        hits = sum(contaminant_hits(lines, index, k) for lines in chunk)
+        contaminant = hits >= min_hits
+
+        write_chunk(output, chunk, ~contaminant)
+        write_chunk(contaminants, chunk, contaminant)
+
+        counts['reads'] += len(contaminant)
+        counts['contaminants'] += int(contaminant.sum())
+
+    return counts
+# ---
@@ -0,0 +1,190 @@
+"""
+Calibrating the resources of a run with a pilot run.
+====================================================
+
+Author: Andrés García García @ Sept 2018
+
+The resources a stage needs (memory, cores, time) are only known after
+submitting the full job arrays (281 tasks) and seeing them fail for lack of
+memory, hang, or fight for the cores. The accounting of previous runs (see
+`jobs.py`) helps only from the second run on.
+
+Instead, `script.pipeline.py --pilot N` runs every stage, the quality check
+included, on a random sample of the reads of a few chunks first:
+
+    - A few chunks are chosen, spread from the smallest to the largest
+      ('representative_chunks'), and a random sample of their reads is
+      written to files of the same name ('sample_chunk'). The chunks get
+      different numbers of reads (N / K, 2 N / K, ..., N for K chunks), so that
+      the fixed cost of each task (starting FastQC, loading the genome index)
+      can be told apart from the cost per read. The same reads are drawn from
+      both mates of a chunk.
+    - The stages are executed on them, as a tiny job array or locally, and
+      each task records the resources it used (see `tasks.py`).
+    - For each stage, a line is fitted to the CPU time, wall time and peak
+      memory as a function of the size of the input of the tasks
+      ('fit_line'), and extrapolated to the full run ('calibrate_stage'): the
+      CPU-hours, the wall time of the largest task, the RAM and cores to
+      request, the throughput, and the size of the outputs. The input of the
+      later stages of the full run is estimated from the ratio between the
+      inputs of each stage and the raw reads in the pilot run.
+
+The totals assume that every task of a stage runs at the same time, so the
+wall time of the run is that of the largest task of each stage. The fetching
+only links the raw files (`script.fetch_data.py`), it is not extrapolated.
+
+The calibration is written to 'pilot.json' in the working directory, where
+the generators of the job arrays use it with `--auto_resources` until there
+are enough previous runs of each stage (see 'predict_resources' in `jobs.py`).
+
+"""
+
+from pathlib import Path
+from typing import Union, List, Tuple, Dict
+
+import numpy as np
+
+from fastq import reservoir_sample, write_records
+from jobs import read_accounting, used_cores, memory_request
+from tasks import files_of
+
+
+# The chunks sampled by default
+PILOT_CHUNKS = 3
+
+
+def chunk_bytes(files: Tuple[str, ...]) -> int:
+    """The size of the files of a chunk."""
+    return sum(Path(f).stat().st_size for f in files)
+# ---
+
+def representative_chunks(chunks: List[Tuple[str, ...]],
+                          n_chunks: int = PILOT_CHUNKS) -> List[Tuple[str, ...]]:
+    """The chunks (pairs of files, or single files) spread evenly by size, from
+    the smallest to the largest."""
+    by_size = sorted(chunks, key=chunk_bytes)
+    if len(by_size) <= n_chunks:
+        return by_size
+    if n_chunks == 1:
+        return [by_size[len(by_size) // 2]]
+
+    return [by_size[round(i * (len(by_size) - 1) / (n_chunks - 1))]
+                for i in range(n_chunks)]
+# ---
+
+def sample_chunk(files: Tuple[str, ...],
+                 n_reads: int,
+                 output_dir: Union[str, Path],
+                 seed: int = 0) -> List[str]:
+    """Write a random sample of the reads of a chunk to files of the same name.
+
+    The mates have the same number of reads, so the same seed draws the same
+    reads from each of them.
+    """
+    samples = []
+    for path in files:
+        records, _ = reservoir_sample([path], n_reads, seed)
+        sample = Path(output_dir) / Path(path).name
+        write_records(records, sample)
+        samples.append(str(sample))
+
+    return samples
+# ---
+
+def fit_line(x: List[float], y: List[float]) -> Tuple[float, float]:
+    """The intercept and slope of the least squares line of y over x.
+
+    With a single value of x, or a negative intercept, the line goes through
+    the origin instead. With a negative slope (the size doesn't matter, only
+    noise), it is flat at the mean of y.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    if len(np.unique(x)) > 1:
+        slope, intercept = np.polyfit(x, y, 1)
+        if slope < 0:
+            return float(y.mean()), 0.0
+        if intercept >= 0:
+            return float(intercept), float(slope)
+
+    return 0.0, float(y.sum() / max(x.sum(), 1))
+# ---
+
+def output_bytes(command: str) -> int:
+    """The size of the output files of the command."""
+    _, outputs = files_of(command)
+    return sum(Path(f).stat().st_size for f in outputs if Path(f).exists())
+# ---
+
+def calibrate_stage(records: List[dict],
+                    n_tasks: int,
+                    stage_bytes: float,
+                    largest_input: float) -> Dict[str, float]:
+    """Extrapolate the resources used by the pilot tasks of a stage to the full run.
+
+    Input:
+        records: The accounting of the pilot tasks (see 'read_accounting' in `jobs.py`).
+        n_tasks: The number of commands of the stage in the full run.
+        stage_bytes: The size of the input of the stage in the full run.
+        largest_input: The size of the input of its largest command.
+    Output: The extrapolated resources of the stage, and the model of its
+            memory used by 'predict_resources' (see `jobs.py`).
+    """
+    sizes = [r['input_bytes'] for r in records]
+    cpu_fixed, cpu_per_byte = fit_line(sizes, [r['user_time'] + r['sys_time'] for r in records])
+    wall_fixed, wall_per_byte = fit_line(sizes, [r['wall_time'] for r in records])
+    baseline, per_byte = fit_line(sizes, [r['max_rss_mb'] for r in records])
+    output_ratio = sum(output_bytes(r['command']) for r in records) / max(sum(sizes), 1)
+
+    task_minutes = (wall_fixed + wall_per_byte * largest_input) / 60
+
+    return {'tasks': n_tasks,
+            'input_gb': round(stage_bytes / 1024**3, 2),
+            'cpu_hours': round((n_tasks * cpu_fixed + cpu_per_byte * stage_bytes) / 3600, 2),
+            'max_task_hours': round(task_minutes / 60, 2),
+            'output_gb': round(output_ratio * stage_bytes / 1024**3, 2),
+            'ram': memory_request(baseline, per_byte, largest_input),
+            'cores': used_cores(records),
+            'throughput': round(largest_input / 1024**2 / max(task_minutes, 1e-3), 1),
+            'baseline_mb': round(baseline, 1),
+            'mb_per_byte': per_byte,
+            'largest_input_bytes': int(largest_input)}
+# ---
+
+def calibrate(stage_tasks: Dict[str, int],
+              pilot_bytes: int,
+              full_bytes: int,
+              largest_chunk: int,
+              n_chunks: int) -> Dict[str, object]:
+    """Extrapolate the pilot run, from the accounting of its stages, to the full run.
+
+    Input:
+        stage_tasks: The number of commands of each stage in the full run,
+                     in order of execution.
+        pilot_bytes: The size of the raw reads of the pilot run.
+        full_bytes: The size of the raw reads of the full run.
+        largest_chunk: The size of the largest raw chunk of the full run.
+        n_chunks: The number of raw chunks of the full run.
+    Output: The resources of each stage (see 'calibrate_stage'), and the
+            CPU-hours, wall time and disk space of the whole run.
+    """
+    stages = dict()
+    for stage, n_tasks in stage_tasks.items():
+        # A command executed again (e.g. after its task was requeued)
+        # counts once, its last successful execution.
+        records = list({r['command']: r for r in read_accounting(stage)}.values())
+        if not records:
+            print(f'WARNING: No successful pilot task of {stage}, it is not calibrated.', flush=True)
+            continue
+
+        # The input of the stage grows as the raw reads, and the commands
+        # of the stage share the raw chunks (e.g. when mapping several at once).
+        stage_bytes = full_bytes * sum(r['input_bytes'] for r in records) / max(pilot_bytes, 1)
+        largest_input = stage_bytes * largest_chunk / max(full_bytes, 1) * n_chunks / n_tasks
+        stages[stage] = calibrate_stage(records, n_tasks, stage_bytes, largest_input)
+
+    return {'stages': stages,
+            'cpu_hours': round(sum(s['cpu_hours'] for s in stages.values()), 2),
+            'wall_hours': round(sum(s['max_task_hours'] for s in stages.values()), 2),
+            'disk_gb': round(sum(s['output_gb'] for s in stages.values()), 2)}
+# ---
@@ -0,0 +1,232 @@
+"""
+Summary table of the FastQC reports.
+====================================
+
+Author: Andrés García García @ Sept 2018
+
+After the quality check, MultiQC was run by hand to gather the reports of
+the (568) FastQC runs, and it parses every report again each time.
+
+Instead, each task of the quality check job array parses the reports it just
+produced ('add_reports') and appends a row for each of them to a table next
+to the reports, 'qc_summary.tsv':
+
+    file    sample    total_sequences    ...    basic_statistics    ...
+    mm1L_ATCACG_L003_R1_001    mm1L    4000000    ...    pass    ...
+
+A report is only parsed again if its ZIP file changed (its size and
+modification time are in the table), and only the last row of each report
+counts, so executing the quality check again for a few files just appends
+their new rows.
+
+After updating the table, the task also rewrites the summary of each sample
+(the chunk files grouped by the 'mmXY' prefix of their names),
+'qc_summary.samples.tsv', with the total number of reads, the mean GC content
+and, for each FastQC module, the worst status and how many chunks failed it.
+So, both tables are ready as soon as the last task of the array finishes.
+
+The tables of a directory with older reports can be made or refreshed with
+`script.qc_summary.py`.
+
+"""
+
+import re
+import csv
+import fcntl
+import zipfile
+from pathlib import Path
+from collections import OrderedDict
+from typing import Union, List, Dict
+
+from tasks import files_of, fingerprint_files
+from fastq import sample_of
+
+
+# The tables, in the directory of the reports
+SUMMARY_FILE = 'qc_summary.tsv'
+SAMPLES_FILE = 'qc_summary.samples.tsv'
+
+# The modules of FastQC, as named in the reports
+MODULES = ['Basic Statistics',
+           'Per base sequence quality',
+           'Per tile sequence quality',
+           'Per sequence quality scores',
+           'Per base sequence content',
+           'Per sequence GC content',
+           'Per base N content',
+           'Sequence Length Distribution',
+           'Sequence Duplication Levels',
+           'Overrepresented sequences',
+           'Adapter Content']
+
+# The statuses of the modules, from the best to the worst
+STATUSES = ['pass', 'warn', 'fail']
+
+# The statistics taken from the 'Basic Statistics' module
+BASIC_STATISTICS = {'Total Sequences': 'total_sequences',
+                    'Sequences flagged as poor quality': 'poor_quality',
+                    'Sequence length': 'sequence_length',
+                    '%GC': 'gc'}
+
+
+def column_name(module: str) -> str:
+    """The column of the table with the status of the module, e.g. 'per_base_n_content'."""
+    return re.sub(r'\W+', '_', module.lower()).strip('_')
+# ---
+
+COLUMNS = (['file', 'sample', 'zip_size', 'zip_mtime']
+           + list(BASIC_STATISTICS.values())
+           + ['deduplicated_percent']
+           + [column_name(module) for module in MODULES])
+
+
+def parse_report(zip_file: Union[str, Path]) -> Dict[str, str]:
+    """Extract the statistics and the status of each module from a FastQC ZIP file.
+
+    Output: A row of the summary table (see COLUMNS).
+    """
+    zip_file = Path(zip_file)
+    name = re.sub(r'_fastqc\.zip$', '', zip_file.name)
+    size, mtime = fingerprint_files([str(zip_file)])[str(zip_file)]
+
+    row = {column: '' for column in COLUMNS}
+    row.update(file=name, sample=sample_of(name), zip_size=size, zip_mtime=mtime)
+
+    with zipfile.ZipFile(zip_file) as archive:
+        data_file = next(member for member in archive.namelist()
+                                    if member.endswith('/fastqc_data.txt'))
+        lines = archive.read(data_file).decode('UTF-8').split('\n')
+
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if line.startswith('>>') and not line.startswith('>>END_MODULE'):
+            module = fields[0][2:]
+            if module in MODULES and len(fields) > 1:
+                row[column_name(module)] = fields[1]
+        elif fields[0] in BASIC_STATISTICS and len(fields) > 1:
+            row[BASIC_STATISTICS[fields[0]]] = fields[1]
+        elif fields[0] == '#Total Deduplicated Percentage' and len(fields) > 1:
+            row['deduplicated_percent'] = fields[1]
+
+    return row
+# ---
+
+def read_summary(summary_file: Union[str, Path]) -> Dict[str, Dict[str, str]]:
+    """Read the summary table.
+
+    Output: The last row of each report.
+    """
+    rows = OrderedDict()
+
+    if Path(summary_file).exists():
+        with open(summary_file) as table:
+            for row in csv.DictReader(table, delimiter='\t'):
+                rows[row['file']] = row
+
+    return rows
+# ---
+
+def rollup(rows: List[Dict[str, str]]) -> List[Dict[str, object]]:
+    """Summarize the rows of the reports by sample.
+
+    Output: A row for each sample, with the number of chunk files, the total
+            number of reads, the mean GC content (weighted by the reads) and,
+            for each module, the worst status and the number of failed chunks.
+    """
+    samples = OrderedDict()
+    for row in rows:
+        samples.setdefault(row['sample'], []).append(row)
+
+    summaries = []
+    for sample, sample_rows in sorted(samples.items()):
+        reads = [int(row['total_sequences'] or 0) for row in sample_rows]
+        gc = [float(row['gc'] or 0) for row in sample_rows]
+
+        summary = OrderedDict(sample=sample,
+                              files=len(sample_rows),
+                              total_sequences=sum(reads),
+                              gc=round(sum(r*g for r,g in zip(reads, gc)) / max(sum(reads), 1), 2))
+
+        for module in MODULES:
+            column = column_name(module)
+            statuses = [row[column] for row in sample_rows if row[column] in STATUSES]
+            summary[column] = max(statuses, key=STATUSES.index) if statuses else ''
+            summary[column + '_failed'] = statuses.count('fail')
+
+        summaries.append(summary)
+
+    return summaries
+# ---
+
+def write_table(rows: List[Dict[str, object]], file: Union[str, Path]):
+    """Write the rows as a tab separated table, through a temporary file."""
+    if not rows:
+        return
+
+    temporary = Path(f'{file}.tmp')
+    with open(temporary, 'w', newline='') as table:
+        writer = csv.DictWriter(table, fieldnames=list(rows[0]), delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+    temporary.replace(file)
+# ---
+
+def update_summary(report_dir: Union[str, Path], zip_files: List[str]) -> List[Dict[str, str]]:
+    """Add the reports to the summary table of the directory, and rewrite the
+    summary of the samples.
+
+    Output: The rows added to the table.
+
+    Only the reports that are new or changed since they were added are parsed.
+    Many tasks may finish at the same time, so the table is locked meanwhile.
+    """
+    report_dir = Path(report_dir)
+    summary_file = report_dir / SUMMARY_FILE
+
+    with open(report_dir / f'.{SUMMARY_FILE}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        rows = read_summary(summary_file)
+
+        new_rows = []
+        for zip_file in zip_files:
+            name = re.sub(r'_fastqc\.zip$', '', Path(zip_file).name)
+            size, mtime = fingerprint_files([zip_file])[zip_file] or (None, None)
+            known = rows.get(name)
+            if known and [known['zip_size'], known['zip_mtime']] == [str(size), str(mtime)]:
+                continue
+
+            try:
+                row = parse_report(zip_file)
+            except (zipfile.BadZipFile, StopIteration, TypeError) as error:
+                print(f'WARNING: Could not parse the FastQC report {zip_file}: {error!r}', flush=True)
+                continue
+            rows[name] = row
+            new_rows.append(row)
+
+        if new_rows:
+            new_table = not summary_file.exists()
+            with open(summary_file, 'a', newline='') as table:
+                writer = csv.DictWriter(table, fieldnames=COLUMNS, delimiter='\t')
+                if new_table:
+                    writer.writeheader()
+                writer.writerows(new_rows)
+
+        write_table(rollup(list(rows.values())), report_dir / SAMPLES_FILE)
+
+    return new_rows
+# ---
+
+def add_reports(commands: List[str]):
+    """Add the reports made by the FastQC commands to the summary tables."""
+    zip_files = [output for command in commands
+                            for output in files_of(command)[1]
+                                if output.endswith('_fastqc.zip') and Path(output).exists()]
+
+    report_dirs = OrderedDict()
+    for zip_file in zip_files:
+        report_dirs.setdefault(str(Path(zip_file).parent), []).append(zip_file)
+
+    for report_dir, dir_zip_files in report_dirs.items():
+        update_summary(report_dir, dir_zip_files)
+# ---
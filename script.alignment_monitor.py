@@ -0,0 +1,99 @@
+#! /bin/env python3
+
+"""
+Aborting the mapping of a chunk whose first reads don't align.
+===============================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+Passes the SAM records of HISAT2 through, and aborts if the alignment rate
+of the first reads is below a minimum (see `alignment_monitor.py`):
+
+    hisat2 --dta -x <index> -1 <input 1> -2 <input 2> \\
+        | script.alignment_monitor.py -m <minimum %> [-n <reads>] \\
+        | samtools sort -o <output.bam> -
+
+`script.rnaseq_map.py --min_alignment_rate` puts it after HISAT2. When it
+aborts, the command exits with code ABORTED_EXIT_CODE, which `tasks.py`
+reports as an aborted task, not to be executed again as it is.
+
+The records are written to the standard output by default, and the reports
+to the standard error.
+
+"""
+
+import sys
+import click
+
+from alignment_monitor import monitor_alignments, CHECK_READS, MIN_ALIGNMENT_RATE, VERSION
+from tasks import ABORTED_EXIT_CODE
+from fastq import open_binary
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--output', '-o',
+              help='Where to write the SAM records. Default: The standard output.')
+
+@click.option('--min_rate', '-m',
+              help=f'The minimum alignment rate (in %) of the first reads.'
+                   f' Default {100 * MIN_ALIGNMENT_RATE:g}.')
+
+@click.option('--check_reads', '-n',
+              help=f'How many reads are checked. Default {CHECK_READS}.')
+
+@click.option('--version', is_flag=True,
+              help='Print the version and exit.')
+
+def main(output, min_rate, check_reads, version):
+    """Copy the SAM records of the standard input, checking the alignment rate of the first reads."""
+
+    if version:
+        print(VERSION)
+        return
+
+    output = output if output else '-'
+    min_rate = float(min_rate) / 100 if min_rate else MIN_ALIGNMENT_RATE
+    check_reads = int(check_reads) if check_reads else CHECK_READS
+
+    print( 'Resolved parameters: \n'
+          f'    Output file: {output}\n'
+          f'    Minimum alignment rate: {100 * min_rate:g}%\n'
+          f'    Reads checked: {check_reads}', file=sys.stderr)
+
+
+    # 1. --- Copy the records, checking the first ones.
+    with open_binary('-', 'rb') as sam_in, open_binary(output, 'wb') as sam_out:
+        counts = monitor_alignments(sam_in, sam_out, min_rate, check_reads)
+
+    message = (f'{counts["aligned"]} of the first {counts["reads"]} reads aligned'
+               f' ({100 * counts["rate"]:.2f}%, minimum {100 * min_rate:g}%)')
+
+
+    # 2. --- Abort if they don't align.
+    if not counts['passed']:
+        print(f'ERROR: {message}. Aborting the mapping.', file=sys.stderr, flush=True)
+        sys.exit(ABORTED_EXIT_CODE)
+
+    print(f'{message}.', file=sys.stderr)
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
@@ -0,0 +1,133 @@
+#! /bin/env python3
+
+"""
+Collapsing the duplicate reads before mapping them.
+===================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+Collapses the reads (or pairs) of a chunk with the same sequence into one,
+with the number of copies in its name (see `collapse.py`), so that HISAT2
+maps each sequence only once. Then, the number of copies is moved from the
+names to a tag of the alignments:
+
+    script.collapse.py [-o <output>] <input>
+    script.collapse.py [-o <output 1> -o <output 2>] <input 1> <input 2>
+    script.collapse.py --tag [-o <SAM file>]
+
+The inputs may be lists of files separated by commas (as HISAT2 takes them),
+or '-' for the standard input (interleaved pairs with --interleaved). The
+outputs are the standard output by default (interleaved, for pairs). With
+--tag, the SAM records are read from the standard input.
+
+`script.rnaseq_map.py --collapse` pipes them around HISAT2:
+
+    script.collapse.py -o - <input 1> <input 2> \\
+        | hisat2 --dta -x <index> --interleaved - \\
+        | script.collapse.py --tag | samtools sort -o <output.bam> -
+
+The reports are written to the standard error, to keep the standard output
+for the reads.
+
+"""
+
+import sys
+import click
+
+from collapse import read_pairs, keyed_reads, collapse_reads, tag_counts, COUNT_TAG, MAX_TABLE_BYTES, VERSION
+from fastq import open_binary, read_interleaved
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.argument('inputs', nargs=-1)
+
+@click.option('--output', '-o', multiple=True,
+              help='Where to write the unique reads, once for each input file'
+                   ' (or once, to interleave the pairs). With --tag, the SAM'
+                   ' file. Default: The standard output.')
+
+@click.option('--interleaved', '-I', is_flag=True,
+              help='The pairs of the standard input are interleaved.')
+
+@click.option('--tag', '-t', is_flag=True,
+              help=f'Read SAM records from the standard input, and move the'
+                   f' number of copies from the names to the {COUNT_TAG} tag.')
+
+@click.option('--max_memory', '-M',
+              help=f'The size of the table of unique reads (in Gb) above which'
+                   f' it is spilled to disk. Default {MAX_TABLE_BYTES / 1024**3:g}.')
+
+@click.option('--spill_dir', '-T',
+              help='Where to spill the table. Default: $TMPDIR.')
+
+@click.option('--version', is_flag=True,
+              help='Print the version and exit.')
+
+def main(inputs, output, interleaved, tag, max_memory, spill_dir, version):
+    """Collapse the duplicate reads, or tag the alignments of collapsed reads."""
+
+    if version:
+        print(VERSION)
+        return
+
+    inputs = list(inputs) if inputs else ['-']
+    outputs = list(output) if output else ['-']
+    max_table_bytes = int(float(max_memory) * 1024**3) if max_memory else MAX_TABLE_BYTES
+
+    print( 'Resolved parameters: \n'
+          f'    Input files: {" ".join(inputs)}\n'
+          f'    Output files: {" ".join(outputs)}\n'
+          f'    Interleaved input: {interleaved}\n'
+          f'    Tag the alignments: {tag}\n'
+          f'    Maximum table size: {max_table_bytes / 1024**3:g}G\n'
+          f'    Spill directory: {spill_dir}', file=sys.stderr)
+
+
+    # 1. --- Tag the alignments ...
+    if tag:
+        with open_binary('-', 'rb') as sam_in, open_binary(outputs[0], 'wb') as sam_out:
+            counts = tag_counts(sam_in, sam_out)
+        print(f'Tagged {counts["alignments"]} alignments'
+              f' ({counts["copies"]} counting the copies).', file=sys.stderr)
+        return
+
+
+    # 2. --- ... or collapse the reads.
+    if inputs == ['-']:
+        stdin = open_binary('-', 'rb')
+        reads = keyed_reads(read_interleaved(stdin, 2 if interleaved else 1))
+    else:
+        reads = read_pairs(inputs)
+
+    output_files = [open_binary(path, 'wb') for path in outputs]
+    try:
+        counts = collapse_reads(reads, output_files, max_table_bytes, spill_dir)
+    finally:
+        for output_file in output_files:
+            output_file.close()
+
+    print(f'Collapsed {counts["reads"]} reads into {counts["unique"]} unique'
+          f' ({100 * counts["unique"] / max(counts["reads"], 1):.2f}%),'
+          f' spilling the table {counts["spills"]} times.', file=sys.stderr)
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
@@ -0,0 +1,145 @@
+#! /bin/env python3
+
+"""
+Duplication of the reads of each sample, across all of its chunks.
+==================================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+FastQC reports the duplication of each chunk file (`mm1L_..._R1_001.fastq`,
+`_002`, ...) from its first reads, but a read may be repeated in many chunks
+of the same sample. Here every read of every chunk is summarized in a sketch
+of fixed size (see `sketches.py`), several files at the same time (one per
+process), and the sketches of the chunks of each sample and mate (R1, R2) are
+merged. The report has, for each sample and mate, the estimated fraction of
+distinct reads and the most duplicated sequences:
+
+    {"samples": {"mm1L_R1": {"files": 40,
+                             "reads": 160000000,
+                             "distinct_reads": 52000000,
+                             "distinct_fraction": 0.325,
+                             "duplicated_sequences": [{"sequence": ...,
+                                                       "copies": ...,
+                                                       "fraction": ...}, ...]},
+                 ...}}
+
+The memory used by each process doesn't depend on the number of reads, so it
+can be run on the full dataset. To do it in a node of the cluster, submit
+this script itself, e.g.:
+    qsub -cwd -V -pe openmp 8 -b y python3 script.duplication.py -j 8
+
+"""
+
+import json
+import click
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from fastq import CHUNK_READS, group_of
+from sketches import file_sketch, merge_sketches, summarize_sketch
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--input_dir', '-i',
+              help='The directory where the input files reside.'
+                   ' Default: "./raw_data".')
+
+@click.option('--file_glob', '-f',
+              help='A glob expression specifying the files to'
+                   ' analize from the input directory.'
+                   ' Default: "*.fastq".')
+
+@click.option('--output_file', '-o',
+              help='The JSON file where to write the report.'
+                   ' Default: "./duplication.json".')
+
+@click.option('--processes', '-j',
+              help='How many files are processed at the same time.'
+                   ' Default: The number of cores of the machine.')
+
+@click.option('--top', '-t',
+              help='How many of the most duplicated sequences to report'
+                   ' for each sample. Default 20.')
+
+@click.option('--chunk_reads', '-n',
+              help=f'How many reads are processed at once. Default {CHUNK_READS}.')
+
+def main(input_dir, file_glob, output_file, processes, top, chunk_reads):
+    """Estimate the duplication of the reads of each sample and write it to a JSON report."""
+
+    input_dir = Path(input_dir
+                         if input_dir
+                         else './raw_data').resolve()
+    file_glob = (file_glob
+                    if file_glob
+                    else '*.fastq')
+    output_file = Path(output_file
+                           if output_file
+                           else './duplication.json').resolve()
+    processes = int(processes) if processes else cpu_count()
+    top = int(top) if top else 20
+    chunk_reads = int(chunk_reads) if chunk_reads else CHUNK_READS
+
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    File glob: {file_glob}\n'
+          f'    Output file: {output_file}\n'
+          f'    Processes: {processes}\n'
+          f'    Duplicated sequences per sample: {top}\n'
+          f'    Reads per chunk: {chunk_reads}')
+
+
+    # 1. --- Search the files.
+    files = sorted(str(file) for file in input_dir.glob(file_glob))
+
+
+    # 2. --- Sketch each file, several at the same time,
+    #        and merge the sketches of each sample as they are done.
+    sketches = dict()
+
+    with Pool(processes) as pool:
+        all_sketches = pool.imap(partial(file_sketch, chunk_reads=chunk_reads), files)
+
+        for file, sketch in zip(files, all_sketches):
+            group = group_of(Path(file).name)
+            print(f'{file}: {sketch["reads"]} reads.', flush=True)
+
+            files_count, merged = sketches.get(group, (0, None))
+            sketches[group] = (files_count + 1,
+                               merge_sketches(merged, sketch) if merged else sketch)
+
+
+    # 3. --- Write the report.
+    report = {'samples': {group: {'files': files_count, **summarize_sketch(sketch, top)}
+                              for group, (files_count, sketch) in sorted(sketches.items())}}
+
+    with open(output_file, 'w') as outf:
+        json.dump(report, outf, indent=1)
+
+    for group, summary in report['samples'].items():
+        print(f'{group}: {summary["reads"]} reads,'
+              f' {100 * summary["distinct_fraction"]:.2f}% distinct.')
+    print(f'Report written to {output_file}')
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
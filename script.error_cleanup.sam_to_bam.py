@@ -28,6 +28,11 @@ import subprocess
 #NOTE: The script may need to be 
 #      customized to adapt to the 
 #      specific files you want to target.
+#
+#NOTE: The current job scripts write their outputs to a temporary
+#      directory and move them to their place only when the command
+#      succeeds (see `tasks.py`), so they never leave incomplete files.
+#      This script is only needed for outputs of older job scripts.
 
 def run(command, **kwargs):
     """Execute a command through the shell. Doesn't capture output."""
@@ -0,0 +1,129 @@
+#! /bin/env python3
+
+"""
+Quality check of all the FASTQ files in a single pass.
+======================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+An alternative to the quality check with FastQC (`script.quality_check.py`).
+FastQC starts a Java virtual machine for each one of the (568) FASTQ files,
+and MultiQC is then needed to gather the reports.
+
+Here the statistics of every file are computed with NumPy (see `fastq.py`),
+several files at the same time (one per process), and written to a single
+JSON report with the statistics of each file and of all of them together:
+
+    {"files": {"<file name>": {<statistics>}, ...},
+     "total": {<statistics>}}
+
+The reading is done in chunks, so the memory used by each process doesn't
+depend on the size of the files. Only the overrepresented sequences of each
+file are kept, so their counts in the statistics of all the files together
+are lower bounds ("overrepresented_lower_bounds", see 'file_stats').
+
+The statistics are computed in the current machine. To do it in a node of the
+cluster, submit this script itself, e.g.:
+    qsub -cwd -V -pe openmp 8 -b y python3 script.fastq_stats.py -j 8
+
+"""
+
+import json
+import click
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from fastq import file_stats, merge_stats, summarize, new_stats, CHUNK_READS
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--input_dir', '-i',
+              help='The directory where the input files reside.'
+                   ' Default: "./raw_data".')
+
+@click.option('--file_glob', '-f',
+              help='A glob expression specifying the files to'
+                   ' analize from the input directory.'
+                   ' Default: "*.fastq".')
+
+@click.option('--output_file', '-o',
+              help='The JSON file where to write the report.'
+                   ' Default: "./fastq_stats.json".')
+
+@click.option('--processes', '-j',
+              help='How many files are processed at the same time.'
+                   ' Default: The number of cores of the machine.')
+
+@click.option('--chunk_reads', '-n',
+              help=f'How many reads are processed at once. Default {CHUNK_READS}.')
+
+def main(input_dir, file_glob, output_file, processes, chunk_reads):
+    """Compute the statistics of the FASTQ files and write them to a JSON report."""
+
+    input_dir = Path(input_dir
+                         if input_dir
+                         else './raw_data').resolve()
+    file_glob = (file_glob
+                    if file_glob
+                    else '*.fastq')
+    output_file = Path(output_file
+                           if output_file
+                           else './fastq_stats.json').resolve()
+    processes = int(processes) if processes else cpu_count()
+    chunk_reads = int(chunk_reads) if chunk_reads else CHUNK_READS
+
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    File glob: {file_glob}\n'
+          f'    Output file: {output_file}\n'
+          f'    Processes: {processes}\n'
+          f'    Reads per chunk: {chunk_reads}')
+
+
+    # 1. --- Search the files.
+    files = sorted(str(file) for file in input_dir.glob(file_glob))
+
+
+    # 2. --- Compute the statistics of each file, several at the same time.
+    report = {'files': dict()}
+    total = new_stats()
+
+    with Pool(processes) as pool:
+        all_stats = pool.imap(partial(file_stats, chunk_reads=chunk_reads), files)
+
+        for file, stats in zip(files, all_stats):
+            print(f'{file}: {stats["reads"]} reads.', flush=True)
+            report['files'][Path(file).name] = summarize(stats)
+            total = merge_stats(total, stats)
+
+    report['total'] = summarize(total)
+
+
+    # 3. --- Write the report.
+    with open(output_file, 'w') as outf:
+        json.dump(report, outf, indent=1)
+
+    print(f'Report written to {output_file}')
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
@@ -0,0 +1,121 @@
+#! /bin/env python3
+
+"""
+Filtering out the contaminant reads before mapping them.
+========================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+Splits the reads (or pairs) of a chunk between the ones sharing k-mers with
+the sequences of a FASTA file of contaminants (e.g. the ribosomal RNA), which
+are written to a side file, and the rest (see `kmer_filter.py`):
+
+    script.kmer_filter.py -c <contaminants.fa> [-s <side file>] [-o <output>] <input>
+    script.kmer_filter.py -c <contaminants.fa> [-s <side file>] [-o <output>] <input 1> <input 2>
+
+The inputs may be '-' for the standard input (interleaved pairs with
+--interleaved), and the output is the standard output by default. The pairs
+are written interleaved, so that `script.rnaseq_map.py --contaminants`
+pipes them into HISAT2:
+
+    script.kmer_filter.py -c <contaminants.fa> -s <chunk>.contaminants.fastq -o - <input 1> <input 2> \\
+        | hisat2 --dta -x <index> --interleaved - | ...
+
+The reports are written to the standard error, to keep the standard output
+for the reads.
+
+"""
+
+import os
+import sys
+import click
+
+from kmer_filter import load_index, filter_reads, K, MIN_HITS, VERSION
+from fastq import open_binary, read_mates, read_interleaved
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.argument('inputs', nargs=-1)
+
+@click.option('--contaminants', '-c',
+              help='The FASTA file with the sequences of the contaminants.'
+                   ' Default: "./index/contaminants.fa".')
+
+@click.option('--output', '-o',
+              help='Where to write the reads that are not contaminants.'
+                   ' Default: The standard output.')
+
+@click.option('--side_file', '-s',
+              help='Where to write the contaminant reads. Default: Nowhere.')
+
+@click.option('--interleaved', '-I', is_flag=True,
+              help='The pairs of the standard input are interleaved.')
+
+@click.option('--min_hits', '-m',
+              help=f'The k-mers of a read (or pair) found in the contaminants'
+                   f' to filter it out. Default {MIN_HITS}.')
+
+@click.option('--version', is_flag=True,
+              help='Print the version and exit.')
+
+def main(inputs, contaminants, output, side_file, interleaved, min_hits, version):
+    """Write the reads that are not contaminants to the output."""
+
+    if version:
+        print(VERSION)
+        return
+
+    inputs = list(inputs) if inputs else ['-']
+    contaminants = contaminants if contaminants else './index/contaminants.fa'
+    output = output if output else '-'
+    side_file = side_file if side_file else os.devnull
+    min_hits = int(min_hits) if min_hits else MIN_HITS
+
+    print( 'Resolved parameters: \n'
+          f'    Input files: {" ".join(inputs)}\n'
+          f'    Contaminants: {contaminants}\n'
+          f'    Output file: {output}\n'
+          f'    Side file: {side_file}\n'
+          f'    Interleaved input: {interleaved}\n'
+          f'    Minimum hits: {min_hits}', file=sys.stderr)
+
+
+    # 1. --- Load the k-mers of the contaminants.
+    index = load_index(contaminants)
+
+
+    # 2. --- Split the reads.
+    if inputs == ['-']:
+        chunks = read_interleaved(open_binary('-', 'rb'), 2 if interleaved else 1)
+    else:
+        chunks = read_mates(inputs)
+
+    with open_binary(output, 'wb') as output_file, open_binary(side_file, 'wb') as side:
+        counts = filter_reads(chunks, index, output_file, side, min_hits)
+
+    print(f'Filtered out {counts["contaminants"]} of {counts["reads"]} reads'
+          f' ({100 * counts["contaminants"] / max(counts["reads"], 1):.2f}%)'
+          f' sharing at least {min_hits} of the {len(index["kmers"])} {K}-mers of the contaminants.',
+          file=sys.stderr)
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
@@ -0,0 +1,565 @@
+#! /bin/env python3
+
+"""
+Running the trimming, mapping and sorting stages together.
+==========================================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+The trimming (`script.trimming.py`), mapping (`script.rnaseq_map.py`) and
+conversion to BAM (`script.sam_to_bam.py`) stages are usually launched by hand
+one after another, so the mapping of the first chunk can't start until the
+trimming of all the chunks has finished.
+
+But every trimming command produces the input of exactly one mapping command,
+and every mapping command produces the input of exactly one sorting command.
+So, here we assemble the commands of the three stages in the same order, such
+that the N-th task of each job array works on the same chunk, and submit all
+of the job arrays at once. Each task waits only for the task with the same id
+in the previous job array (SGE array task dependencies, 'qsub -hold_jid_ad').
+In this way, the chunk N moves to the next stage as soon as it is done with
+the previous one, and the stages overlap.
+
+With the `--sort` flag the mapping and sorting are fused into a single stage
+(see `script.rnaseq_map.py`).
+
+The commands can also be grouped in batches, each one executed by a single
+task (see `jobs.py`). The batches are made from the trimming commands and
+the same grouping is used for all the stages, so that the tasks still match.
+
+With `--group_by sample` all the chunks of a sample are mapped by a single
+HISAT2 run (see `script.rnaseq_map.py`). Then, the N-th trimming task trims all
+the chunks that the N-th mapping task maps.
+
+With `--executor local` the same is done in the current machine, running the
+tasks of all the stages for the same chunk one after the other.
+
+With `--collapse` the duplicate reads of each chunk are mapped only once (see
+`script.rnaseq_map.py`).
+
+With `--contaminants` the reads of the contaminants (e.g. ribosomal RNA) are
+not mapped (see `script.rnaseq_map.py`).
+
+With `--min_alignment_rate` the mapping of a chunk whose first reads don't
+align is aborted, and the next stages are not run for it (see
+`script.rnaseq_map.py`). Locally, its chain stops there. In SGE, its task
+exits with code 100, so it is left in the error state and the tasks of the
+next stages for the chunk stay on hold, until it is cleared ('qmod -cj') or
+deleted ('qdel') (see `tasks.py`). A pilot run waits for them too.
+
+With `--fused` the three stages become a single one: each task trims its
+chunk with `script.trim.py` and streams the reads straight into HISAT2 and
+`samtools sort`, so the trimmed FASTQ and the SAM files are never written.
+Only the sorted BAM file is kept, with the summaries of the trimming and of
+the mapping next to it ('<chunk>.trimming.txt' and '<chunk>.hisat2.txt').
+The pairs are streamed interleaved (HISAT2 '--interleaved -'), so the
+unpaired reads left by the trimming are dropped, as when mapping the paired
+trimmed files. This implies the NumPy trimming engine (Trimmomatic can't
+write the pairs to the standard output), sorting, and mapping chunk by chunk;
+--skip_clean is ignored, as there are no trimmed files to spare.
+
+With `--pilot N` the stages are first run on a random sample of the reads of
+a few chunks (N reads at most, `--pilot_chunks` chunks), in the directory
+'pilot', with a quality check of the same chunks (`script.quality_check.py`)
+before the trimming. From the resources they use, the CPU-hours, wall time,
+disk space and the RAM and cores of each stage are extrapolated to the full
+run, and written to 'pilot.json', which the scripts use with
+`--auto_resources` (see `pilot.py`). The full run is not submitted: once the
+numbers look right, run this script again without `--pilot`.
+
+"""
+
+import os
+import re
+import json
+import time
+import click
+from pathlib import Path
+from typing import List
+
+from jobs import load_script, qsub, run_local_chain, batch_commands, predict_resources, PILOT_FILE
+from tasks import files_of, reads_of, accounting_file, STALL_MINUTES
+from pilot import representative_chunks, sample_chunk, chunk_bytes, calibrate, PILOT_CHUNKS
+from kmer_filter import load_index
+from alignment_monitor import CHECK_READS
+from trim import parse_arguments, CLEAN_ADAPTER_RATE, CLEAN_LOW_QUALITY_RATE
+
+
+#### <<<<<< FUSED STAGES >>>>>>> ####
+
+def fuse_commands(trimming_commands: List[str],
+                  mapping_commands: List[str],
+                  n_cores: int = 1) -> List[str]:
+    """Pipe each trimming command into the mapping command of the same chunk.
+
+    Input:
+        trimming_commands: The `script.trim.py` commands.
+        mapping_commands: The mapping commands sorting into BAM files, the
+                          N-th one mapping the output of the N-th trimming.
+        n_cores: The cores of each fused command, shared by its programs:
+                 the trimming uses one, HISAT2 the rest (at least one), and
+                 'samtools sort' one more thread, as it mostly waits for the
+                 alignments until HISAT2 is done.
+    Output: The fused commands, e.g. for pairs:
+        script.trim.py PE -threads 1 -summary <chunk>.trimming.txt <input 1> <input 2> - <steps> \\
+            | hisat2 -p <n_cores - 1> --dta --new-summary --summary-file <chunk>.hisat2.txt -x <index> --interleaved - \\
+            | samtools sort -@ 1 -o <chunk>.bam -
+    For single reads HISAT2 reads '-U -' instead. When filtering the
+    contaminants or collapsing the duplicate reads, the first of those
+    programs reads the trimmed reads instead.
+    """
+    hisat2_threads = max(int(n_cores) - 1, 1)
+    fused = []
+
+    for trimming_command, mapping_command in zip(trimming_commands, mapping_commands):
+        program, *args = trimming_command.split()
+        mode, _, _, _, outputs, _, _ = parse_arguments(args)
+
+        mapping = [part.split() for part in mapping_command.split('|')]
+        sorting = mapping[-1]
+        chunk = re.sub(r'\.bam$', '', sorting[sorting.index('-o') + 1])
+
+        # The output files are replaced by the standard output
+        first = args.index(outputs[0])
+        trim_args = ([mode, '-summary', f'{chunk}.trimming.txt']
+                     + args[1:first] + ['-'] + args[first + len(outputs):])
+        if '-threads' in trim_args:
+            trim_args[trim_args.index('-threads') + 1] = '1'
+
+        # ... and the input files of the next program by the standard input
+        first_reads = reads_of(' '.join(mapping[0]))
+        if Path(mapping[0][0]).name != 'hisat2':
+            mapping[0] = ([arg for arg in mapping[0] if arg not in first_reads]
+                          + (['--interleaved'] if mode == 'PE' else []) + ['-'])
+
+        for part in mapping:
+            if Path(part[0]).name == 'hisat2':
+                x = part.index('-x')
+                part[x:x+2] = (['--new-summary', '--summary-file', f'{chunk}.hisat2.txt']
+                               + part[x:x+2])
+                if part[-1] != '-':
+                    part[x+5:] = ['-U', '-'] if mode == 'SE' else ['--interleaved', '-']
+                part[part.index('-p') + 1] = str(hisat2_threads)
+            elif Path(part[0]).name == 'samtools' and '-@' in part:
+                part[part.index('-@') + 1] = '1'
+
+        fused.append(' | '.join([' '.join([program] + trim_args)]
+                                + [' '.join(part) for part in mapping]))
+
+    return fused
+# ---
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--input_dir', '-i',
+              help='The directory where the raw FASTQ files reside.'
+                   ' Default: "./raw_data".')
+
+@click.option('--trimmed_dir', '-t',
+              help='The directory where to output the trimmed files.'
+                   ' Default: "./trimmed".')
+
+@click.option('--mapped_dir', '-o',
+              help='The directory where to output the mapped files.'
+                   ' Default: "./mapped".')
+
+@click.option('--adapters_file', '-a',
+              help='The FASTA file specifying the adapters to trimm.'
+                   ' Default: A file "all_adapters.fa" in the input folder.')
+
+@click.option('--detect_adapters', '-D', is_flag=True,
+              help='Find the adapters present in each sample, and trim only'
+                   ' those (see `script.trimming.py`).')
+
+@click.option('--skip_clean', '-S', is_flag=True,
+              help='Don\'t trim the chunks with few adapters and low quality'
+                   ' ends (see `script.trimming.py`).')
+
+@click.option('--trim_engine', '-E', type=click.Choice(['trimmomatic', 'numpy']),
+              help='The program that trims the reads (see `script.trimming.py`).'
+                   ' Default "trimmomatic".')
+
+@click.option('--idx_prefix', '-p',
+              help='The prefix of the genome index files.'
+                   ' Default "./index/grcm38_snp_tran/genome_snp_tran".')
+
+@click.option('--sort', '-s', is_flag=True,
+              help='Pipe the mapping directly into "samtools sort" instead'
+                   ' of running a separate SAM to BAM stage.')
+
+@click.option('--cores', '-c',
+              help='The number of cores to use per process (only used by'
+                   ' "samtools sort", and by HISAT2 with --fused). Default 1.')
+
+@click.option('--collapse', '-C', is_flag=True,
+              help='Collapse the duplicate reads of each chunk before mapping'
+                   ' (see `script.rnaseq_map.py`).')
+
+@click.option('--contaminants', '-K',
+              help='A FASTA file with the sequences of the contaminants (e.g.'
+                   ' the ribosomal RNA), whose reads are not mapped (see'
+                   ' `script.rnaseq_map.py`). Default: Map every read.')
+
+@click.option('--min_alignment_rate', '-R',
+              help='Abort the mapping of a chunk if the alignment rate (in %)'
+                   ' of its first reads is lower (see `script.rnaseq_map.py`).'
+                   ' Default: Map every chunk to the end.')
+
+@click.option('--check_reads', '-N',
+              help='How many reads are checked with --min_alignment_rate.'
+                   f' Default {CHECK_READS}.')
+
+@click.option('--group_by', '-g',
+              help='How to group the chunks of paired files mapped by each'
+                   ' HISAT2 run: "chunk", "sample" or a number of chunks (see'
+                   ' `script.rnaseq_map.py`). When grouping, each trimming task'
+                   ' trims the chunks of a group, and --batch_size and'
+                   ' --target_task_minutes are ignored. Default "chunk".')
+
+@click.option('--index_cache', '-k',
+              help='A directory in the local disk (or tmpfs) of the nodes where'
+                   ' to keep a copy of the genome index (see `index_cache.py`).'
+                   ' Default: No copy.')
+
+@click.option('--prewarm', '-P', is_flag=True,
+              help='Read the genome index into the page cache of the node'
+                   ' before mapping.')
+
+@click.option('--ram', '-r',
+              help='RAM amount per job (in Gb). Default 8.')
+
+@click.option('--batch_size', '-b',
+              help='The number of chunks processed by each task. Default 1.')
+
+@click.option('--target_task_minutes', '-m',
+              help='Group the chunks so that each trimming task takes about this'
+                   ' many minutes (estimated from the size of the input files).'
+                   ' Overrides --batch_size.')
+
+@click.option('--batch_concurrency', '-j',
+              help='How many of the chunks of a task are processed at the'
+                   ' same time. Default 1.')
+
+@click.option('--auto_resources', '-A', is_flag=True,
+              help='Predict the RAM and cores of each stage from its previous'
+                   ' runs (see `jobs.py`). Every task of a stage gets the'
+                   ' largest prediction, so that the tasks of all the stages'
+                   ' still match. Overrides --ram.')
+
+@click.option('--stall_minutes', '-w',
+              help='Kill a command when neither its output files nor its CPU'
+                   ' time grow in this many minutes, and execute its task'
+                   ' again (see `tasks.py`). Default 60.')
+
+@click.option('--scratch', '-T', is_flag=True,
+              help='Copy the input files to the local scratch directory of'
+                   ' the node ($TMPDIR), execute the commands there and move'
+                   ' the outputs back (see `tasks.py`).')
+
+@click.option('--fused', '-F', is_flag=True,
+              help='Trim, map and sort each chunk in a single task, streaming'
+                   ' the reads from one program to the next, and keep only the'
+                   ' BAM file and the summaries. Implies --trim_engine numpy,'
+                   ' --sort and --group_by chunk.')
+
+@click.option('--pilot', '-n',
+              help='Run the stages on at most this many reads of a few chunks'
+                   ' only, and extrapolate the resources they need in the full'
+                   ' run to "pilot.json" (see `pilot.py`).')
+
+@click.option('--pilot_chunks', '-u',
+              help=f'The chunks sampled by --pilot. Default {PILOT_CHUNKS}.')
+
+@click.option('--executor', '-e', type=click.Choice(['sge', 'local']),
+              help='Where to run the tasks: submit them to the SGE queue (qsub)'
+                   ' or run them in a pool of processes in the current machine.'
+                   ' Default "sge".')
+
+def main(input_dir, trimmed_dir, mapped_dir,
+         adapters_file, detect_adapters, skip_clean, trim_engine,
+         idx_prefix, sort, group_by, collapse, contaminants, min_alignment_rate, check_reads,
+         index_cache, prewarm,
+         cores, ram, auto_resources,
+         batch_size, target_task_minutes, batch_concurrency,
+         stall_minutes, scratch, fused, pilot, pilot_chunks, executor):
+    """Assemble the scripts for trimming, mapping and sorting and submit them chained."""
+
+    input_dir = Path(input_dir
+                         if input_dir
+                         else './raw_data').resolve()
+    trimmed_dir = Path(trimmed_dir
+                           if trimmed_dir
+                           else './trimmed').resolve()
+    mapped_dir = Path(mapped_dir
+                          if mapped_dir
+                          else './mapped').resolve()
+
+    adapters_file = (adapters_file
+                        if adapters_file
+                        else str(input_dir / 'all_adapters.fa'))
+
+    if not idx_prefix:
+        index_dir = Path('./index/grcm38_snp_tran/').resolve()
+        idx_prefix = str(index_dir / 'genome_snp_tran') # The / is for appending to the path object.
+
+    contaminants = str(Path(contaminants).resolve()) if contaminants else None
+    min_alignment_rate = float(min_alignment_rate) if min_alignment_rate else None
+    check_reads = int(check_reads) if check_reads else CHECK_READS
+
+    # The fused stages need the trimmed reads in the standard output
+    trim_engine = 'numpy' if fused else (trim_engine if trim_engine else 'trimmomatic')
+    sort = sort or fused
+    cores = cores if cores else 1
+    group_by = group_by if group_by and not fused else 'chunk'
+    ram = ram if ram else 8
+    batch_size = batch_size if batch_size else 1
+    batch_concurrency = batch_concurrency if batch_concurrency else 1
+    stall_minutes = stall_minutes if stall_minutes else STALL_MINUTES
+    pilot = int(pilot) if pilot else None
+    pilot_chunks = int(pilot_chunks) if pilot_chunks else PILOT_CHUNKS
+    executor = executor if executor else 'sge'
+
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    Trimmed files directory: {trimmed_dir}\n'
+          f'    Mapped files directory: {mapped_dir}\n'
+          f'    Adapters file: {adapters_file}\n'
+          f'    Detect the adapters of each sample: {detect_adapters}\n'
+          f'    Skip clean chunks: {skip_clean}\n'
+          f'    Trimming engine: {trim_engine}\n'
+          f'    Index prefix: {idx_prefix}\n'
+          f'    Sort output into BAM: {sort}\n'
+          f'    Cores per task: {cores}\n'
+          f'    Collapse duplicate reads: {collapse}\n'
+          f'    Contaminants: {contaminants}\n'
+          f'    Minimum alignment rate: {min_alignment_rate}\n'
+          f'    Reads checked: {check_reads}\n'
+          f'    Chunks per mapping: {group_by}\n'
+          f'    Index cache: {index_cache}\n'
+          f'    Prewarm index: {prewarm}\n'
+          f'    RAM per process: {ram}\n'
+          f'    Chunks per task: {batch_size}\n'
+          f'    Target minutes per task: {target_task_minutes}\n'
+          f'    Chunks at the same time: {batch_concurrency}\n'
+          f'    Predict resources: {auto_resources}\n'
+          f'    Minutes without progress before requeueing: {stall_minutes}\n'
+          f'    Stage files in local scratch: {scratch}\n'
+          f'    Fuse trimming, mapping and sorting: {fused}\n'
+          f'    Pilot run: {f"{pilot} reads of {pilot_chunks} chunks" if pilot else False}\n'
+          f'    Executor: {executor}')
+
+    trimming = load_script('script.trimming.py')
+    rnaseq_map = load_script('script.rnaseq_map.py')
+    sam_to_bam = load_script('script.sam_to_bam.py')
+
+
+    # 1. --- Find the data.
+    files = trimming.search_files(input_dir)
+
+    #          With --pilot, measure the full run (to extrapolate to it)...
+    if pilot:
+        chunks = files['paired'] + [(f,) for f in files['unpaired']]
+        full_bytes = sum(chunk_bytes(chunk) for chunk in chunks)
+        largest_chunk = max(chunk_bytes(chunk) for chunk in chunks)
+        n_mappings = (len(files['unpaired'])
+                      + len(rnaseq_map.chunk_groups(files['paired'], group_by)))
+        # The commands of each stage in the full run, in order of execution
+        stage_tasks = {'quality_check': len(chunks),
+                       **({} if fused else {'trimming': len(chunks)}),
+                       'rnaseq_map': n_mappings,
+                       **({} if sort else {'sam_to_bam': n_mappings})}
+
+        #      ... and use a sample of the reads of a few chunks instead, in a
+        #          directory of its own (with its logs, manifests and accounting).
+        work_dir = Path.cwd()
+        pilot_dir = work_dir / 'pilot'
+        input_dir, trimmed_dir, mapped_dir, qc_dir = (pilot_dir / name
+                                                      for name in ('raw_data', 'trimmed', 'mapped', 'qc'))
+        for directory in (input_dir, trimmed_dir, mapped_dir, qc_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+
+        start = time.monotonic()
+        sampled = representative_chunks(chunks, pilot_chunks)
+        for i, chunk in enumerate(sampled):
+            # Different sizes, to tell the fixed cost of a task from the cost per read
+            sample_chunk(chunk, pilot * (i+1) // len(sampled), input_dir)
+        print(f'Sampled the reads of {len(sampled)} chunks in'
+              f' {time.monotonic() - start:.1f} seconds:', ' '.join(Path(chunk[0]).name for chunk in sampled))
+
+        os.chdir(pilot_dir)
+        for stage in stage_tasks:
+            # Only the tasks of this pilot run are measured
+            if accounting_file(stage).exists():
+                accounting_file(stage).unlink()
+
+        files = trimming.search_files(input_dir)
+        pilot_bytes = sum(chunk_bytes(chunk)
+                              for chunk in files['paired'] + [(f,) for f in files['unpaired']])
+
+
+    # 2. --- Generate the commands of every stage.
+    #        The outputs of each stage are the inputs of the next one,
+    #        in the same order.
+    sample_adapters = (trimming.detect_sample_adapters(files, adapters_file, trimmed_dir)
+                           if detect_adapters
+                           else None)
+    trimming_commands = list(trimming.assemble_commands(files,
+                                                        trimmed_dir,
+                                                        adapters_file,
+                                                        trim_engine,
+                                                        1,
+                                                        sample_adapters=sample_adapters))
+
+    trimmed_files = trimming.mapping_inputs(files, trimmed_dir)
+    mapping_commands = list(rnaseq_map.assemble_commands(trimmed_files,
+                                                         idx_prefix,
+                                                         mapped_dir,
+                                                         sort,
+                                                         cores,
+                                                         group_by,
+                                                         collapse,
+                                                         contaminants,
+                                                         min_alignment_rate,
+                                                         check_reads))
+    if contaminants:
+        # The k-mers of the contaminants are indexed once, not by every task
+        load_index(contaminants)
+
+    if group_by == 'chunk':
+        # The same batches are used for all the stages
+        batches = batch_commands(trimming_commands,
+                                 batch_size,
+                                 target_task_minutes,
+                                 stage='trimming')
+        mapping_batches = batches
+    else:
+        # Each trimming task trims all the chunks mapped together by the
+        # corresponding mapping task. The unpaired files go first, one by one.
+        n_unpaired = len(trimmed_files['unpaired'])
+        groups = rnaseq_map.chunk_groups(trimmed_files['paired'], group_by)
+        batches = ([[i+1] for i in range(n_unpaired)] +
+                   [[n_unpaired + i + 1 for i in group] for group in groups])
+        mapping_batches = [[i+1] for i in range(len(batches))]
+
+    def resources(commands, stage, cores):
+        """The (RAM, cores) of the tasks of a stage."""
+        if not auto_resources:
+            return ram, cores
+        predicted = predict_resources(commands, stage, ram, cores)
+        return (max(r for r, _ in predicted),
+                max(c for _, c in predicted))
+
+    if fused:
+        # A single stage, executed as the mapping
+        mapping_commands = fuse_commands(trimming_commands, mapping_commands, cores)
+
+    # (script name, contents, cores, RAM) of each stage.
+    stage_ram, stage_cores = resources(trimming_commands, 'trimming', 1)
+    stages = [] if fused else [('script.autogenerated.trimming_jobs.py',
+                   trimming.assemble_script([trimming.with_threads(c, stage_cores)
+                                                 for c in trimming_commands], stage_ram,
+                                            batches, batch_concurrency, stage_cores,
+                                            stall_minutes=stall_minutes,
+                                            scratch=scratch,
+                                            skip_clean=((CLEAN_ADAPTER_RATE, CLEAN_LOW_QUALITY_RATE)
+                                                            if skip_clean
+                                                            else None)),
+                   int(stage_cores) * int(batch_concurrency), stage_ram)]
+
+    stage_ram, stage_cores = resources(mapping_commands, 'rnaseq_map', cores)
+    stages.append(('script.autogenerated.rnaseq_map_jobs.py',
+                       rnaseq_map.assemble_script([rnaseq_map.with_threads(c, stage_cores)
+                                                       for c in mapping_commands],
+                                                  stage_ram, stage_cores,
+                                                  mapping_batches, batch_concurrency,
+                                                  stall_minutes=stall_minutes,
+                                                  idx_prefix=idx_prefix,
+                                                  index_cache=index_cache,
+                                                  prewarm=prewarm,
+                                                  scratch=scratch),
+                       int(stage_cores) * int(batch_concurrency), stage_ram))
+
+    if not sort:
+        # The SAM file is the output of the mapping command.
+        sam_files = [next(f for f in files_of(c)[1] if f.endswith('.sam'))
+                         for c in mapping_commands]
+        sorting_commands = list(sam_to_bam.assemble_commands(sam_files,
+                                                             mapped_dir,
+                                                             cores))
+        stage_ram, stage_cores = resources(sorting_commands, 'sam_to_bam', cores)
+        stages.append(('script.autogenerated.sam_to_bam_jobs.py',
+                           sam_to_bam.assemble_script(sorting_commands, stage_ram, stage_cores,
+                                                      mapping_batches, batch_concurrency,
+                                                      stall_minutes=stall_minutes,
+                                                      scratch=scratch),
+                           int(stage_cores) * int(batch_concurrency), stage_ram))
+
+
+    if pilot:
+        # The quality check of the same chunks goes first
+        quality_check = load_script('script.quality_check.py')
+        qc_commands = [quality_check.fastqc_command(reads_of(c), qc_dir)
+                           for c in trimming_commands]
+        stage_ram, stage_cores = resources(qc_commands, 'quality_check', 1)
+        stages.insert(0, ('script.autogenerated.quality_check_jobs.py',
+                              quality_check.assemble_script(qc_commands, stage_ram,
+                                                            batches, batch_concurrency, stage_cores,
+                                                            stall_minutes=stall_minutes,
+                                                            scratch=scratch),
+                              int(stage_cores) * int(batch_concurrency), stage_ram))
+
+
+    # 3. --- Write the scripts to files.
+    for script_name, script_contents, _, _ in stages:
+        with open(script_name, 'w') as outf:
+            outf.write(script_contents)
+
+
+    # 4. --- Execute the scripts, chained task by task.
+    if executor == 'local':
+        run_local_chain([(script_name, c, r) for script_name, _, c, r in stages],
+                        len(batches))
+    else:
+        job_id = None
+        for i, (script_name, _, _, _) in enumerate(stages):
+            # A pilot run waits for its last stage to finish
+            job_id = qsub(script_name, hold_jid=job_id, sync=bool(pilot) and i == len(stages)-1)
+
+
+    # 5. --- With --pilot, extrapolate the resources to the full run.
+    if pilot:
+        calibration = calibrate(stage_tasks, pilot_bytes, full_bytes, largest_chunk, len(chunks))
+
+        with open(work_dir / PILOT_FILE, 'w') as outf:
+            json.dump(calibration, outf, indent=1)
+
+        for stage, s in calibration['stages'].items():
+            print(f'{stage}: {s["tasks"]} commands, {s["input_gb"]}G of input,'
+                  f' {s["cpu_hours"]} CPU-hours, {s["max_task_hours"]} hours the largest one,'
+                  f' {s["ram"]}G of RAM and {s["cores"]} cores, {s["output_gb"]}G of outputs.')
+        print(f'Full run: {calibration["cpu_hours"]} CPU-hours,'
+              f' {calibration["wall_hours"]} hours with every task of a stage at the same time,'
+              f' {calibration["disk_gb"]}G of disk.')
+        print(f'Calibration written to {work_dir / PILOT_FILE}, used with --auto_resources.')
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
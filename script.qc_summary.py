@@ -0,0 +1,73 @@
+#! /bin/env python3
+
+"""
+Summary tables of the FastQC reports
+====================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+The tasks of the quality check (`script.quality_check.py`) add their FastQC
+reports to the summary tables as they finish (see `qc_summary.py`). This
+script adds the reports of a directory that are missing from its tables
+(e.g. the ones made before) and rewrites the summary of the samples:
+
+    <report dir>/qc_summary.tsv             (a row per report)
+    <report dir>/qc_summary.samples.tsv     (a row per sample, 'mmXY')
+
+The reports already in the table, and not changed since, are not parsed again.
+
+"""
+
+import click
+from pathlib import Path
+
+from qc_summary import update_summary, SUMMARY_FILE, SAMPLES_FILE
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--report_dir', '-i',
+              help='The directory where the FastQC reports reside.'
+                   ' Default: "./raw_data".')
+
+def main(report_dir):
+    """Add the FastQC reports of the directory to its summary tables."""
+
+    report_dir = Path(report_dir
+                          if report_dir
+                          else './raw_data').resolve()
+
+    print( 'Resolved parameters: \n'
+          f'    Report directory: {report_dir}')
+
+
+    # 1. --- Search the reports.
+    zip_files = sorted(str(file) for file in report_dir.glob('*_fastqc.zip'))
+
+
+    # 2. --- Add the new and changed ones to the tables.
+    new_rows = update_summary(report_dir, zip_files)
+
+    print(f'{len(new_rows)} of {len(zip_files)} reports added to {report_dir / SUMMARY_FILE}\n'
+          f'Summary of the samples written to {report_dir / SAMPLES_FILE}')
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface
+    main()
@@ -34,18 +34,61 @@ Procedure
 All the FASTQ files are already in a single folder (data/), so, we invoke
 fastq on each of them.
 
+Each FastQC run starts a Java virtual machine, which takes longer than the
+analysis of a small chunk. So the files can be analyzed several at a time by
+each run ('--files_per_run'), with as many threads as requested cores
+('--cores', FastQC analyzes a file per thread):
+
+    fastqc -t 4 -o <output dir> <file 1> <file 2> ... <file 16>
+
+The cores are requested for each task through the parallel environment
+('#$ -pe openmp'); without it SGE gives a single slot to the task and the
+FastQC threads fight for it (and for the memory of the node, each thread
+uses about 250Mb).
+
 Why do we need to generate another script? In order to get computing resources, we need to
 enqueue the job through the SGE tasks system, this is done by specifying the task in a script.
 That is the script that is generated here and submitted to the queue system through 'qsub' at 
 the end of this file.
 
+Sampled quality check
+---------------------
+Running FastQC on every read of the 568 files takes hours, just to learn
+whether a run is good enough to go on. With '--sample N', a uniform random
+sample of N reads is drawn from each file (or, with '--sample_by sample',
+from all the files of each sample and mate, whatever their lane, e.g.
+'mm1L_R1' of every 'mm1L_..._L00X_R1_00Y.fastq', see 'group_of' in `fastq.py`)
+in a single pass ("reservoir sampling", see `fastq.py`), and FastQC is run on
+the sampled files only (<output dir>/sampled/<name>.sample<N>.fastq).
+
+Next to the FastQC reports, '<output dir>/sampled_qc.json' has the statistics
+of each sample of reads together with their 95% confidence intervals (e.g. of
+the mean quality at each position, the GC content and the percent of each
+overrepresented sequence), so one can tell when the sample is too small to
+trust a verdict. The sampling uses a fixed seed, so it is repeatable, and a
+sample is only drawn again when its files change.
+
+Summary tables
+--------------
+Each task adds the reports it made to the tables 'qc_summary.tsv' (a row per
+report) and 'qc_summary.samples.tsv' (a row per sample) in the output
+directory (see `qc_summary.py`), so there is no need to run MultiQC.
+
 """
 
+import json
 import click
 import textwrap
 import subprocess
-from typing import Union, List
+from typing import Union, List, Optional, Tuple, Dict
 from pathlib import Path
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+
+from fastq import (reservoir_sample, write_records, file_stats, summarize, 
+                   confidence, group_of)
+from jobs import run_local, batch_commands, resource_groups, script_file
+from tasks import STALL_MINUTES
 
 
 def get_output(command: Union[str, List[str]], **kwargs) -> str:
@@ -64,6 +107,175 @@ def run(command: Union[str, List[str]], **kwargs) -> subprocess.CompletedProcess
     return subprocess.run(command, **kwargs)
 # ---
 
+def sample_groups(files: List[str], sample_by: str = 'file') -> Dict[str, List[str]]:
+    """The files sampled together, by the name of their sample: each file by
+    itself ('file'), or all the files of each sample and mate ('sample', see
+    'group_of' in `fastq.py`)."""
+    groups = defaultdict(list)
+    for file in files:
+        name = group_of(file) if sample_by == 'sample' else Path(file).stem
+        groups[name].append(file)
+    return dict(groups)
+# ---
+
+def sample_reads(name: str, 
+                 files: List[str], 
+                 n_reads: int, 
+                 sampled_dir: Path) -> Tuple[str, Dict[str, object]]:
+    """Draw a random sample of the reads of the files and compute its statistics.
+
+    Input:
+        name: The name of the group of files.
+        files: The FASTQ files.
+        n_reads: The number of reads to sample.
+        sampled_dir: The directory where to write the sampled FASTQ file.
+    Output: The sampled file, and the statistics of the sample with their
+            confidence intervals.
+
+    A sample newer than its files, from the same files, is not drawn again
+    (its statistics are kept next to it, in '<name>.sample<N>.json'), so that
+    the FastQC task of an unchanged sample is skipped (see `tasks.py`).
+    """
+    sampled_file = sampled_dir / f'{name}.sample{n_reads}.fastq'
+    report_file = sampled_file.with_suffix('.json')
+    names = [Path(f).name for f in files]
+
+    if (sampled_file.exists() and report_file.exists()
+            and sampled_file.stat().st_mtime >= max(Path(f).stat().st_mtime for f in files)):
+        with open(report_file) as inf:
+            report = json.load(inf)
+        if report['files'] == names:
+            return str(sampled_file), report
+
+    records, total_reads = reservoir_sample(files, n_reads)
+    write_records(records, sampled_file)
+
+    stats = file_stats(sampled_file)
+    report = summarize(stats)
+    report['files'] = names
+    report['confidence'] = confidence(stats, total_reads)
+    with open(report_file, 'w') as outf:
+        json.dump(report, outf, indent=1)
+
+    return str(sampled_file), report
+# ---
+
+def fastqc_command(files: List[str], output_dir: Union[str, Path], threads: int = 1) -> str:
+    """The FastQC command that analyzes the files, with the given number of threads."""
+    threads_str = f'-t {threads} ' if int(threads) > 1 else ''
+    return f"fastqc {threads_str}-o {output_dir} {' '.join(files)}"
+# ---
+
+def assemble_script(commands: List[str], 
+                    ram: int = 8,
+                    batches: Optional[List[List[int]]] = None,
+                    concurrency: int = 1,
+                    cores: int = 1,
+                    stall_minutes: float = STALL_MINUTES,
+                    scratch: bool = False) -> str:
+    """Assemble the job array script that executes the commands.
+    
+    Input:
+        commands: The commands to be executed.
+        ram: RAM amount per task (in Gb).
+        batches: The ids of the commands executed by each task, as returned 
+                 from 'jobs.batch_commands'. Default: one command per task.
+        concurrency: How many commands of a task are executed at the same time.
+        cores: The cores used by each command.
+        stall_minutes: Minutes without progress before killing a command.
+        scratch: Whether to execute the commands in the local scratch of the node.
+    Output: The contents of the script.
+    """
+    batches = batches if batches else [[i+1] for i in range(len(commands))]
+
+    commands_str = "\n    ".join( f"commands[{i+1}]='{s}'" 
+                                  for i,s in enumerate(commands) )
+    batches_str = "\n    ".join( f"batches[{i+1}]={b}" 
+                                 for i,b in enumerate(batches) )
+
+    python3_exec_path = get_output('which python3')
+    pipeline_dir = Path(__file__).resolve().parent
+
+    script_contents = f"""\
+    #! {python3_exec_path}
+
+    #Run through this shell
+    #$ -S {python3_exec_path}
+
+    # Use current working directory
+    #$ -cwd
+
+    # Join stdout and stderr
+    #$ -j y
+
+    # If modules are needed, source modules environment (Do not delete the next line):
+    #. /etc/profile.d/modules.sh
+
+    # Name the job
+    #$ -N quality_check
+
+    # Pass environment
+    #$ -V
+
+    # Use the cores of each command, for every command executed at the same time
+    #$ -pe openmp {int(cores) * int(concurrency)}
+
+    # Work with {ram}G RAM
+    #$ -l vf={ram}G
+
+    # Use as many jobs as needed
+    #$ -t 1-{len(batches)}
+
+
+    '''
+    Quality check using FastQC
+    --------------------------
+
+    The current script was autogenerated with the 
+    file `script.quality_check.py`, look there for documentation.
+
+    '''
+
+    import os
+    import sys
+    
+    # The pipeline modules are in the directory of the generator script
+    sys.path.insert(0, '{pipeline_dir}')
+    from tasks import execute_batch, task_exit_code
+    from qc_summary import add_reports
+    
+    
+    # The commands to be executed
+    commands = dict()
+    {commands_str}
+    
+    # The ids of the commands executed by each job
+    batches = dict()
+    {batches_str}
+    
+    # Fetch the job id
+    task_id = int( os.environ['SGE_TASK_ID'] )
+    
+    # Execute the commands corresponding to the current job.
+    #   -> Each one is skipped if it was already executed with the same inputs, 
+    #      parameters and tool versions (see `tasks.py`).
+    exit_code = execute_batch([commands[i] for i in batches[task_id]], 
+                              task_id, 
+                              stage='quality_check', 
+                              concurrency={concurrency},
+                              stall_minutes={stall_minutes},
+                              scratch={scratch})
+    
+    # Add the reports to the summary tables of the output directory
+    #   -> See `qc_summary.py`.
+    add_reports([commands[i] for i in batches[task_id]])
+    
+    # An aborted command keeps the tasks of the next stages on hold (see `tasks.py`).
+    sys.exit(task_exit_code(exit_code))
+    """
+    # Remove indentation
+    return textwrap.dedent(script_contents)
+# ---
 
 #### <<<<<< MAIN PROCEDURE >>>>>>> ####
 
@@ -86,7 +298,59 @@ def run(command: Union[str, List[str]], **kwargs) -> subprocess.CompletedProcess
 @click.option('--ram', '-r', 
               help='RAM amount per job (in Gb). Default 8.')
 
-def main(input_dir, output_dir, file_glob, ram):
+@click.option('--sample', '-n',
+              help='Check only a random sample of this many reads of each'
+                   ' file (or of each sample, see --sample_by) instead of all'
+                   ' the reads. Default: check all the reads.')
+
+@click.option('--sample_by', '-s', type=click.Choice(['file', 'sample']),
+              help='With --sample, draw the reads from each file or from all'
+                   ' the files (chunks) of each sample and read direction.'
+                   ' Default "file".')
+
+@click.option('--cores', '-c',
+              help='The cores (and FastQC threads) of each FastQC run.'
+                   ' Default 1.')
+
+@click.option('--files_per_run', '-g',
+              help='How many files are analyzed by each FastQC run (a single'
+                   ' Java virtual machine). Default 1.')
+
+@click.option('--batch_size', '-b',
+              help='The number of commands executed by each task. Default 1.')
+
+@click.option('--target_task_minutes', '-m',
+              help='Group the commands so that each task takes about this many'
+                   ' minutes (estimated from the size of the input files).'
+                   ' Overrides --batch_size.')
+
+@click.option('--batch_concurrency', '-j',
+              help='How many of the commands of a task are executed at the'
+                   ' same time. Default 1.')
+
+@click.option('--auto_resources', '-A', is_flag=True,
+              help='Predict the RAM and cores of each task from the previous'
+                   ' runs of the stage (see `jobs.py`), and submit a job array'
+                   ' for each group of tasks needing the same resources.'
+                   ' Overrides --ram.')
+
+@click.option('--stall_minutes', '-w',
+              help='Kill a command when neither its output files nor its CPU'
+                   ' time grow in this many minutes, and execute its task'
+                   ' again (see `tasks.py`). Default 60.')
+
+@click.option('--scratch', '-T', is_flag=True,
+              help='Copy the input files to the local scratch directory of'
+                   ' the node ($TMPDIR), execute the commands there and move'
+                   ' the outputs back (see `tasks.py`).')
+
+@click.option('--executor', '-e', type=click.Choice(['sge', 'local']),
+              help='Where to run the tasks: submit them to the SGE queue (qsub)'
+                   ' or run them in a pool of processes in the current machine.'
+                   ' Default "sge".')
+
+def main(input_dir, output_dir, file_glob, ram, sample, sample_by, cores, files_per_run,
+         batch_size, target_task_minutes, batch_concurrency, auto_resources, stall_minutes, scratch, executor):
     """Assemble the script with the commands for quality check and submit (qsub) it."""
     
     input_dir = Path(input_dir 
@@ -101,113 +365,121 @@ def main(input_dir, output_dir, file_glob, ram):
                     else '*.fastq')
     
     ram = ram if ram else 8
+    sample = int(sample) if sample else None
+    sample_by = sample_by if sample_by else 'file'
+    cores = int(cores) if cores else 1
+    files_per_run = int(files_per_run) if files_per_run else 1
+    batch_size = batch_size if batch_size else 1
+    batch_concurrency = batch_concurrency if batch_concurrency else 1
+    stall_minutes = stall_minutes if stall_minutes else STALL_MINUTES
+    executor = executor if executor else 'sge'
     
     print( 'Resolved parameters: \n'
           f'    Input directory: {input_dir}\n'
           f'    Output directory: {output_dir}\n'
           f'    File glob: {file_glob}\n'
-          f'    RAM per process: {ram}')
+          f'    RAM per process: {ram}\n'
+          f'    Reads sampled: {sample if sample else "all"}\n'
+          f'    Sample by: {sample_by}\n'
+          f'    Cores per FastQC run: {cores}\n'
+          f'    Files per FastQC run: {files_per_run}\n'
+          f'    Commands per task: {batch_size}\n'
+          f'    Target minutes per task: {target_task_minutes}\n'
+          f'    Commands at the same time: {batch_concurrency}\n'
+          f'    Predict resources: {auto_resources}\n'
+          f'    Minutes without progress before requeueing: {stall_minutes}\n'
+          f'    Stage files in local scratch: {scratch}\n'
+          f'    Executor: {executor}')
     
 
     ## 1. --- Generate the commands.
     #          ... & search the files.
-    input_files = (str(file) 
-                       for file in input_dir.glob(file_glob))
-
-
-    command_template = f"fastqc -o {output_dir} {{inputf}}"
-    commands = [command_template.format(inputf=file) 
-                    for file in input_files]
-
-    commands_str = "\n    ".join( f"commands[{i+1}]='{s}'" 
-                                  for i,s in enumerate(commands) )
+    input_files = sorted(str(file) 
+                             for file in input_dir.glob(file_glob))
 
+    #          ... & with --sample, check random samples of the reads instead.
+    if sample:
+        groups = sample_groups(input_files, sample_by)
 
+        sampled_dir = output_dir / 'sampled'
+        sampled_dir.mkdir(parents=True, exist_ok=True)
 
-    # 2. --- Assemble the script.
-    #        Create the script that will launch the paralell jobs.
+        with Pool(min(len(groups), cpu_count()) or 1) as pool:
+            results = pool.starmap(sample_reads, 
+                                   [(name, files, sample, sampled_dir) 
+                                        for name, files in groups.items()])
 
-    python3_exec_path = get_output('which python3')
+        sampled_report = dict()
+        for name, (sampled_file, report) in zip(groups, results):
+            sampled_report[name] = report
+            conf = report['confidence']
+            print(f'{name}: {conf["sampled_reads"]} of {conf["total_reads"]} reads sampled,'
+                  f' GC {report["mean_gc"]:.1f}% (95% CI {conf["mean_gc"][0]}-{conf["mean_gc"][1]}),'
+                  f' {len(conf["overrepresented_sequences"])} overrepresented sequences.')
 
-    script_contents = f"""\
-    #! {python3_exec_path}
+        with open(output_dir / 'sampled_qc.json', 'w') as outf:
+            json.dump(sampled_report, outf, indent=1)
 
-    #Run through this shell
-    #$ -S {python3_exec_path}
+        input_files = [sampled_file for sampled_file, _ in results]
 
-    # Use current working directory
-    #$ -cwd
 
-    # Join stdout and stderr
-    #$ -j y
+    #          Each command analyzes several files in a single FastQC run.
+    runs = [input_files[i:i+files_per_run] 
+                for i in range(0, len(input_files), files_per_run)]
+    commands = [fastqc_command(files, output_dir, cores) 
+                    for files in runs]
 
-    # If modules are needed, source modules environment (Do not delete the next line):
-    #. /etc/profile.d/modules.sh
 
-    # Name the job
-    #$ -N quality_check
 
-    # Pass environment
-    #$ -V
-
-    # Work with {ram}G RAM
-    #$ -l vf={ram}G
-
-    # Use as many jobs as needed
-    #$ -t 1-{len(commands)}
-
-
-    '''
-    Quality check using FastQC
-    --------------------------
-
-    The current script was autogenerated with the 
-    file `script.quality_check.py`, look there for documentation.
-
-    '''
+    # 2. --- Assemble the script.
+    #        Create the script that will launch the paralell jobs.
+    #        The commands are grouped in batches, each one executed by a task.
+    #        With --auto_resources, a script is made for each group of commands
+    #        needing the same resources.
+    groups = resource_groups(commands, 
+                             'quality_check', 
+                             ram, 
+                             cores, 
+                             auto_resources)
 
-    import os
-    import maya
-    import subprocess
-    from pathlib import Path
+    for group_ram, group_cores, ids in groups:
+        # The FastQC threads match the cores requested for the group
+        for i in ids:
+            commands[i-1] = fastqc_command(runs[i-1], output_dir, group_cores)
 
+        batches = batch_commands(commands, 
+                                 batch_size, 
+                                 target_task_minutes, 
+                                 stage='quality_check',
+                                 ids=ids)
+        script_contents = assemble_script(commands, group_ram, batches, 
+                                          batch_concurrency, group_cores,
+                                          stall_minutes=stall_minutes,
+                                          scratch=scratch)
 
-    # The commands to be executed
-    commands = dict()
-    {commands_str}
 
-    # Fetch the job id
-    task_id = int( os.environ['SGE_TASK_ID'] )
 
-    # Fetch the command corresponding to the current job
-    command = commands[task_id]
+        # 3. --- Write the script to a file.
 
+        script_name = script_file('script.autogenerated.quality_check_jobs.py',
+                                  group_ram, 
+                                  group_cores, 
+                                  len(groups))
 
-    # Execute the command
-    print(f'Task {{task_id}}. Executing command @', maya.now(), ':', command, flush=True)
+        with open(script_name, 'w') as outf:
+            outf.write(script_contents)
 
-    subprocess.run(command.split()) # <-- Here it is executed, splitting is 
-                                    #     necessary to pass the arguments 
-                                    #     appropriately
-
-    print(f'Task {{task_id}}. Finished execution @', maya.now(), flush=True)
-    """
-    # Remove indentation
-    script_contents = textwrap.dedent(script_contents)
-    
-    
-    
-    # 3. --- Write the script to a file.
-    
-    script_name = 'script.autogenerated.quality_check_jobs.py'
 
-    with open(script_name, 'w') as outf:
-        outf.write(script_contents)
 
+        # 4. --- Launch the job
 
-        
-    # 4. -- Launch the job
-    run(f"qsub {script_name}")
+        if executor == 'local':
+            run_local(script_name, 
+                      len(batches), 
+                      int(group_cores) * int(batch_concurrency), 
+                      group_ram)
+        else:
+            run(f"qsub {script_name}")
 # ---
 
 
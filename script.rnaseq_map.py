@@ -43,7 +43,46 @@ from the link on the official HISAT2 page
 We are basing our protocol on the instructions provided in:
 https://davetang.org/muse/2017/10/25/getting-started-hisat-stringtie-ballgown/
 So we are executing:
-    hisat2 -p 8 --dta -x <index folder with prefix> -1 <sample1> -2 <sample2> -S <outputfile.sam>
+    hisat2 -p <cores> --dta -x <index folder with prefix> -1 <sample1> -2 <sample2> -S <outputfile.sam>
+
+The SAM files are huge and the only thing we do with them afterwards is sorting and
+compressing them to BAM (`script.sam_to_bam.py`). So, with the `--sort` flag, the
+output of HISAT2 is piped directly into `samtools sort` inside the same task:
+    hisat2 -p <cores - 1> --dta -x <index folder with prefix> -1 <sample1> -2 <sample2> | samtools sort -@ 1 -o <outputfile.bam> -
+and only the sorted BAM file is written. This avoids writing and re-reading the SAM
+files and the second job array altogether. HISAT2 is the bottleneck, so it gets all
+the cores of the task but one, left to 'samtools sort', which mostly waits for the
+alignments until HISAT2 is done.
+
+Each sample is split in many chunks (`_001.fastq`, `_002.fastq`, ...), and running HISAT2
+once per chunk means loading the genome index (several Gb) from disk once per chunk.
+HISAT2 accepts lists of files separated by commas, so with `--group_by sample` all the
+chunks of a sample are mapped by a single HISAT2 run (and a single SAM/BAM file per sample
+is produced):
+    hisat2 --dta -x <index folder with prefix> -1 <chunk1_1>,<chunk2_1>,... -2 <chunk1_2>,<chunk2_2>,... -S <sample>_paired.sam
+With `--group_by N` the chunks of each sample are mapped N at a time instead.
+
+After the trimming, the sequences have an awful lot of repetition. With `--collapse`,
+the duplicate reads (or pairs) of each chunk are collapsed before mapping, so HISAT2
+maps each sequence only once, and the number of copies is restored as the tag 'XC'
+of the alignments (see `collapse.py`):
+    script.collapse.py -o - <sample1> <sample2> | hisat2 --dta -x <index folder with prefix> --interleaved - \\
+        | script.collapse.py --tag | samtools sort -o <outputfile.bam> -
+
+Reads of ribosomal RNA and other abundant contaminants would be discarded after mapping.
+With `--contaminants <FASTA file>`, the reads sharing k-mers with its sequences are written
+to a side file ('<outputfile>.contaminants.fastq') instead of being mapped (see `kmer_filter.py`):
+    script.kmer_filter.py -c <contaminants.fa> -s <side file> -o - <sample1> <sample2> \\
+        | hisat2 --dta -x <index folder with prefix> --interleaved - ...
+
+A badly trimmed or mislabelled chunk would still be mapped to the end before its alignment
+rate is seen. With `--min_alignment_rate <%>`, the mapping of a chunk is aborted if the
+alignment rate of its first reads (`--check_reads`) is lower (see `alignment_monitor.py`):
+    hisat2 ... | script.alignment_monitor.py -m <%> | samtools sort -o <outputfile.bam> -
+
+The index is also read by every task from the shared filesystem. With `--index_cache <dir>`
+it is copied once per node to a local directory, and with `--prewarm` it is read ahead into
+the page cache before mapping (see `index_cache.py`).
 
 Procedure
 ---------
@@ -72,10 +111,16 @@ import re
 import click
 import textwrap
 import subprocess
-from typing import Union, List, Iterable, Generator
+from typing import Union, List, Tuple, Iterable, Generator, Optional
 from itertools import chain
 from pathlib import Path
 
+from jobs import run_local, batch_commands, resource_groups, script_file
+from tasks import STALL_MINUTES
+from kmer_filter import load_index
+from alignment_monitor import CHECK_READS
+from fastq import sample_of
+
 
 def get_output(command: Union[str, List[str]], **kwargs) -> str:
     """Execute a command through the shell, get the output as a string.
@@ -143,9 +188,75 @@ def search_files(data_path: Union[str, Path]):
             'unpaired': loners}
 # ---
 
+def chunk_groups(pairs: List[Tuple[str, str]], 
+                 group_by: Union[str, int] = 'chunk') -> List[List[int]]:
+    """Group the pairs of chunk files to be mapped by the same HISAT2 run.
+    
+    Input:
+        pairs: The pairs of chunk files, as in the 'search_files' output.
+        group_by: 'chunk' (every pair on its own), 'sample' (all the chunks of 
+                  the same sample together) or a number N (N consecutive chunks 
+                  of the same sample together).
+    Output: The groups, as lists of indices of the pairs. The order of the 
+            pairs is kept.
+    """
+    if str(group_by) == 'chunk':
+        return [[i] for i in range(len(pairs))]
+    
+    group_size = None if str(group_by) == 'sample' else int(group_by)
+    
+    groups = []
+    for i, (p1, _) in enumerate(pairs):
+        same_sample = groups and sample_of(pairs[groups[-1][0]][0]) == sample_of(p1)
+        if same_sample and (not group_size or len(groups[-1]) < group_size):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    
+    return groups
+# ---
+
+def group_output_name(pairs: List[Tuple[str, str]], 
+                      group: List[int]) -> str:
+    """The name of the SAM file for a group of pairs of chunk files.
+    
+    E.g. 'mm1L_ATCACG_L003_paired_001.sam' for a single chunk, 
+    'mm1L_ATCACG_L003_paired_001-005.sam' for several chunks (or
+    'mm1L_ATCACG_L003_paired_004-ATCACG_L004_paired_002.sam' across two
+    lanes), and 'mm1L_paired.sam' for all the chunks of the sample (see
+    'sample_of' in `fastq.py`).
+    """
+    first = Path(pairs[group[0]][0]).name
+    out_filename = re.sub('_R[12]_', '_', first)
+    out_filename = re.sub('fastq$', 'sam', out_filename)
+    
+    if len(group) == 1:
+        return out_filename
+    
+    sample = sample_of(first)
+    whole_sample = (len(group) == 
+                    sum(1 for p1, _ in pairs if sample_of(p1) == sample))
+    if whole_sample:
+        return f'{sample}_paired.sam'
+    
+    last = re.sub('_R[12]_', '_', Path(pairs[group[-1]][0]).name)
+    prefix, last_chunk = re.match(r'(.*)_(\d+)\.fastq$', last).groups()
+    if not out_filename.startswith(f'{prefix}_'):
+        # Another lane of the sample
+        last_chunk = last[len(sample) + 1:-len('.fastq')]
+    return re.sub(r'\.sam$', f'-{last_chunk}.sam', out_filename)
+# ---
+
 def assemble_commands(files, 
                       idx_prefix: Union[str, Path], 
-                      output_path: Union[str, Path]) -> Generator[str, None, None]:
+                      output_path: Union[str, Path],
+                      sort: bool = False,
+                      n_cores: int = 1,
+                      group_by: Union[str, int] = 'chunk',
+                      collapse: bool = False,
+                      contaminants: Optional[str] = None,
+                      min_alignment_rate: Optional[float] = None,
+                      check_reads: Optional[int] = None) -> Generator[str, None, None]:
     """Assemble the mapping commands.
     
     Input:
@@ -153,16 +264,95 @@ def assemble_commands(files,
                  as returned from the 'search_files' function.
         idx_prefix: A string with the path and file prefix for the genome index.
         output_path: A valid pathlib.Path object pointing to the output directory.
+        sort: Whether to pipe the output of HISAT2 directly into 'samtools sort'
+              and write only the sorted BAM file.
+        n_cores: The cores of each command (see 'with_threads').
+        group_by: How to group the paired chunks mapped by each command 
+                  (see 'chunk_groups').
+        collapse: Whether to collapse the duplicate reads before mapping
+                  them, and tag the alignments with their copies (see
+                  `collapse.py`).
+        contaminants: A FASTA file with the contaminants to filter out before
+                      mapping (see `kmer_filter.py`). Default: No filter.
+        min_alignment_rate: The alignment rate (in %) of the first reads
+                            below which the mapping is aborted (see
+                            `alignment_monitor.py`). Default: No check.
+        check_reads: How many reads are checked. Default: The default of
+                     `script.alignment_monitor.py`.
     
     Generates the commands that would be executed to make the map.
     
     The mapping is done using the following commands
         For paired reads:
-            hisat2 --dta -x <index folder with prefix> -1 <pair1> -2 <pair2> -S <outputfile.sam>
+            hisat2 -p <n_cores> --dta -x <index folder with prefix> -1 <pair1> -2 <pair2> -S <outputfile.sam>
         For unpaired reads:
-            hisat2 --dta -x <index folder with prefix> -U <unpaired> -S <outputfile.sam>
+            hisat2 -p <n_cores> --dta -x <index folder with prefix> -U <unpaired> -S <outputfile.sam>
+    
+    If sorting is requested, the '-S <outputfile.sam>' part is replaced by
+    (and HISAT2 leaves a core to it, '-p <n_cores - 1>'):
+            | samtools sort -@ 1 -o <outputfile.bam> -
+    
+    If several pairs are mapped together, their files are joined with commas:
+            -1 <pair1_1>,<pair2_1>,... -2 <pair1_2>,<pair2_2>,...
+    
+    If collapsing is requested, the reads come from `script.collapse.py` and
+    its tagging goes before the output part:
+            script.collapse.py -o - <pair1> <pair2> | hisat2 --dta -x <index folder with prefix> --interleaved - \
+            | script.collapse.py --tag -o <outputfile.sam>
+    
+    If filtering the contaminants, the reads come from `script.kmer_filter.py`
+    (before the collapsing, if requested):
+            script.kmer_filter.py -c <contaminants> -s <outputfile.contaminants.fastq> -o - <pair1> <pair2> \
+            | [script.collapse.py -o - --interleaved - |] hisat2 --dta -x <index folder with prefix> --interleaved - ...
+    
+    If checking the alignment rate, the output of HISAT2 goes through
+    `script.alignment_monitor.py` first:
+            hisat2 ... | script.alignment_monitor.py -m <min_alignment_rate> [-n <check_reads>] \
+            [| script.collapse.py --tag] | samtools sort -@ 1 -o <outputfile.bam> -
     """
     output_path = Path(output_path)
+    collapse_program = str(Path(__file__).resolve().parent / 'script.collapse.py')
+    filter_program = str(Path(__file__).resolve().parent / 'script.kmer_filter.py')
+    monitor_program = str(Path(__file__).resolve().parent / 'script.alignment_monitor.py')
+    hisat2 = f'hisat2 -p {hisat2_threads(n_cores, sort)} --dta -x {idx_prefix}'
+    
+    def output_part(out_filename):
+        "The part of the command that specifies where the output goes."
+        monitor = ''
+        if min_alignment_rate is not None:
+            n = f'-n {check_reads} ' if check_reads else ''
+            monitor = f'| {monitor_program} -m {min_alignment_rate:g} {n}'
+        tag = f'| {collapse_program} --tag ' if collapse else ''
+        if sort:
+            out_filename = re.sub('sam$', 'bam', out_filename)
+            o = str(output_path / out_filename)
+            return f'{monitor}{tag}| samtools sort -@ 1 -o {o} -'
+        else:
+            S = str(output_path / out_filename) # The / is for appending to the path object.
+            return f'{monitor}{tag}-o {S}' if monitor or tag else f'-S {S}'
+    # ---
+    
+    def reads_part(out_filename, *read_files):
+        "The part of the command that specifies where the reads come from."
+        filters = []
+        if contaminants:
+            side_file = str(output_path / re.sub('sam$', 'contaminants.fastq', out_filename))
+            filters.append(f'{filter_program} -c {contaminants} -s {side_file} -o -')
+        if collapse:
+            filters.append(f'{collapse_program} -o -')
+        
+        if filters:
+            # The first filter reads the files, the next ones its output
+            interleaved = '--interleaved ' if len(read_files) == 2 else ''
+            reads = '-U -' if len(read_files) == 1 else '--interleaved -'
+            return ' | '.join([f'{filters[0]} {" ".join(read_files)}']
+                              + [f'{f} {interleaved}-' for f in filters[1:]]
+                              + [f'{hisat2} {reads}'])
+        elif len(read_files) == 1:
+            return f'{hisat2} -U {read_files[0]}'
+        else:
+            return f'{hisat2} -1 {read_files[0]} -2 {read_files[1]}'
+    # ---
     
     # Unpaired reads
     loners = files['unpaired']
@@ -170,89 +360,85 @@ def assemble_commands(files,
     for unpaired_f in loners:
            
         out_filename = re.sub('fastq$','sam', Path(unpaired_f).name)
-        S = str(output_path / out_filename)
 
-        yield f'hisat2 --dta -x {idx_prefix} -U {unpaired_f} -S {S}'
+        yield f'{reads_part(out_filename, unpaired_f)} {output_part(out_filename)}'
         
     # Paired reads
     pairs = files['paired']
 
-    for p1, p2 in pairs:
-            
-        out_filename = re.sub('_R[12]_', '_', Path(p1).name)
-        out_filename = re.sub('fastq$', 'sam', out_filename)
-
-        S = str(output_path / out_filename) # The / is for appending to the path object.
+    for group in chunk_groups(pairs, group_by):
+        
+        p1 = ','.join(pairs[i][0] for i in group)
+        p2 = ','.join(pairs[i][1] for i in group)
+        out_filename = group_output_name(pairs, group)
 
-        yield f'hisat2 --dta -x {idx_prefix} -1 {p1} -2 {p2} -S {S}'
+        yield f'{reads_part(out_filename, p1, p2)} {output_part(out_filename)}'
 # ---
 
-#### <<<<<< MAIN PROCEDURE >>>>>>> ####
-
-# Command line interface
-@click.command()
-
-@click.option('--input_dir', '-i',
-              help='The directory where the input files reside.'
-                   ' Default "./trimmed".')
-
-@click.option('--output_dir', '-o',
-              help='The directory where to output the results.'
-                   ' Default "./mapped".')
+def hisat2_threads(n_cores: int, sort: bool) -> int:
+    """The threads of HISAT2 in a command with the given cores: all of them,
+    but one for 'samtools sort' when sorting (at least one)."""
+    return max(int(n_cores) - 1, 1) if sort else int(n_cores)
+# ---
 
-@click.option('--idx_prefix', '-p',
-              help='The prefix of the genome index files.'
-                   ' Default "./index/grcm38_snp_tran/genome_snp_tran".')
+def with_threads(command: str, n_cores: int) -> str:
+    """The mapping command using the given number of cores (e.g. the cores
+    requested for it with --auto_resources)."""
+    threads = hisat2_threads(n_cores, 'samtools sort' in command)
+    return re.sub(r'hisat2 -p \d+', f'hisat2 -p {threads}', command)
+# ---
 
-@click.option('--ram', '-r', 
-              help='RAM amount per job (in Gb). Default 8.')
-    
-def main(input_dir, output_dir, idx_prefix, ram):
-    """Assemble the script with the commands for trimming and submit (qsub) it."""
-    
-    input_dir = Path(input_dir 
-                         if input_dir 
-                         else './trimmed').resolve()
-    output_dir = Path(output_dir 
-                          if output_dir 
-                          else './mapped').resolve()
-    
-    if not idx_prefix:
-        index_dir = Path('./index/grcm38_snp_tran/').resolve()
-        idx_prefix = str(index_dir / 'genome_snp_tran') # The / is for appending to the path object.
-    
-    ram = ram if ram else 8
-    
-    print( 'Resolved parameters: \n'
-          f'    Input directory: {input_dir}\n'
-          f'    Output directory: {output_dir}\n'
-          f'    Index prefix: {idx_prefix}\n'
-          f'    RAM per process: {ram}')
-    
-    # 1. --- Find the data to map.
-    #        The data is in the directory "../RNAseq_data" (a symbolic link to the actual data.)
-    #        Here we fetch information of the files containing the data, whether they are paired 
-    #        and their location in the filesystem.
-    files = search_files(input_dir)
-    
-    
-    # 2. --- Generate the mapping commands.
-    #        From the information of the files, generate the commands
-    #        needed.
+def assemble_script(commands: List[str], 
+                    ram: int = 8, 
+                    cores: int = 1,
+                    batches: Optional[List[List[int]]] = None,
+                    concurrency: int = 1,
+                    stall_minutes: float = STALL_MINUTES,
+                    idx_prefix: Optional[str] = None,
+                    index_cache: Optional[str] = None,
+                    prewarm: bool = False,
+                    scratch: bool = False) -> str:
+    """Assemble the job array script that executes the commands.
     
-    commands = list(assemble_commands(files,
-                                      idx_prefix,
-                                      output_dir))
-    
-    
-    # 3. --- Assemble the mapping script.
-    #        Create the script that will launch the paralell jobs.
+    Input:
+        commands: The commands to be executed.
+        ram: RAM amount per task (in Gb).
+        cores: The number of cores per command.
+        batches: The ids of the commands executed by each task, as returned 
+                 from 'jobs.batch_commands'. Default: one command per task.
+        concurrency: How many commands of a task are executed at the same time.
+        stall_minutes: Minutes without progress before killing a command.
+        idx_prefix: The prefix of the genome index files used in the commands.
+        index_cache: A local directory of the nodes where to copy the index
+                     before mapping (see `index_cache.py`).
+        prewarm: Whether to read the index into the page cache before mapping.
+        scratch: Whether to execute the commands in the local scratch of the node.
+    Output: The contents of the script.
+    """
+    batches = batches if batches else [[i+1] for i in range(len(commands))]
+    slots = int(cores) * int(concurrency)
+    
+    if idx_prefix and (index_cache or prewarm):
+        # The commands are executed with the local copy of the index
+        cache_dir = f"'{index_cache}'" if index_cache else None
+        index_str = "\n    ".join([
+            "from index_cache import stage_index",
+            "replace = dict()",
+            "if not all(command_up_to_date(command, 'rnaseq_map') for command in batch):",
+            f"    local_prefix = stage_index('{idx_prefix}', {cache_dir}, prewarm_index={prewarm})",
+            f"    replace = {{'{idx_prefix}': local_prefix}}"])
+    else:
+        index_str = "replace = dict()"
+
     python3_exec_path = get_output('which python3')
+    pipeline_dir = Path(__file__).resolve().parent
     
     # We want every command to be associated to a job id.
     # (we add one to i because job ids start from 1) 
     commands_str = "\n    ".join( f"commands[{i+1}]='{s}'" 
                                   for i,s in enumerate(commands) )
+    batches_str = "\n    ".join( f"batches[{i+1}]={b}" 
+                                 for i,b in enumerate(batches) )
     
     # vvvvvv This is the script to be generated
     script_contents = f"""\
@@ -276,11 +462,14 @@ def main(input_dir, output_dir, idx_prefix, ram):
     # Pass environment
     #$ -V
     
+    #$ -pe openmp {slots}
+    #export OMP_NUM_THREADS={slots}
+    
     # Specify available RAM per process, per core.
     #$ -l vf={ram}G
     
     # Use as many jobs as needed
-    #$ -t 1-{len(commands)}
+    #$ -t 1-{len(batches)}
     
     
     '''
@@ -293,53 +482,271 @@ def main(input_dir, output_dir, idx_prefix, ram):
 
     '''
     import os
-    import subprocess
-    import maya
-    from pathlib import Path
+    import sys
+    
+    # The pipeline modules are in the directory of the generator script
+    sys.path.insert(0, '{pipeline_dir}')
+    from tasks import execute_batch, task_exit_code, command_up_to_date
     
     
     # The commands to be executed
     commands = dict()
     {commands_str}
     
+    # The ids of the commands executed by each job
+    batches = dict()
+    {batches_str}
+    
     # Fetch the job id
     task_id = int( os.environ['SGE_TASK_ID'] )
     
-    # Fetch the command corresponding to the current job
-    command = commands[task_id]
-    
-    # Get the name of the output file for the current job
-    output_file = command.split()[command.split().index("-S") + 1]
-    
-    # Execute the job
-    if Path(output_file).exists():
-        print(f'Task {{task_id}}. Output file already exists:', output_file, flush=True)
-    
-    else:
-        print(f'Task {{task_id}}. Executing command @', maya.now(), ':', command, flush=True)
-
-        subprocess.run(command.split()) # <-- Here it is executed, splitting is 
-                                        #     necessary to pass the arguments 
-                                        #     appropriately                            
-        print(f'Task {{task_id}}. Finished execution @', maya.now(), flush=True)
+    # The commands corresponding to the current job.
+    batch = [commands[i] for i in batches[task_id]]
+    
+    # The genome index to use, a copy in the node if requested (see `index_cache.py`).
+    #   -> Only staged if some command is executed.
+    {index_str}
+    
+    # Execute the commands.
+    #   -> Each one is skipped if it was already executed with the same inputs, 
+    #      parameters and tool versions (see `tasks.py`).
+    exit_code = execute_batch(batch, 
+                              task_id, 
+                              stage='rnaseq_map', 
+                              concurrency={concurrency},
+                              stall_minutes={stall_minutes},
+                              replace=replace,
+                              scratch={scratch})
+    
+    # An aborted command keeps the tasks of the next stages on hold (see `tasks.py`).
+    sys.exit(task_exit_code(exit_code))
     """
     # Remove indentation
-    script_contents = textwrap.dedent(script_contents)
-
-
+    return textwrap.dedent(script_contents)
+# ---
 
-    # 4. --- Write the mapping script to a file.
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
 
-    script_name = 'script.autogenerated.rnaseq_map_jobs.py'
+# Command line interface
+@click.command()
 
-    with open(script_name, 'w') as outf:
-        outf.write(script_contents)
+@click.option('--input_dir', '-i',
+              help='The directory where the input files reside.'
+                   ' Default "./trimmed".')
 
+@click.option('--output_dir', '-o',
+              help='The directory where to output the results.'
+                   ' Default "./mapped".')
 
+@click.option('--idx_prefix', '-p',
+              help='The prefix of the genome index files.'
+                   ' Default "./index/grcm38_snp_tran/genome_snp_tran".')
 
-    # 5. --- Execute the script
+@click.option('--ram', '-r', 
+              help='RAM amount per job (in Gb). Default 8.')
 
-    run(f"qsub {script_name}")
+@click.option('--sort', '-s', is_flag=True,
+              help='Pipe the mapping directly into "samtools sort" and write'
+                   ' only the sorted BAM files (no intermediate SAM files).')
+
+@click.option('--cores', '-c',
+              help='The number of cores to use per process (HISAT2, and'
+                   ' "samtools sort" with --sort). Default 1.')
+
+@click.option('--group_by', '-g',
+              help='How to group the chunks of paired files mapped by each'
+                   ' HISAT2 run, so that the index is loaded only once for'
+                   ' all of them: "chunk" (a run per chunk), "sample" (a run'
+                   ' per sample) or a number of chunks. Default "chunk".')
+
+@click.option('--collapse', '-C', is_flag=True,
+              help='Collapse the duplicate reads of each chunk before mapping,'
+                   ' and tag the alignments with the number of copies'
+                   ' (see `collapse.py`).')
+
+@click.option('--contaminants', '-K',
+              help='A FASTA file with the sequences of the contaminants (e.g.'
+                   ' the ribosomal RNA). The reads sharing k-mers with them'
+                   ' are not mapped (see `kmer_filter.py`). Default: Map'
+                   ' every read.')
+
+@click.option('--min_alignment_rate', '-R',
+              help='Abort the mapping of a chunk if the alignment rate (in %)'
+                   ' of its first reads is lower (see `alignment_monitor.py`).'
+                   ' Default: Map every chunk to the end.')
+
+@click.option('--check_reads', '-N',
+              help='How many reads are checked with --min_alignment_rate.'
+                   f' Default {CHECK_READS}.')
+
+@click.option('--index_cache', '-k',
+              help='A directory in the local disk (or tmpfs, e.g. /dev/shm) of'
+                   ' the nodes where to keep a copy of the genome index, so it'
+                   ' is read from the shared filesystem only once per node'
+                   ' (see `index_cache.py`). Default: No copy.')
+
+@click.option('--prewarm', '-P', is_flag=True,
+              help='Read the genome index into the page cache of the node'
+                   ' before mapping.')
+
+@click.option('--batch_size', '-b',
+              help='The number of commands executed by each task. Default 1.')
+
+@click.option('--target_task_minutes', '-m',
+              help='Group the commands so that each task takes about this many'
+                   ' minutes (estimated from the size of the input files).'
+                   ' Overrides --batch_size.')
+
+@click.option('--batch_concurrency', '-j',
+              help='How many of the commands of a task are executed at the'
+                   ' same time. Default 1.')
+
+@click.option('--auto_resources', '-A', is_flag=True,
+              help='Predict the RAM and cores of each task from the previous'
+                   ' runs of the stage (see `jobs.py`), and submit a job array'
+                   ' for each group of tasks needing the same resources.'
+                   ' Overrides --ram and --cores.')
+
+@click.option('--stall_minutes', '-w',
+              help='Kill a command when neither its output files nor its CPU'
+                   ' time grow in this many minutes, and execute its task'
+                   ' again (see `tasks.py`). Default 60.')
+
+@click.option('--scratch', '-T', is_flag=True,
+              help='Copy the input files to the local scratch directory of'
+                   ' the node ($TMPDIR), execute the commands there and move'
+                   ' the outputs back (see `tasks.py`).')
+
+@click.option('--executor', '-e', type=click.Choice(['sge', 'local']),
+              help='Where to run the tasks: submit them to the SGE queue (qsub)'
+                   ' or run them in a pool of processes in the current machine.'
+                   ' Default "sge".')
+    
+def main(input_dir, output_dir, idx_prefix, ram, sort, cores, group_by, collapse, contaminants,
+         min_alignment_rate, check_reads, index_cache, prewarm, batch_size, target_task_minutes, batch_concurrency, auto_resources, stall_minutes, scratch, executor):
+    """Assemble the script with the commands for trimming and submit (qsub) it."""
+    
+    input_dir = Path(input_dir 
+                         if input_dir 
+                         else './trimmed').resolve()
+    output_dir = Path(output_dir 
+                          if output_dir 
+                          else './mapped').resolve()
+    
+    if not idx_prefix:
+        index_dir = Path('./index/grcm38_snp_tran/').resolve()
+        idx_prefix = str(index_dir / 'genome_snp_tran') # The / is for appending to the path object.
+    
+    contaminants = str(Path(contaminants).resolve()) if contaminants else None
+    min_alignment_rate = float(min_alignment_rate) if min_alignment_rate else None
+    check_reads = int(check_reads) if check_reads else CHECK_READS
+    ram = ram if ram else 8
+    cores = cores if cores else 1
+    group_by = group_by if group_by else 'chunk'
+    batch_size = batch_size if batch_size else 1
+    batch_concurrency = batch_concurrency if batch_concurrency else 1
+    stall_minutes = stall_minutes if stall_minutes else STALL_MINUTES
+    executor = executor if executor else 'sge'
+    
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    Output directory: {output_dir}\n'
+          f'    Index prefix: {idx_prefix}\n'
+          f'    Sort output into BAM: {sort}\n'
+          f'    Cores per task: {cores}\n'
+          f'    RAM per process: {ram}\n'
+          f'    Chunks per mapping: {group_by}\n'
+          f'    Collapse duplicate reads: {collapse}\n'
+          f'    Contaminants: {contaminants}\n'
+          f'    Minimum alignment rate: {min_alignment_rate}\n'
+          f'    Reads checked: {check_reads}\n'
+          f'    Index cache: {index_cache}\n'
+          f'    Prewarm index: {prewarm}\n'
+          f'    Commands per task: {batch_size}\n'
+          f'    Target minutes per task: {target_task_minutes}\n'
+          f'    Commands at the same time: {batch_concurrency}\n'
+          f'    Predict resources: {auto_resources}\n'
+          f'    Minutes without progress before requeueing: {stall_minutes}\n'
+          f'    Stage files in local scratch: {scratch}\n'
+          f'    Executor: {executor}')
+    
+    # 1. --- Find the data to map.
+    #        The data is in the directory "../RNAseq_data" (a symbolic link to the actual data.)
+    #        Here we fetch information of the files containing the data, whether they are paired 
+    #        and their location in the filesystem.
+    files = search_files(input_dir)
+    
+    
+    # 2. --- Generate the mapping commands.
+    #        From the information of the files, generate the commands
+    #        needed.
+    
+    commands = list(assemble_commands(files,
+                                      idx_prefix,
+                                      output_dir,
+                                      sort,
+                                      cores,
+                                      group_by,
+                                      collapse,
+                                      contaminants,
+                                      min_alignment_rate,
+                                      check_reads))
+    
+    if contaminants:
+        # The k-mers of the contaminants are indexed once, not by every task
+        load_index(contaminants)
+    
+    
+    # 3. --- Assemble the script.
+    #        Create the script that will launch the paralell jobs.
+    #        The commands are grouped in batches, each one executed by a task.
+    #        With --auto_resources, a script is made for each group of commands
+    #        needing the same resources.
+    groups = resource_groups(commands, 
+                             'rnaseq_map', 
+                             ram, 
+                             cores, 
+                             auto_resources)
+
+    for group_ram, group_cores, ids in groups:
+        batches = batch_commands(commands, 
+                                 batch_size, 
+                                 target_task_minutes, 
+                                 stage='rnaseq_map',
+                                 ids=ids)
+        # The commands use the cores requested for them
+        script_contents = assemble_script([with_threads(c, group_cores) for c in commands],
+                                          group_ram, group_cores, 
+                                          batches, batch_concurrency,
+                                          stall_minutes=stall_minutes,
+                                          idx_prefix=idx_prefix,
+                                          index_cache=index_cache,
+                                          prewarm=prewarm,
+                                          scratch=scratch)
+
+
+
+        # 4. --- Write the mapping script to a file.
+
+        script_name = script_file('script.autogenerated.rnaseq_map_jobs.py',
+                                  group_ram, 
+                                  group_cores, 
+                                  len(groups))
+
+        with open(script_name, 'w') as outf:
+            outf.write(script_contents)
+
+
+
+        # 5. --- Execute the script
+
+        if executor == 'local':
+            run_local(script_name, 
+                      len(batches), 
+                      int(group_cores) * int(batch_concurrency), 
+                      group_ram)
+        else:
+            run(f"qsub {script_name}")
 # ---
 
 
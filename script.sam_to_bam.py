@@ -21,6 +21,10 @@ The data
 --------
 The input data for the current script are the SAM files resulting of the
 alignment of the RNAseq expression data to the reference genome.
+
+NOTE: If the mapping was done with the `--sort` flag of `script.rnaseq_map.py`,
+the sorted BAM files are already produced by the mapping tasks and this step
+is not needed.
     
 The analysis
 ------------
@@ -47,7 +51,10 @@ import click
 import textwrap
 import subprocess
 from pathlib import Path
-from typing import Union, List, Generator, Iterable
+from typing import Union, List, Generator, Iterable, Optional
+
+from jobs import run_local, batch_commands, resource_groups, script_file
+from tasks import STALL_MINUTES
 
 
 def get_output(command: Union[str, List[str]], **kwargs) -> str:
@@ -102,70 +109,38 @@ def assemble_commands(sam_files: Iterable[Union[str, Path]],
         yield f'samtools sort -@ {n_cores} -o {output_file} {sam_file}'
 # ---
 
-#### <<<<<< MAIN PROCEDURE >>>>>>> ####
-
-# Command line interface
-@click.command()
-
-@click.option('--input_dir', '-i',
-              help='The directory where the input files reside.'
-                   ' Default "./mapped".')
-
-@click.option('--output_dir', '-o',
-              help='The directory where to output the results.'
-                   ' Default "./mapped".')
-
-@click.option('--cores', '-p',
-              help='The number of cores to use per process.'
-                   ' Default 1.')
-
-@click.option('--ram', '-r', 
-              help='RAM amount per job (in Gb). Default 8.')
-    
-def main(input_dir, output_dir, cores, ram):
-    """Assemble the script with the commands for trimming and submit (qsub) it."""
-    
-    input_dir = Path(input_dir 
-                         if input_dir 
-                         else './mapped').resolve()
-    output_dir = Path(output_dir 
-                          if output_dir 
-                          else './mapped').resolve()
+def assemble_script(commands: List[str], 
+                    ram: int = 8, 
+                    cores: int = 1,
+                    batches: Optional[List[List[int]]] = None,
+                    concurrency: int = 1,
+                    stall_minutes: float = STALL_MINUTES,
+                    scratch: bool = False) -> str:
+    """Assemble the job array script that executes the commands.
     
-    cores = cores if cores else 1
-    ram = ram if ram else 8
-    
-    print( 'Resolved parameters: \n'
-          f'    Input directory: {input_dir}\n'
-          f'    Output directory: {output_dir}\n'
-          f'    Cores per task: {cores}\n'
-          f'    RAM per process: {ram}')
-    
-    # 1. --- Find the files to convert.
-    #        The data is in the directory "./map" 
-    #        Here we fetch the location of the files in the filesystem.
-    input_files = search_files(input_dir)
-
-
-
-    # 2. --- Generate the conversion commands.
-    #        From the information of the files, generate the commands
-    #        needed.
-    commands = list(assemble_commands(input_files,
-                                      output_dir,
-                                      cores))
-
-
-
-    # 3. --- Assemble the script.
-    #        Create the script that will launch the paralell jobs.
+    Input:
+        commands: The commands to be executed.
+        ram: RAM amount per task (in Gb).
+        cores: The number of cores per command.
+        batches: The ids of the commands executed by each task, as returned 
+                 from 'jobs.batch_commands'. Default: one command per task.
+        concurrency: How many commands of a task are executed at the same time.
+        stall_minutes: Minutes without progress before killing a command.
+        scratch: Whether to execute the commands in the local scratch of the node.
+    Output: The contents of the script.
+    """
+    batches = batches if batches else [[i+1] for i in range(len(commands))]
+    slots = int(cores) * int(concurrency)
 
     python3_exec_path = get_output('which python3')
+    pipeline_dir = Path(__file__).resolve().parent
 
     # We want every command to be associated to a job id.
     # (we add one to i because job ids start from 1) 
     commands_str = "\n    ".join( f"commands[{i+1}]='{s}'" 
                                   for i,s in enumerate(commands) )
+    batches_str = "\n    ".join( f"batches[{i+1}]={b}" 
+                                 for i,b in enumerate(batches) )
 
     script_contents = f"""\
     #! {python3_exec_path}
@@ -188,14 +163,14 @@ def main(input_dir, output_dir, cores, ram):
     # Pass environment
     #$ -V
 
-    #$ -pe openmp {cores}
-    #export OMP_NUM_THREADS={cores}
+    #$ -pe openmp {slots}
+    #export OMP_NUM_THREADS={slots}
 
     # Work with {ram}G RAM per process
     #$ -l vf={ram}G
 
     # Use as many jobs as needed
-    #$ -t 1-{len(commands)}
+    #$ -t 1-{len(batches)}
 
     '''
     Convert SAM files to BAM
@@ -207,54 +182,186 @@ def main(input_dir, output_dir, cores, ram):
     '''
 
     import os
-    import maya
-    import subprocess
-    from pathlib import Path
-
-
+    import sys
+    
+    # The pipeline modules are in the directory of the generator script
+    sys.path.insert(0, '{pipeline_dir}')
+    from tasks import execute_batch, task_exit_code
+    
+    
     # The commands to be executed
     commands = dict()
     {commands_str}
-
+    
+    # The ids of the commands executed by each job
+    batches = dict()
+    {batches_str}
+    
     # Fetch the job id
     task_id = int( os.environ['SGE_TASK_ID'] )
+    
+    # Execute the commands corresponding to the current job.
+    #   -> Each one is skipped if it was already executed with the same inputs, 
+    #      parameters and tool versions (see `tasks.py`).
+    exit_code = execute_batch([commands[i] for i in batches[task_id]], 
+                              task_id, 
+                              stage='sam_to_bam', 
+                              concurrency={concurrency},
+                              stall_minutes={stall_minutes},
+                              scratch={scratch})
+    
+    # An aborted command keeps the tasks of the next stages on hold (see `tasks.py`).
+    sys.exit(task_exit_code(exit_code))
+    """
+    # Remove indentation
+    return textwrap.dedent(script_contents)
+# ---
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+# Command line interface
+@click.command()
+
+@click.option('--input_dir', '-i',
+              help='The directory where the input files reside.'
+                   ' Default "./mapped".')
+
+@click.option('--output_dir', '-o',
+              help='The directory where to output the results.'
+                   ' Default "./mapped".')
 
-    # Fetch the command corresponding to the current job
-    command = commands[task_id]
+@click.option('--cores', '-p',
+              help='The number of cores to use per process.'
+                   ' Default 1.')
 
-    # Get the name of the output file
-    #   -> The output file is the next string after the '-o' argument
-    output_file = command.split()[command.split().index('-o') + 1]
+@click.option('--ram', '-r', 
+              help='RAM amount per job (in Gb). Default 8.')
 
-    # Execute the job
-    if Path(output_file).exists():
-        print(f'Task {{task_id}}. Output file already exists:', output_file, flush=True)
+@click.option('--batch_size', '-b',
+              help='The number of commands executed by each task. Default 1.')
+
+@click.option('--target_task_minutes', '-m',
+              help='Group the commands so that each task takes about this many'
+                   ' minutes (estimated from the size of the input files).'
+                   ' Overrides --batch_size.')
+
+@click.option('--batch_concurrency', '-j',
+              help='How many of the commands of a task are executed at the'
+                   ' same time. Default 1.')
+
+@click.option('--auto_resources', '-A', is_flag=True,
+              help='Predict the RAM and cores of each task from the previous'
+                   ' runs of the stage (see `jobs.py`), and submit a job array'
+                   ' for each group of tasks needing the same resources.'
+                   ' Overrides --ram and --cores.')
+
+@click.option('--stall_minutes', '-w',
+              help='Kill a command when neither its output files nor its CPU'
+                   ' time grow in this many minutes, and execute its task'
+                   ' again (see `tasks.py`). Default 60.')
+
+@click.option('--scratch', '-T', is_flag=True,
+              help='Copy the input files to the local scratch directory of'
+                   ' the node ($TMPDIR), execute the commands there and move'
+                   ' the outputs back (see `tasks.py`).')
+
+@click.option('--executor', '-e', type=click.Choice(['sge', 'local']),
+              help='Where to run the tasks: submit them to the SGE queue (qsub)'
+                   ' or run them in a pool of processes in the current machine.'
+                   ' Default "sge".')
+    
+def main(input_dir, output_dir, cores, ram,
+         batch_size, target_task_minutes, batch_concurrency, auto_resources, stall_minutes, scratch, executor):
+    """Assemble the script with the commands for trimming and submit (qsub) it."""
     
-    else:
-        print(f'Task {{task_id}}. Executing command @', maya.now(), ':', command, flush=True)
+    input_dir = Path(input_dir 
+                         if input_dir 
+                         else './mapped').resolve()
+    output_dir = Path(output_dir 
+                          if output_dir 
+                          else './mapped').resolve()
+    
+    cores = cores if cores else 1
+    ram = ram if ram else 8
+    batch_size = batch_size if batch_size else 1
+    batch_concurrency = batch_concurrency if batch_concurrency else 1
+    stall_minutes = stall_minutes if stall_minutes else STALL_MINUTES
+    executor = executor if executor else 'sge'
+    
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    Output directory: {output_dir}\n'
+          f'    Cores per task: {cores}\n'
+          f'    RAM per process: {ram}\n'
+          f'    Commands per task: {batch_size}\n'
+          f'    Target minutes per task: {target_task_minutes}\n'
+          f'    Commands at the same time: {batch_concurrency}\n'
+          f'    Predict resources: {auto_resources}\n'
+          f'    Minutes without progress before requeueing: {stall_minutes}\n'
+          f'    Stage files in local scratch: {scratch}\n'
+          f'    Executor: {executor}')
+    
+    # 1. --- Find the files to convert.
+    #        The data is in the directory "./map" 
+    #        Here we fetch the location of the files in the filesystem.
+    input_files = search_files(input_dir)
 
-        subprocess.run(command.split()) # <-- Here it is executed, splitting is 
-                                        #     necessary to pass the arguments 
-                                        #     appropriately                            
-        print(f'Task {{task_id}}. Finished execution @', maya.now(), flush=True)
-    """
-    # Remove indentation
-    script_contents = textwrap.dedent(script_contents)
+
+
+    # 2. --- Generate the conversion commands.
+    #        From the information of the files, generate the commands
+    #        needed.
+    commands = list(assemble_commands(input_files,
+                                      output_dir,
+                                      cores))
+
+
+
+    # 3. --- Assemble the script.
+    #        Create the script that will launch the paralell jobs.
+    #        The commands are grouped in batches, each one executed by a task.
+    #        With --auto_resources, a script is made for each group of commands
+    #        needing the same resources.
+    groups = resource_groups(commands, 
+                             'sam_to_bam', 
+                             ram, 
+                             cores, 
+                             auto_resources)
+
+    for group_ram, group_cores, ids in groups:
+        batches = batch_commands(commands, 
+                                 batch_size, 
+                                 target_task_minutes, 
+                                 stage='sam_to_bam',
+                                 ids=ids)
+        script_contents = assemble_script(commands, group_ram, group_cores, 
+                                          batches, batch_concurrency,
+                                          stall_minutes=stall_minutes,
+                                          scratch=scratch)
 
 
 
-    # 4. --- Write the mapping script to a file.
+        # 4. --- Write the script to a file.
 
-    script_name = 'script.autogenerated.sam_to_bam_jobs.py'
+        script_name = script_file('script.autogenerated.sam_to_bam_jobs.py',
+                                  group_ram, 
+                                  group_cores, 
+                                  len(groups))
 
-    with open(script_name, 'w') as outf:
-        outf.write(script_contents)
+        with open(script_name, 'w') as outf:
+            outf.write(script_contents)
 
 
 
-    # 5. --- Execute the script
+        # 5. --- Execute the script
 
-    run(f"qsub {script_name}")
+        if executor == 'local':
+            run_local(script_name, 
+                      len(batches), 
+                      int(group_cores) * int(batch_concurrency), 
+                      group_ram)
+        else:
+            run(f"qsub {script_name}")
 # ---
 
 
@@ -0,0 +1,126 @@
+#! /bin/env python3
+
+"""
+Trimming the reads with NumPy, as Trimmomatic
+=============================================
+
+Author: Andrés García García @ Sept 2018
+
+About the project
+-----------------
+We are trying to detect if there are changes in the expression of
+long non-coding RNAs between the left and right hemisphere of a mouse's
+brain (telencephalon). For this, 3 samples where taken and sequenced using
+RNAseq. For more information about RNAseq, see:
+https://galaxyproject.org/tutorials/rb_rnaseq/
+
+
+The analysis
+------------
+An alternative to Trimmomatic (see `trim.py`), taking the same arguments, so
+that `script.trimming.py --engine numpy` only changes the program of the
+commands:
+
+    script.trim.py SE [-threads N] [-phred33|-phred64] [-summary <file>] \\
+                   <input> <output> <steps>
+    script.trim.py PE [-threads N] [-phred33|-phred64] [-summary <file>] \\
+                   <input 1> <input 2> \\
+                   <forward paired> <forward unpaired> \\
+                   <reverse paired> <reverse unpaired> <steps>
+
+With '-' as the only output, the kept reads are written to the standard
+output instead, the pairs interleaved (the unpaired reads are discarded), to
+be piped to HISAT2 (see `script.pipeline.py --fused`).
+
+The steps supported are ILLUMINACLIP, LEADING, TRAILING, SLIDINGWINDOW,
+MINLEN, CROP and HEADCROP. Without steps, the output files are just links to
+the input files (see 'probe_command' in `trim.py`).
+
+To check the results against the ones of Trimmomatic on the same input:
+
+    script.trim.py compare <trimmed by Trimmomatic> <trimmed by script.trim.py>
+
+"""
+
+import sys
+import json
+
+from trim import trim_files, compare_trimming, parse_arguments, link_files, write_summary, VERSION
+from fastq import read_records
+
+
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
+
+def main(args):
+    """Trim the reads with the given arguments (as Trimmomatic)."""
+
+    if not args or args[0] in ('-h', '--help'):
+        print(__doc__)
+        return 0
+
+    if args[0] == '-version':
+        print(VERSION)
+        return 0
+
+    if args[0] == 'compare':
+        print(json.dumps(compare_trimming(*args[1:3]), indent=1))
+        return 0
+
+    mode, threads, phred_offset, inputs, outputs, steps, summary = parse_arguments(args)
+
+    if mode not in ('SE', 'PE') or len(outputs) not in ((1,) if mode == 'SE' else (1, 4)) \
+                                or (mode == 'PE' and len(outputs) == 1 and outputs != ['-']):
+        print(f'Wrong arguments: {" ".join(args)}\n{__doc__}', file=sys.stderr)
+        return 1
+
+    print( 'Resolved parameters: \n'
+          f'    Mode: {mode}\n'
+          f'    Processes: {threads}\n'
+          f'    Phred offset: {phred_offset}\n'
+          f'    Input files: {" ".join(inputs)}\n'
+          f'    Output files: {" ".join(outputs)}\n'
+          f'    Steps: {" ".join(steps)}', file=sys.stderr)
+
+
+    # 1. --- Trim the reads.
+    #        ... nothing to do without steps, unless streaming them.
+    if not steps and '-' not in outputs:
+        link_files(inputs, outputs)
+        if summary:
+            # Every read survives
+            n_reads = sum(len(lines) for lines in read_records(inputs[0])) // 4
+            write_summary(summary, {'input': n_reads,
+                                    'surviving': [n_reads] if mode == 'SE' else [n_reads, 0, n_reads, 0]})
+        print(f'No trimming steps, {" ".join(outputs)} linked to the inputs.\n'
+               'Completed successfully', file=sys.stderr)
+        return 0
+
+    counts = trim_files(mode, inputs, outputs, steps, threads, phred_offset)
+
+
+    # 2. --- Report, as Trimmomatic.
+    if summary:
+        write_summary(summary, counts)
+
+    total = max(counts['input'], 1)
+    percent = lambda n: f'{n} ({100 * n / total:.2f}%)'
+    if mode == 'SE':
+        kept, = counts['surviving']
+        print(f'Input Reads: {counts["input"]} Surviving: {percent(kept)}'
+              f' Dropped: {percent(counts["input"] - kept)}', file=sys.stderr)
+    else:
+        both, forward, _, reverse = counts['surviving']
+        print(f'Input Read Pairs: {counts["input"]} Both Surviving: {percent(both)}'
+              f' Forward Only Surviving: {percent(forward)}'
+              f' Reverse Only Surviving: {percent(reverse)}'
+              f' Dropped: {percent(counts["input"] - both - forward - reverse)}', file=sys.stderr)
+
+    print('Completed successfully', file=sys.stderr)
+    return 0
+# ---
+
+
+
+if __name__ == '__main__':
+    # Command line interface, as Trimmomatic's
+    sys.exit(main(sys.argv[1:]))
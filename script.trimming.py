@@ -40,6 +40,25 @@ enqueue the job through the SGE tasks system, this is done by specifying the tas
 That is the script that is generated here and submitted to the queue system through 'qsub' at 
 the end of this file.
 
+With '--engine numpy', the commands run `script.trim.py` instead of Trimmomatic,
+with the same arguments. It applies the same steps to chunks of reads with
+NumPy (see `trim.py`), in as many processes as '--cores', and without starting
+a Java virtual machine for each chunk.
+
+The default adapters file has the adapters of every TruSeq and Nextera kit,
+and every read is tested against all of them. With '--detect_adapters', the
+adapters present in the first reads of each sample (the 'mmXY' prefix of the
+files) are found before trimming (see `trim.py`), and written to a minimal
+adapters file per sample (<output dir>/adapters/<sample>.fa), used by the
+commands of that sample.
+
+With '--skip_clean', each task first probes the first reads of its chunks
+that are not up to date (see `trim.py`): the chunks where few reads have adapters or low quality
+ends are not trimmed. Their outputs are links to the inputs (or, if some
+reads are shorter than MINLEN, only the MINLEN step is applied), instead of
+writing again the whole chunk. The manifest records the trimming command,
+so the chunks left untrimmed are trimmed again without '--skip_clean'.
+
 """
 
 import re
@@ -48,7 +67,13 @@ import textwrap
 import subprocess
 from itertools import chain
 from pathlib import Path
-from typing import Union, Generator, Iterable, List
+from typing import Union, Generator, Iterable, List, Optional, Dict, Tuple
+
+from jobs import run_local, batch_commands, resource_groups, script_file
+from tasks import STALL_MINUTES
+from trim import (read_fasta, write_fasta, detect_adapters, 
+                  CLEAN_ADAPTER_RATE, CLEAN_LOW_QUALITY_RATE)
+from fastq import sample_of
 
 
 def get_output(command: Union[str, List[str]], **kwargs) -> str:
@@ -119,15 +144,110 @@ def search_files(data_path: Union[str, Path]):
             'unpaired': loners}
 # ---
 
+def unpaired_output(unpaired_f: Union[str, Path], 
+                    output_path: Union[str, Path]) -> str:
+    """The name of the trimmed file for an unpaired input file."""
+    output = re.sub('fastq$','trimmed.fastq', Path(unpaired_f).name)
+    
+    return str(Path(output_path) / output)
+# ---
+
+def paired_outputs(p1: Union[str, Path], 
+                   output_path: Union[str, Path]) -> List[str]:
+    """The names of the trimmed files for a pair of input files.
+    
+    Output: A list with the forward paired, forward unpaired, reverse paired
+            and reverse unpaired output files, in that order (the same order
+            in which Trimmomatic expects them).
+    """
+    return [str(Path(output_path) / re.sub('_R[12]_', f'_{part}_', Path(p1).name))
+                for part in ('R1_paired', 'R1_unpaired', 'R2_paired', 'R2_unpaired')]
+# ---
+
+def mapping_inputs(files, 
+                   output_path: Union[str, Path]):
+    """The trimmed files that will be used for the mapping.
+    
+    Input:
+        files: A dictionary with the RNAseq files location and pairing information
+               as returned from the 'search_files' function.
+        output_path: The output directory of the trimming.
+    
+    Output: A dictionary with the same structure as the one returned from the
+            'search_files' function of `script.rnaseq_map.py`. The files are
+            in the same order as the commands from 'assemble_commands', so the
+            N-th mapping command uses the output of the N-th trimming command.
+    """
+    unpaired = [unpaired_output(f, output_path) for f in files['unpaired']]
+    
+    paired = []
+    for p1, p2 in files['paired']:
+        forward_paired, _, reverse_paired, _ = paired_outputs(p1, output_path)
+        paired.append((forward_paired, reverse_paired))
+    
+    return {'paired': paired,
+            'unpaired': unpaired}
+# ---
+
+def detect_sample_adapters(files, 
+                           adapters_file: str, 
+                           output_path: Union[str, Path]) -> Dict[str, str]:
+    """Find the adapters present in each sample and write them to a file per sample.
+    
+    Input:
+        files: A dictionary with the RNAseq files location and pairing information
+               as returned from the 'search_files' function.
+        adapters_file: The FASTA file with all the known adapters.
+        output_path: The output directory of the trimming. The adapters files
+                     are written to its subdirectory 'adapters'.
+    Output: The adapters file of each sample.
+    """
+    adapters = read_fasta(adapters_file)
+    adapters_dir = Path(output_path) / 'adapters'
+    adapters_dir.mkdir(parents=True, exist_ok=True)
+
+    samples = dict()
+    for file in files['unpaired'] + list(chain.from_iterable(files['paired'])):
+        samples.setdefault(sample_of(Path(file).name), []).append(file)
+
+    sample_adapters = dict()
+    for sample, sample_files in sorted(samples.items()):
+        found = detect_adapters(sorted(sample_files), adapters)
+        sample_adapters[sample] = str(adapters_dir / f'{sample}.fa')
+        write_fasta([(name, sequence) for name, sequence, _ in found], sample_adapters[sample])
+
+        found_str = ', '.join(f'{name} ({100 * fraction:.2f}% of the reads)' 
+                                  for name, _, fraction in found)
+        print(f'Adapters of {sample}: {found_str if found else "none found"}.')
+
+    return sample_adapters
+# ---
+
+def trimming_program(engine: str = 'trimmomatic') -> str:
+    """The program that trims the reads: Trimmomatic, or `script.trim.py` (engine 'numpy')."""
+    if engine == 'numpy':
+        return str(Path(__file__).resolve().parent / 'script.trim.py')
+    return 'trimmomatic'
+# ---
+
 def assemble_commands(files,
                       output_path: Union[str, Path],
-                      adapters_file: str) -> Generator[str, None, None]:
+                      adapters_file: str,
+                      engine: str = 'trimmomatic',
+                      cores: int = 1,
+                      sample_adapters: Optional[Dict[str, str]] = None) -> Generator[str, None, None]:
     """Assemble the mapping commands.
     
     Input:
         samples: A dictionary with the RNAseq files location and pairing information
                  as returned from the 'search_files' function.
         output_path: A valid Path object pointing to the output directory.
+        adapters_file: The FASTA file with the adapters.
+        engine: 'trimmomatic', or 'numpy' to use `script.trim.py` instead.
+        cores: The threads (processes, with 'numpy') of each command.
+        sample_adapters: The adapters file of each sample (see 
+                         'detect_sample_adapters'), used instead of the
+                         given one.
     
     Generates the commands that will be executed.
     
@@ -143,6 +263,12 @@ def assemble_commands(files,
             ILLUMINACLIP:{adapters_file}:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15 MINLEN:36
     """
     output_path = Path(output_path)
+    program = trimming_program(engine)
+    sample_adapters = sample_adapters if sample_adapters else dict()
+    adapters_of = lambda file : (
+                    # The adapters of the sample, if detected
+                    sample_adapters.get(sample_of(Path(file).name), adapters_file)
+                )
     
     fullpath = lambda filename : (
                     # Append the paths
@@ -154,10 +280,10 @@ def assemble_commands(files,
 
     for unpaired_f in loners:
             
-        output = re.sub('fastq$','trimmed.fastq', Path(unpaired_f).name)
+        output = unpaired_output(unpaired_f, output_path)
 
-        yield (f'trimmomatic SE -threads 1 -phred33 {unpaired_f} {fullpath(output)}'
-               f' ILLUMINACLIP:{adapters_file}:2:30:10 LEADING:3 TRAILING:3'
+        yield (f'{program} SE -threads {cores} -phred33 {unpaired_f} {output}'
+               f' ILLUMINACLIP:{adapters_of(unpaired_f)}:2:30:10 LEADING:3 TRAILING:3'
                 ' SLIDINGWINDOW:4:15 MINLEN:36')
         
     # Paired reads
@@ -165,84 +291,64 @@ def assemble_commands(files,
 
     for p1, p2 in pairs:
             
-        output_forward_paired = re.sub('_R[12]_', '_R1_paired_', Path(p1).name)
-        output_forward_unpaired = re.sub('_R[12]_', '_R1_unpaired_', Path(p1).name)
-        output_reverse_paired = re.sub('_R[12]_', '_R2_paired_', Path(p1).name)
-        output_reverse_unpaired = re.sub('_R[12]_', '_R2_unpaired_', Path(p1).name)
-
-        yield (f'trimmomatic PE -threads 1 -phred33 {fullpath(p1)} {fullpath(p2)}'
-               f' {fullpath(output_forward_paired)} {fullpath(output_forward_unpaired)}'
-               f' {fullpath(output_reverse_paired)} {fullpath(output_reverse_unpaired)}'
-               f' ILLUMINACLIP:{adapters_file}:2:30:10 LEADING:3 TRAILING:3'
+        outputs = ' '.join(paired_outputs(p1, output_path))
+
+        yield (f'{program} PE -threads {cores} -phred33 {fullpath(p1)} {fullpath(p2)}'
+               f' {outputs}'
+               f' ILLUMINACLIP:{adapters_of(p1)}:2:30:10 LEADING:3 TRAILING:3'
                 ' SLIDINGWINDOW:4:15 MINLEN:36')
 # ---
 
-#### <<<<<< MAIN PROCEDURE >>>>>>> ####
-
-# Command line interface
-@click.command()
-
-@click.option('--input_dir', '-i',
-              help='The directory where the input files reside.'
-                   ' Default: "./raw_data".')
-
-@click.option('--output_dir', '-o',
-              help='The directory where to output the results.'
-                   ' Default: "./trimmed".')
-
-@click.option('--adapters_file', '-a',
-              help='The FASTA file specifying the adapters to trimm.'
-                   ' Default: A file "all_adapters.fa" in the input folder.')
-
-@click.option('--ram', '-r', 
-              help='RAM amount per job (in Gb). Default 8.')
-
-def main(input_dir, output_dir, adapters_file, ram):
-    """Assemble the script with the commands for trimming and submit (qsub) it."""
-    
-    input_dir = Path(input_dir 
-                         if input_dir 
-                         else './raw_data').resolve()
-    output_dir = Path(output_dir 
-                          if output_dir 
-                          else './trimmed').resolve()
-    
-    adapters_file = adapters_file 
-                        if adapters_file 
-                        else str(input_dir / 'all_adapters.fa')
-    
-    ram = ram if ram else 8
+def with_threads(command: str, threads: int) -> str:
+    """The trimming command using the given number of threads (e.g. the cores
+    requested for it with --auto_resources)."""
+    return re.sub(r'-threads \d+', f'-threads {int(threads)}', command)
+# ---
 
-    print( 'Resolved parameters: \n'
-          f'    Input directory: {input_dir}\n'
-          f'    Output directory: {output_dir}\n'
-          f'    Adapters file: {adapters_file}\n'
-          f'    RAM per process: {ram}'))
+def assemble_script(commands: List[str], 
+                    ram: int = 8,
+                    batches: Optional[List[List[int]]] = None,
+                    concurrency: int = 1,
+                    cores: int = 1,
+                    stall_minutes: float = STALL_MINUTES,
+                    scratch: bool = False,
+                    skip_clean: Optional[Tuple[float, float]] = None) -> str:
+    """Assemble the job array script that executes the commands.
     
+    Input:
+        commands: The commands to be executed.
+        ram: RAM amount per task (in Gb).
+        batches: The ids of the commands executed by each task, as returned 
+                 from 'jobs.batch_commands'. Default: one command per task.
+        concurrency: How many commands of a task are executed at the same time.
+        cores: The cores used by each command.
+        stall_minutes: Minutes without progress before killing a command.
+        scratch: Whether to execute the commands in the local scratch of the node.
+        skip_clean: The maximum fraction of the reads with adapters and with
+                    low quality ends of the chunks that are not trimmed. 
+                    Default: Trim every chunk.
+    Output: The contents of the script.
+    """
+    batches = batches if batches else [[i+1] for i in range(len(commands))]
 
-    #1. --- Find the data.
-    #        Here we fetch information of the files containing the data, whether they are paired 
-    #        and their location in the filesystem.
-    files = search_files(input_dir)
-
-
-    # 2. --- Generate the commands.
-    #        From the information of the files, generate the commands
-    #        needed.
-
-    commands = list(assemble_commands(files,
-                                      output_dir,
-                                      adapters_file))
-
+    if skip_clean:
+        # The links to the inputs would point to the scratch of the node
+        probe_str = "\n    ".join([
+            "from trim import probe_command",
+            f"prepare = lambda command: probe_command(command, {skip_clean[0]}, {skip_clean[1]},"
+            f" link={not scratch})"])
+    else:
+        probe_str = "prepare = None"
 
-    # 3. --- Assemble the script.
-    #        Create the script that will launch the paralell jobs.
     python3_exec_path = get_output('which python3')
+    pipeline_dir = Path(__file__).resolve().parent
 
     # We want every command to be associated to a job id.
     # (we add one to i because job ids start from 1) 
-    commands_str = "\n".join( f"commands[{i+1}]='{s}'" 
-                              for i,s in enumerate(commands) )
+    commands_str = "\n    ".join( f"commands[{i+1}]='{s}'" 
+                                  for i,s in enumerate(commands) )
+    batches_str = "\n    ".join( f"batches[{i+1}]={b}" 
+                                 for i,b in enumerate(batches) )
 
     # vvvvvv This is the script to be generated
     script_contents = f"""\
@@ -266,11 +372,14 @@ def main(input_dir, output_dir, adapters_file, ram):
     # Pass environment
     #$ -V
 
+    # Use the cores of each command, for every command executed at the same time
+    #$ -pe openmp {int(cores) * int(concurrency)}
+
     # Specify available RAM per process, per core.
     #$ -l vf={ram}G
 
     # Use as many jobs as needed
-    #$ -t 1-{len(commands)}
+    #$ -t 1-{len(batches)}
 
 
     '''
@@ -283,45 +392,249 @@ def main(input_dir, output_dir, adapters_file, ram):
 
     '''
     import os
-    import subprocess
-    import maya
-    from pathlib import Path
-
-
+    import sys
+    
+    # The pipeline modules are in the directory of the generator script
+    sys.path.insert(0, '{pipeline_dir}')
+    from tasks import execute_batch, task_exit_code
+    
+    
     # The commands to be executed
     commands = dict()
     {commands_str}
-
+    
+    # The ids of the commands executed by each job
+    batches = dict()
+    {batches_str}
+    
     # Fetch the job id
     task_id = int( os.environ['SGE_TASK_ID'] )
+    
+    # The commands corresponding to the current job.
+    batch = [commands[i] for i in batches[task_id]]
+    
+    # With --skip_clean, the clean chunks are not trimmed (see `trim.py`).
+    {probe_str}
+    
+    # Execute the commands.
+    #   -> Each one is skipped if it was already executed with the same inputs, 
+    #      parameters and tool versions (see `tasks.py`). Otherwise, its chunk
+    #      is probed first with --skip_clean.
+    exit_code = execute_batch(batch, 
+                              task_id, 
+                              stage='trimming', 
+                              concurrency={concurrency},
+                              stall_minutes={stall_minutes},
+                              scratch={scratch},
+                              prepare=prepare)
+    
+    # An aborted command keeps the tasks of the next stages on hold (see `tasks.py`).
+    sys.exit(task_exit_code(exit_code))
+    """
+    # Remove indentation
+    return textwrap.dedent(script_contents)
+# ---
 
-    # Fetch the command corresponding to the current job
-    command = commands[task_id]
+#### <<<<<< MAIN PROCEDURE >>>>>>> ####
 
+# Command line interface
+@click.command()
 
-    # Execute the job
-    print(f'Task {{task_id}}. Executing command @ {{maya.now()}} : {{command}}', flush=True)
+@click.option('--input_dir', '-i',
+              help='The directory where the input files reside.'
+                   ' Default: "./raw_data".')
 
-    subprocess.run(command.split()) # <-- Here it is executed, splitting is 
-                                    #     necessary to pass the arguments 
-                                    #     appropriately                            
-    print(f'Task {{task_id}}. Finished execution @ {{maya.now()}}', flush=True)
-    """
-    # Remove indentation
-    script_contents = textwrap.dedent(script_contents)
+@click.option('--output_dir', '-o',
+              help='The directory where to output the results.'
+                   ' Default: "./trimmed".')
+
+@click.option('--adapters_file', '-a',
+              help='The FASTA file specifying the adapters to trimm.'
+                   ' Default: A file "all_adapters.fa" in the input folder.')
+
+@click.option('--detect_adapters', '-D', is_flag=True,
+              help='Find the adapters present in each sample, and trim only'
+                   ' those (see `trim.py`).')
+
+@click.option('--skip_clean', '-S', is_flag=True,
+              help='Probe the first reads of each chunk, and don\'t trim the'
+                   ' chunks with few adapters and low quality ends (see'
+                   ' `trim.py`).')
+
+@click.option('--max_adapter_rate', '-x',
+              help='With --skip_clean, the fraction of the probed reads with'
+                   f' adapters below which a chunk is clean. Default {CLEAN_ADAPTER_RATE}.')
+
+@click.option('--max_low_quality_rate', '-q',
+              help='With --skip_clean, the fraction of the probed reads with'
+                   ' low quality ends below which a chunk is clean.'
+                   f' Default {CLEAN_LOW_QUALITY_RATE}.')
+
+@click.option('--engine', '-E', type=click.Choice(['trimmomatic', 'numpy']),
+              help='The program that trims the reads: Trimmomatic, or the'
+                   ' NumPy engine `script.trim.py` (see `trim.py`).'
+                   ' Default "trimmomatic".')
+
+@click.option('--cores', '-c',
+              help='The threads (processes, with the NumPy engine) of each'
+                   ' trimming command. Default 1.')
+
+@click.option('--ram', '-r', 
+              help='RAM amount per job (in Gb). Default 8.')
+
+@click.option('--batch_size', '-b',
+              help='The number of commands executed by each task. Default 1.')
+
+@click.option('--target_task_minutes', '-m',
+              help='Group the commands so that each task takes about this many'
+                   ' minutes (estimated from the size of the input files).'
+                   ' Overrides --batch_size.')
+
+@click.option('--batch_concurrency', '-j',
+              help='How many of the commands of a task are executed at the'
+                   ' same time. Default 1.')
+
+@click.option('--auto_resources', '-A', is_flag=True,
+              help='Predict the RAM and cores of each task from the previous'
+                   ' runs of the stage (see `jobs.py`), and submit a job array'
+                   ' for each group of tasks needing the same resources.'
+                   ' Overrides --ram.')
+
+@click.option('--stall_minutes', '-w',
+              help='Kill a command when neither its output files nor its CPU'
+                   ' time grow in this many minutes, and execute its task'
+                   ' again (see `tasks.py`). Default 60.')
+
+@click.option('--scratch', '-T', is_flag=True,
+              help='Copy the input files to the local scratch directory of'
+                   ' the node ($TMPDIR), execute the commands there and move'
+                   ' the outputs back (see `tasks.py`).')
+
+@click.option('--executor', '-e', type=click.Choice(['sge', 'local']),
+              help='Where to run the tasks: submit them to the SGE queue (qsub)'
+                   ' or run them in a pool of processes in the current machine.'
+                   ' Default "sge".')
+
+def main(input_dir, output_dir, adapters_file, detect_adapters, 
+         skip_clean, max_adapter_rate, max_low_quality_rate, engine, cores, ram,
+         batch_size, target_task_minutes, batch_concurrency, auto_resources, stall_minutes, scratch, executor):
+    """Assemble the script with the commands for trimming and submit (qsub) it."""
+    
+    input_dir = Path(input_dir 
+                         if input_dir 
+                         else './raw_data').resolve()
+    output_dir = Path(output_dir 
+                          if output_dir 
+                          else './trimmed').resolve()
+    
+    adapters_file = (adapters_file 
+                        if adapters_file 
+                        else str(input_dir / 'all_adapters.fa'))
     
+    max_adapter_rate = float(max_adapter_rate) if max_adapter_rate else CLEAN_ADAPTER_RATE
+    max_low_quality_rate = (float(max_low_quality_rate) 
+                                if max_low_quality_rate 
+                                else CLEAN_LOW_QUALITY_RATE)
+    engine = engine if engine else 'trimmomatic'
+    cores = int(cores) if cores else 1
+    ram = ram if ram else 8
+    batch_size = batch_size if batch_size else 1
+    batch_concurrency = batch_concurrency if batch_concurrency else 1
+    stall_minutes = stall_minutes if stall_minutes else STALL_MINUTES
+    executor = executor if executor else 'sge'
 
-    # 4. --- Write the script to a file.
+    print( 'Resolved parameters: \n'
+          f'    Input directory: {input_dir}\n'
+          f'    Output directory: {output_dir}\n'
+          f'    Adapters file: {adapters_file}\n'
+          f'    Detect the adapters of each sample: {detect_adapters}\n'
+          f'    Skip clean chunks: {skip_clean}\n'
+          f'    Maximum adapter rate of clean chunks: {max_adapter_rate}\n'
+          f'    Maximum low quality rate of clean chunks: {max_low_quality_rate}\n'
+          f'    Trimming engine: {engine}\n'
+          f'    Cores per command: {cores}\n'
+          f'    RAM per process: {ram}\n'
+          f'    Commands per task: {batch_size}\n'
+          f'    Target minutes per task: {target_task_minutes}\n'
+          f'    Commands at the same time: {batch_concurrency}\n'
+          f'    Predict resources: {auto_resources}\n'
+          f'    Minutes without progress before requeueing: {stall_minutes}\n'
+          f'    Stage files in local scratch: {scratch}\n'
+          f'    Executor: {executor}')
+    
 
-    script_name = 'script.autogenerated.trimming_jobs.py'
+    #1. --- Find the data.
+    #        Here we fetch information of the files containing the data, whether they are paired 
+    #        and their location in the filesystem.
+    files = search_files(input_dir)
 
-    with open(script_name, 'w') as outf:
-        outf.write(script_contents)
 
+    # 2. --- Generate the commands.
+    #        From the information of the files, generate the commands
+    #        needed.
+    #        ... with --detect_adapters, each sample uses only its adapters.
+    sample_adapters = (detect_sample_adapters(files, adapters_file, output_dir)
+                           if detect_adapters
+                           else None)
+
+    commands = list(assemble_commands(files,
+                                      output_dir,
+                                      adapters_file,
+                                      engine,
+                                      cores,
+                                      sample_adapters))
 
-    # 5. --- Execute the script
 
-    run(f"qsub {script_name}")
+    # 3. --- Assemble the script.
+    #        Create the script that will launch the paralell jobs.
+    #        The commands are grouped in batches, each one executed by a task.
+    #        With --auto_resources, a script is made for each group of commands
+    #        needing the same resources.
+    groups = resource_groups(commands, 
+                             'trimming', 
+                             ram, 
+                             cores, 
+                             auto_resources)
+
+    for group_ram, group_cores, ids in groups:
+        batches = batch_commands(commands, 
+                                 batch_size, 
+                                 target_task_minutes, 
+                                 stage='trimming',
+                                 ids=ids)
+        # The commands use the cores requested for them
+        script_contents = assemble_script([with_threads(c, group_cores) for c in commands],
+                                          group_ram, batches, 
+                                          batch_concurrency, group_cores,
+                                          stall_minutes=stall_minutes,
+                                          scratch=scratch,
+                                          skip_clean=((max_adapter_rate, max_low_quality_rate)
+                                                          if skip_clean
+                                                          else None))
+
+
+
+        # 4. --- Write the script to a file.
+
+        script_name = script_file('script.autogenerated.trimming_jobs.py',
+                                  group_ram, 
+                                  group_cores, 
+                                  len(groups))
+
+        with open(script_name, 'w') as outf:
+            outf.write(script_contents)
+
+
+
+        # 5. --- Execute the script
+
+        if executor == 'local':
+            run_local(script_name, 
+                      len(batches), 
+                      int(group_cores) * int(batch_concurrency), 
+                      group_ram)
+        else:
+            run(f"qsub {script_name}")
 # ---
 
 
@@ -0,0 +1,210 @@
+"""
+Duplication of the reads of a sample, with bounded memory.
+==========================================================
+
+Author: Andrés García García @ Sept 2018
+
+FastQC measures the duplication of each file from its first reads only, and
+each sample is split in 40-50 chunk files, so the duplication across the
+chunks of a sample is not measured at all. Counting every distinct read of
+a sample exactly would need memory proportional to its number of reads.
+
+Instead, the reads are summarized in sketches of fixed size, whatever the
+number of reads:
+
+    - A HyperLogLog of HLL_BITS bits (2^HLL_BITS registers of one byte)
+      estimates the number of distinct reads, with a relative error of about
+      1.04 / sqrt(2^HLL_BITS) (0.8%).
+    - A count-min sketch of CM_DEPTH rows of 2^CM_BITS counters estimates the
+      number of copies of any read, exceeding it by at most about
+      e / 2^CM_BITS of all the reads (with high probability).
+    - The most repeated reads of each chunk are kept as candidates for the
+      most duplicated reads of the sample (at most MAX_CANDIDATES, the ones
+      with the most copies according to the count-min sketch).
+
+As with the statistics of `fastq.py`, the sketch of each file is kept as a
+dictionary ('new_sketch'), updated with every chunk ('update_sketch'). The
+sketches of several files (e.g. all the chunks of a sample) can be merged
+('merge_sketches'): the registers of the HyperLogLogs by their maximum, the
+count-min sketches by their sum. The result is the same as sketching all
+the reads together. Then, 'summarize_sketch' gives the fraction of distinct
+reads and the most duplicated ones.
+
+Each read is identified by a 64 bit hash of its sequence ('hash_reads').
+
+See `script.duplication.py` for the command line interface.
+
+"""
+
+import math
+from pathlib import Path
+from typing import Union, Dict
+
+import numpy as np
+
+from fastq import read_chunks, CHUNK_READS
+
+
+# The registers of the HyperLogLog, 2^HLL_BITS
+HLL_BITS = 14
+
+# The rows and columns (2^CM_BITS) of the count-min sketch
+CM_DEPTH = 4
+CM_BITS = 20
+
+# An odd multiplier for the hash of each row of the count-min sketch
+CM_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                           0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)[:CM_DEPTH]
+
+# The candidates to the most duplicated reads taken from each chunk, and kept in total
+CHUNK_CANDIDATES = 100
+MAX_CANDIDATES = 1000
+
+
+def mix(hashes: np.ndarray) -> np.ndarray:
+    """Scramble the bits of the 64 bit hashes (the finalizer of SplitMix64)."""
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+# ---
+
+def hash_reads(sequences: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """The 64 bit hash of each read, from the matrix of the sequences (see `fastq.py`)."""
+    n_reads, width = sequences.shape
+    words = np.zeros((n_reads, -(-width // 8) * 8), dtype=np.uint8)
+    words[:, :width] = sequences
+    words = words.view('<u8')
+
+    hashes = mix(lengths.astype(np.uint64))
+    for column in range(words.shape[1]):
+        hashes = mix(hashes ^ words[:, column])
+
+    # A last round, as the HyperLogLog is sensitive to any bias of the bits
+    return mix(hashes)
+# ---
+
+def leading_zeros(values: np.ndarray) -> np.ndarray:
+    """The number of leading zero bits of each 64 bit value."""
+    zeros = np.zeros(values.shape, dtype=np.uint8)
+    shifted = values.copy()
+
+    for bits in (32, 16, 8, 4, 2, 1):
+        empty = (shifted >> np.uint64(64 - bits)) == 0
+        zeros[empty] += bits
+        shifted[empty] <<= np.uint64(bits)
+
+    zeros[values == 0] = 64
+    return zeros
+# ---
+
+def new_sketch() -> Dict[str, object]:
+    """An empty sketch."""
+    return {'reads': 0,
+            'registers': np.zeros(2**HLL_BITS, dtype=np.uint8),
+            'counts': np.zeros((CM_DEPTH, 2**CM_BITS), dtype=np.uint32),
+            'candidates': dict()}
+# ---
+
+def columns_of(hashes: np.ndarray) -> np.ndarray:
+    """The column of each hash in each row of the count-min sketch."""
+    return (hashes[None, :] * CM_MULTIPLIERS[:, None]) >> np.uint64(64 - CM_BITS)
+# ---
+
+def estimate_copies(sketch: Dict[str, object], hashes: np.ndarray) -> np.ndarray:
+    """The number of copies of each read (by its hash) according to the count-min sketch."""
+    columns = columns_of(np.asarray(hashes, dtype=np.uint64))
+    return sketch['counts'][np.arange(CM_DEPTH)[:, None], columns].min(axis=0)
+# ---
+
+def prune_candidates(sketch: Dict[str, object]):
+    """Keep only the MAX_CANDIDATES candidates with the most copies."""
+    candidates = sketch['candidates']
+    if len(candidates) <= MAX_CANDIDATES:
+        return
+
+    hashes = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+    kept = hashes[np.argsort(-estimate_copies(sketch, hashes).astype(np.int64),
+                             kind='stable')[:MAX_CANDIDATES]]
+    sketch['candidates'] = {int(h): candidates[int(h)] for h in kept}
+# ---
+
+def update_sketch(sketch: Dict[str, object], sequences: np.ndarray, lengths: np.ndarray):
+    """Add the reads of a chunk to the sketch."""
+    hashes = hash_reads(sequences, lengths)
+    sketch['reads'] += len(hashes)
+
+    # HyperLogLog: the first bits choose the register, which keeps the
+    # largest position of the first 1 in the rest of the bits.
+    registers = hashes >> np.uint64(64 - HLL_BITS)
+    ranks = np.minimum(leading_zeros(hashes << np.uint64(HLL_BITS)) + 1, 64 - HLL_BITS + 1)
+    np.maximum.at(sketch['registers'], registers.astype(np.int64), ranks.astype(np.uint8))
+
+    # Count-min
+    columns = columns_of(hashes)
+    for row in range(CM_DEPTH):
+        sketch['counts'][row] += np.bincount(columns[row].astype(np.int64),
+                                             minlength=2**CM_BITS).astype(np.uint32)
+
+    # The most repeated reads of the chunk
+    unique, first, copies = np.unique(hashes, return_index=True, return_counts=True)
+    top = np.argsort(-copies, kind='stable')[:CHUNK_CANDIDATES]
+    for h, i in zip(unique[top[copies[top] > 1]], first[top[copies[top] > 1]]):
+        sketch['candidates'].setdefault(int(h), bytes(sequences[i, :lengths[i]]).decode('ascii'))
+    prune_candidates(sketch)
+# ---
+
+def merge_sketches(sketch: Dict[str, object], other: Dict[str, object]) -> Dict[str, object]:
+    """The sketch of the reads of two (sets of) files."""
+    merged = {'reads': sketch['reads'] + other['reads'],
+              'registers': np.maximum(sketch['registers'], other['registers']),
+              'counts': sketch['counts'] + other['counts'],
+              'candidates': {**sketch['candidates'], **other['candidates']}}
+    prune_candidates(merged)
+    return merged
+# ---
+
+def file_sketch(path: Union[str, Path], chunk_reads: int = CHUNK_READS) -> Dict[str, object]:
+    """The sketch of the reads of a FASTQ file."""
+    sketch = new_sketch()
+    for sequences, _, lengths in read_chunks(path, chunk_reads):
+        update_sketch(sketch, sequences, lengths)
+    return sketch
+# ---
+
+def distinct_reads(registers: np.ndarray) -> float:
+    """The number of distinct reads estimated from the registers of the HyperLogLog."""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m**2 / np.sum(2.0 ** -registers.astype(np.float64))
+
+    # Few distinct reads: linear counting of the empty registers
+    empty = int((registers == 0).sum())
+    if estimate <= 2.5 * m and empty:
+        estimate = m * math.log(m / empty)
+
+    return estimate
+# ---
+
+def summarize_sketch(sketch: Dict[str, object], top: int = 20) -> Dict[str, object]:
+    """The duplication of the reads of the sketch.
+
+    Output: The number of reads, the estimated number and fraction of
+            distinct reads, and the 'top' most duplicated reads with their
+            estimated copies and fraction of the reads.
+    """
+    reads = sketch['reads']
+    distinct = min(distinct_reads(sketch['registers']), reads)
+
+    candidates = sketch['candidates']
+    hashes = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+    copies = estimate_copies(sketch, hashes) if len(hashes) else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(-copies.astype(np.int64), kind='stable')[:top]
+
+    return {'reads': reads,
+            'distinct_reads': int(round(distinct)),
+            'distinct_fraction': round(distinct / max(reads, 1), 4),
+            'duplicated_sequences': [{'sequence': candidates[int(hashes[i])],
+                                      'copies': int(copies[i]),
+                                      'fraction': round(int(copies[i]) / max(reads, 1), 6)}
+                                         for i in order]}
+# ---
@@ -0,0 +1,1018 @@
+"""
+Executing the task of a job array.
+==================================
+
+Author: Andrés García García @ Sept 2018
+
+The job array scripts generated by `script.quality_check.py`, `script.trimming.py`,
+`script.rnaseq_map.py` and `script.sam_to_bam.py` fetch the command of the
+current task and execute it with the 'execute' function of this module.
+
+Skipping the work that was already done
+---------------------------------------
+Before, a task was skipped if its output file existed. But that can't tell a
+complete output from a partial one, and it can't tell if the inputs or the
+parameters changed since the output was produced.
+
+So, now every stage keeps a manifest (the file 'manifest.<stage>.jsonl' in the
+working directory of the job) where, each time a task finishes successfully,
+a record is appended with:
+    - The command line.
+    - The fingerprint (size and modification time) of the input files.
+    - The version of the tools used.
+    - The fingerprint of the output files.
+
+A task is skipped only if the last record for its output files matches the
+current command, inputs and tool versions, and the output files are still
+the ones that were produced. So, after tweaking a single parameter, only the
+affected tasks are executed again.
+
+The input and output files are extracted from the command line, knowing the
+arguments of each of the tools used in the pipeline (see 'files_of').
+
+Atomic outputs
+--------------
+Tasks killed or crashed (e.g. after a node failure) used to leave incomplete
+output files that looked just like the complete ones, and they had to be found
+by scraping the logs (`script.error_cleanup.*.py`).
+
+Now the command writes its outputs to a temporary directory ('.tmp') next to
+the final output files, and only if it exits with code 0 they are moved
+(atomically renamed) to their final place and a completion marker is written
+for each of them in the '.done' directory. So, the final output files are
+always complete, and a killed task can just be executed again. The leftovers
+of a killed task are removed the next time the task is executed.
+
+Resource accounting
+-------------------
+For each executed command, a record is appended to the file
+'accounting.<stage>.jsonl' (in the working directory of the job) with the
+resources it used: wall time, user and system CPU time, peak memory (RSS),
+bytes read and written, and the exit code. These are the numbers needed to
+request the right amount of RAM and cores for the tasks, and to find out if
+a tool is not using the cores it was given (or using more than it asked for).
+
+Stalled commands
+----------------
+Some commands (mostly HISAT2) hang for days without finishing nor failing,
+with the output file stuck at the same size, while still holding the slot.
+
+So, while a command runs, a watchdog checks every few seconds the size of its
+output files and the CPU time used by its processes. If none of them has
+grown for a while (60 minutes by default) the command is killed, and the task
+exits with code 99, which makes SGE requeue it (and the local executor run
+it again, see `jobs.py`). Only the stalled tasks are executed again, and a
+command that stalls too many times in a row is given up as failed.
+
+A command can also give up on its own, e.g. the mapping of a chunk whose
+first reads don't align (see `alignment_monitor.py`), exiting with code 98.
+That task is reported as aborted, and not requeued. The job array task exits
+with code 100 instead ('task_exit_code'), which SGE takes as an error: the
+task is left in the error state, and the tasks of the next stages that wait
+for it (qsub -hold_jid_ad) stay on hold, instead of being released to fail
+on its missing outputs. They run once the aborted task is cleared
+('qmod -cj', after fixing its inputs), or never if it is deleted ('qdel').
+
+Local scratch
+-------------
+The tools read and write directly in the shared filesystem, which is slow for
+random access (e.g. the temporary files of 'samtools sort') and, with a whole
+job array running, floods the fileserver with requests.
+
+So, optionally, the input reads of each command are copied to the scratch
+directory of the node ($TMPDIR), the command is executed there, and its
+outputs are moved back to the temporary directory next to the final outputs
+(and then renamed, as usual). When a task executes several commands, the
+inputs of the next command are copied while the current one runs.
+
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Union, List, Tuple, Dict, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import maya
+
+
+# The flag used to ask each tool for its version
+VERSION_FLAGS = {'hisat2': '--version',
+                 'samtools': '--version',
+                 'fastqc': '--version',
+                 'trimmomatic': '-version',
+                 'script.trim.py': '-version',
+                 'script.collapse.py': '--version',
+                 'script.kmer_filter.py': '--version',
+                 'script.alignment_monitor.py': '--version'}
+
+# The extensions of the files with reads (or alignments of reads)
+READS_EXTENSIONS = ('.fastq', '.fq', '.gz', '.sam', '.bam')
+
+# Minutes without progress after which a command is considered stalled
+STALL_MINUTES = 60
+
+# Seconds between the checks of the watchdog
+WATCHDOG_INTERVAL = 30
+
+# Less CPU than this (in cores) is not considered progress
+STALL_CPU_USAGE = 0.05
+
+# Seconds given to a stalled command to terminate before killing it
+KILL_GRACE = 30
+
+# Times in a row that a stalled command is requeued before giving up
+MAX_REQUEUES = 2
+
+# A task exiting with this code is requeued by SGE
+REQUEUE_EXIT_CODE = 99
+
+# A command exiting with this code gave up on its inputs (e.g. reads that
+# don't align, see `alignment_monitor.py`), executing it again won't help
+ABORTED_EXIT_CODE = 98
+
+# A task exiting with this code is put in the error state by SGE, which keeps
+# the tasks depending on it on hold
+HOLD_EXIT_CODE = 100
+
+# The extensions removed by FastQC from the input file name to name the report
+FASTQC_EXTENSIONS = ('.gz', '.bz2', '.txt', '.fastq', '.fq', '.csfastq',
+                     '.sam', '.bam', '.ubam')
+
+
+#### <<<<<< FILES OF EACH COMMAND >>>>>>> ####
+
+def hisat2_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a 'hisat2' command.
+
+    The reads may come from the standard input ('-'), e.g. piped by the trimming.
+    """
+    inputs, outputs = [], []
+
+    for flag in ('-U', '-1', '-2', '--interleaved'):
+        if flag in args:
+            inputs += [f for f in args[args.index(flag) + 1].split(',') if f != '-']
+
+    if '-x' in args:
+        idx_prefix = args[args.index('-x') + 1]
+        inputs += sorted(str(f) for f in Path(idx_prefix).parent.glob(Path(idx_prefix).name + '.*.ht2'))
+
+    for flag in ('-S', '--summary-file'):
+        if flag in args:
+            outputs.append(args[args.index(flag) + 1])
+
+    return inputs, outputs
+# ---
+
+def samtools_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a 'samtools sort' command."""
+    outputs = [args[args.index('-o') + 1]] if '-o' in args else []
+    # The input file is the last argument ('-' is the standard input)
+    inputs = [args[-1]] if args[-1] != '-' else []
+
+    return inputs, outputs
+# ---
+
+def trimmomatic_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a 'trimmomatic' command.
+
+    The files are the positional arguments:
+        SE <input> <output>
+        PE <input 1> <input 2> <4 outputs>
+    The adapters file given in the ILLUMINACLIP step is also an input, and the
+    '-summary' file an output. An output '-' is the standard output.
+    """
+    mode, *args = args
+    flags_with_value = {'-threads', '-trimlog', '-summary'}
+
+    positional = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in flags_with_value:
+            skip = True
+        elif not arg.startswith('-') and ':' not in arg:
+            positional.append(arg)
+
+    n_inputs = 1 if mode == 'SE' else 2
+    inputs, outputs = positional[:n_inputs], positional[n_inputs:]
+
+    inputs += [arg.split(':')[1] for arg in args if arg.startswith('ILLUMINACLIP:')]
+    outputs = [f for f in outputs if f != '-']
+    if '-summary' in args:
+        outputs.append(args[args.index('-summary') + 1])
+
+    return inputs, outputs
+# ---
+
+def collapse_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a `script.collapse.py` command.
+
+    The inputs are the positional arguments (lists separated by commas), and
+    the outputs the '-o' ones. '-' is the standard input or output.
+    """
+    flags_with_value = {'-o', '--output', '-M', '--max_memory', '-T', '--spill_dir'}
+
+    inputs, outputs = [], []
+    for i, arg in enumerate(args):
+        if arg in flags_with_value or arg == '-':
+            continue
+        if i > 0 and args[i-1] in ('-o', '--output'):
+            outputs.append(arg)
+        elif not (i > 0 and args[i-1] in flags_with_value) and not arg.startswith('-'):
+            inputs += arg.split(',')
+
+    return inputs, outputs
+# ---
+
+def kmer_filter_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a `script.kmer_filter.py` command.
+
+    The inputs are the positional arguments (lists separated by commas) and
+    the contaminants ('-c'), the outputs the '-o' and '-s' ones. '-' is the
+    standard input or output.
+    """
+    flags_with_value = {'-c', '--contaminants', '-o', '--output', '-s', '--side_file', '-m', '--min_hits'}
+
+    inputs, outputs = [], []
+    for i, arg in enumerate(args):
+        if arg in flags_with_value or arg == '-':
+            continue
+        previous = args[i-1] if i > 0 else None
+        if previous in ('-c', '--contaminants'):
+            inputs.append(arg)
+        elif previous in ('-o', '--output', '-s', '--side_file'):
+            outputs.append(arg)
+        elif previous not in flags_with_value and not arg.startswith('-'):
+            inputs += arg.split(',')
+
+    return inputs, outputs
+# ---
+
+def alignment_monitor_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a `script.alignment_monitor.py` command.
+
+    It reads the standard input, the output is the '-o' one, if any.
+    """
+    outputs = [args[i+1] for i, arg in enumerate(args[:-1])
+                   if arg in ('-o', '--output') and args[i+1] != '-']
+    return [], outputs
+# ---
+
+def fastqc_report_name(input_file: Union[str, Path]) -> str:
+    """The name FastQC gives to the report of the input file (without extension)."""
+    name = Path(input_file).name
+
+    stripped = True
+    while stripped:
+        stripped = False
+        for extension in FASTQC_EXTENSIONS:
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                stripped = True
+
+    return name + '_fastqc'
+# ---
+
+def fastqc_files(args: List[str]) -> Tuple[List[str], List[str]]:
+    """Input and output files of a 'fastqc' command.
+
+    The outputs are the HTML report and the ZIP file with the data, for each
+    of the input files.
+    """
+    flags_with_value = {'-o', '--outdir', '-t', '--threads'}
+
+    inputs = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in flags_with_value:
+            skip = True
+        elif not arg.startswith('-'):
+            inputs.append(arg)
+
+    output_dir = next((args[i+1] for i,arg in enumerate(args)
+                                     if arg in ('-o', '--outdir')), None)
+    outputs = []
+    for input_file in inputs:
+        report_dir = Path(output_dir) if output_dir else Path(input_file).parent
+        report = fastqc_report_name(input_file)
+        outputs += [str(report_dir / f'{report}.html'),
+                    str(report_dir / f'{report}.zip')]
+
+    return inputs, outputs
+# ---
+
+# The function that knows the files of each tool
+FILES_OF_TOOL = {'hisat2': hisat2_files,
+                 'samtools': samtools_files,
+                 'trimmomatic': trimmomatic_files,
+                 'script.collapse.py': collapse_files,
+                 'script.kmer_filter.py': kmer_filter_files,
+                 'script.alignment_monitor.py': alignment_monitor_files,
+                 'script.trim.py': trimmomatic_files,
+                 'fastqc': fastqc_files}
+
+def tools_of(command: str) -> List[str]:
+    """The tools used in the command (one for each part of a pipe)."""
+    return [Path(part.split()[0]).name for part in command.split('|')]
+# ---
+
+def files_of(command: str) -> Tuple[List[str], List[str]]:
+    """Extract the input and output files from a command.
+
+    Input: The command, which may be several commands joined with pipes.
+    Output: A tuple with the list of input files and the list of output files.
+
+    The files of unknown tools are ignored.
+    """
+    inputs, outputs = [], []
+
+    for part in command.split('|'):
+        tool, *args = part.split()
+        files = FILES_OF_TOOL.get(Path(tool).name)
+        if files:
+            part_inputs, part_outputs = files(args)
+            inputs += part_inputs
+            outputs += part_outputs
+
+    return inputs, outputs
+# ---
+
+def reads_of(command: str) -> List[str]:
+    """The input files of the command that contain reads.
+
+    Other inputs, like the genome index or the adapters file, are left out.
+    """
+    inputs, _ = files_of(command)
+    return [f for f in inputs if f.endswith(READS_EXTENSIONS)]
+# ---
+
+
+#### <<<<<< FINGERPRINTS AND MANIFEST >>>>>>> ####
+
+def fingerprint_files(files: List[str]) -> Dict[str, Optional[List[int]]]:
+    """The size and modification time of each file (None if it doesn't exist)."""
+    fingerprint = dict()
+
+    for file in files:
+        try:
+            stat = Path(file).stat()
+            fingerprint[file] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            fingerprint[file] = None
+
+    return fingerprint
+# ---
+
+def tool_version(tool: str) -> str:
+    """Ask the tool for its version, return the first line of the answer.
+
+    The tools of the pipeline itself (e.g. `script.trim.py`) are looked for
+    in the directory of this module.
+    """
+    flag = VERSION_FLAGS.get(tool)
+    if not flag:
+        return 'unknown'
+
+    if not shutil.which(tool):
+        tool = str(Path(__file__).resolve().parent / tool)
+
+    try:
+        executed = subprocess.run([tool, flag],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+    except FileNotFoundError:
+        return 'unknown'
+
+    lines = [line.strip() for line in executed.stdout.decode('UTF-8').split('\n')]
+    return next((line for line in lines if line), 'unknown')
+# ---
+
+def fingerprint_task(command: str, prepare: Optional[Callable[[str], str]] = None) -> dict:
+    """Everything that determines the output of the command (see 'execute'
+    for 'prepare')."""
+    inputs, _ = files_of(command)
+
+    return dict({'command': command,
+                 'inputs': fingerprint_files(inputs),
+                 'versions': {tool: tool_version(tool) for tool in tools_of(command)}},
+                **({'prepared': True} if prepare else {}))
+# ---
+
+def append_record(file: Union[str, Path], record: dict):
+    """Append the record as a line of JSON to the file.
+
+    Many tasks may finish at the same time, so the file is locked while writing.
+    """
+    with open(file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+# ---
+
+def manifest_file(stage: str) -> Path:
+    """The manifest of the stage, in the working directory of the job."""
+    return Path(f'manifest.{stage}.jsonl')
+# ---
+
+def read_manifest(stage: str) -> Dict[Tuple[str, ...], dict]:
+    """Read the records of the manifest of the stage.
+
+    Output: The last record for each set of output files.
+    """
+    records = dict()
+
+    if manifest_file(stage).exists():
+        for line in manifest_file(stage).read_text().split('\n'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Empty or incomplete line
+                continue
+            records[tuple(record['outputs'])] = record
+
+    return records
+# ---
+
+def record_task(stage: str, outputs: List[str], fingerprint: dict):
+    """Append the record of a successfully executed task to the manifest."""
+    record = dict(fingerprint,
+                  outputs=outputs,
+                  produced=fingerprint_files(outputs),
+                  time=str(maya.now()))
+
+    append_record(manifest_file(stage), record)
+# ---
+
+def is_up_to_date(stage: str, outputs: List[str], fingerprint: dict) -> bool:
+    """Whether the outputs where produced by the same command, inputs and tools.
+
+    The output files must also be the same that where produced (same size
+    and modification time), so that incomplete or modified outputs are not
+    taken as valid.
+    """
+    record = read_manifest(stage).get(tuple(outputs))
+
+    if record is None or not all(marker_of(f).exists() for f in outputs):
+        return False
+
+    same_task = (all(record[key] == fingerprint[key]
+                         for key in ('command', 'inputs', 'versions'))
+                     and record.get('prepared', False) == fingerprint.get('prepared', False))
+    produced = fingerprint_files(outputs)
+    same_outputs = (None not in produced.values()
+                        and record['produced'] == produced)
+
+    return same_task and same_outputs
+# ---
+
+def command_up_to_date(command: str,
+                       stage: str,
+                       prepare: Optional[Callable[[str], str]] = None) -> bool:
+    """Whether the outputs of the command are up to date, so that 'execute' skips it."""
+    _, outputs = files_of(command)
+    return bool(outputs) and is_up_to_date(stage, outputs, fingerprint_task(command, prepare))
+# ---
+
+
+#### <<<<<< ATOMIC OUTPUTS >>>>>>> ####
+
+def temporary_of(file: Union[str, Path]) -> Path:
+    """Where the output file is written before the task finishes."""
+    file = Path(file)
+    return file.parent / '.tmp' / file.name
+# ---
+
+def marker_of(file: Union[str, Path]) -> Path:
+    """The completion marker of the output file."""
+    file = Path(file)
+    return file.parent / '.done' / file.name
+# ---
+
+def temporary_command(command: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """Make the command write its outputs in the temporary directories.
+
+    Input: The command.
+    Output: A tuple with the new command and a list of the (temporary, final)
+            output files.
+
+    The output files in the command are replaced by their temporary
+    counterparts. The output directories (as in 'fastqc -o <dir>') are
+    replaced by the temporary directory inside them.
+    """
+    _, outputs = files_of(command)
+    temporary = {f: str(temporary_of(f)) for f in outputs}
+
+    tokens = command.split()
+    for i, token in enumerate(tokens):
+        if token in temporary:
+            tokens[i] = temporary[token]
+        elif i > 0 and tokens[i-1] in ('-o', '--outdir') and Path(token).is_dir():
+            tokens[i] = str(Path(token) / '.tmp')
+    tmp_command = ' '.join(tokens)
+
+    # The outputs of both commands are found in the same order.
+    _, tmp_outputs = files_of(tmp_command)
+
+    return tmp_command, list(zip(tmp_outputs, outputs))
+# ---
+
+def prepare_outputs(outputs: List[Tuple[str, str]]):
+    """Prepare the temporary directories before executing the command.
+
+    The leftovers of previous executions are removed, as well as the
+    completion markers of the outputs that are going to be replaced.
+    """
+    for tmp, final in outputs:
+        Path(tmp).parent.mkdir(exist_ok=True)
+        marker_of(final).parent.mkdir(exist_ok=True)
+
+        for file in (Path(tmp), marker_of(final)):
+            if file.exists():
+                file.unlink()
+# ---
+
+def commit_outputs(outputs: List[Tuple[str, str]]):
+    """Move the outputs to their final place and mark them as complete."""
+    for tmp, final in outputs:
+        os.replace(tmp, final) # <-- Atomic in the same filesystem.
+
+    for _, final in outputs:
+        marker_of(final).write_text(str(maya.now()) + '\n')
+# ---
+
+def discard_outputs(outputs: List[Tuple[str, str]]):
+    """Remove the temporary outputs of a failed command."""
+    for tmp, _ in outputs:
+        if Path(tmp).is_dir():
+            shutil.rmtree(tmp)
+        elif Path(tmp).exists():
+            Path(tmp).unlink()
+# ---
+
+
+def replace_paths(command: str, paths: Dict[str, str]) -> str:
+    """Replace the paths in the command (also in lists separated by commas)."""
+    tokens = [','.join(paths.get(path, path) for path in token.split(','))
+                  for token in command.split()]
+    return ' '.join(tokens)
+# ---
+
+def stage_inputs(command: str, scratch_dir: Union[str, Path]) -> Dict[str, str]:
+    """Copy the input reads of the command to the scratch directory.
+
+    Output: The path of the copy of each input file.
+    """
+    inputs_dir = Path(scratch_dir) / 'inputs'
+    inputs_dir.mkdir(parents=True, exist_ok=True)
+
+    copies = dict()
+    for file in reads_of(command):
+        if Path(file).exists():
+            copies[file] = str(inputs_dir / Path(file).name)
+            shutil.copyfile(file, copies[file])
+
+    return copies
+# ---
+
+def scratch_outputs(outputs: List[Tuple[str, str]], 
+                    scratch_dir: Union[str, Path]) -> Dict[str, str]:
+    """Where the command writes its temporary outputs in the scratch directory.
+
+    Output: The local path of each temporary output file, and of each
+            temporary directory (for the tools that take an output directory).
+    """
+    paths = dict()
+    tmp_dirs = sorted({str(Path(tmp).parent) for tmp, _ in outputs})
+
+    for i, tmp_dir in enumerate(tmp_dirs):
+        paths[tmp_dir] = str(Path(scratch_dir) / f'outputs{i}')
+        Path(paths[tmp_dir]).mkdir(parents=True, exist_ok=True)
+
+    for tmp, _ in outputs:
+        paths[tmp] = str(Path(paths[str(Path(tmp).parent)]) / Path(tmp).name)
+
+    return paths
+# ---
+
+def unstage_outputs(outputs: List[Tuple[str, str]], paths: Dict[str, str]):
+    """Move the outputs from the scratch directory to the temporary directories."""
+    for tmp, _ in outputs:
+        if Path(paths[tmp]).exists():
+            shutil.move(paths[tmp], tmp)
+# ---
+
+
+#### <<<<<< EXECUTION >>>>>>> ####
+
+def process_io(pid: int) -> Optional[Dict[str, int]]:
+    """Bytes read and written by the process (and its finished children).
+
+    Read from '/proc/<pid>/io', None if it is not available.
+    """
+    try:
+        lines = Path(f'/proc/{pid}/io').read_text().split('\n')
+    except OSError:
+        return None
+
+    fields = dict(line.split(': ') for line in lines if ': ' in line)
+    return {'read_bytes': int(fields['rchar']),
+            'write_bytes': int(fields['wchar'])}
+# ---
+
+def process_tree(pid: int) -> Dict[int, float]:
+    """The process and all its descendants, with the CPU time they used (in seconds).
+
+    The CPU time includes the one of their finished children. Read from
+    '/proc/<pid>/stat'.
+    """
+    children, cpu_times = dict(), dict()
+
+    for stat in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            # The name of the program is between parentheses and may contain spaces
+            fields = stat.read_text().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            # The process already finished
+            continue
+        child = int(stat.parent.name)
+        children.setdefault(int(fields[1]), []).append(child)
+        # utime, stime, cutime and cstime, in clock ticks
+        cpu_times[child] = sum(int(f) for f in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+
+    tree, pending = dict(), [pid]
+    while pending:
+        current = pending.pop()
+        tree[current] = cpu_times.get(current, 0)
+        pending += children.get(current, [])
+
+    return tree
+# ---
+
+def output_size(outputs: List[str]) -> int:
+    """The size of the output files, including their temporary files.
+
+    Some tools write to temporary files next to the output (e.g. 'samtools sort'
+    writes 'out.bam.tmp.0000.bam'), and some outputs are directories.
+    """
+    size = 0
+    for output in map(Path, outputs):
+        for path in output.parent.glob(output.name + '*'):
+            try:
+                size += (sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                             if path.is_dir()
+                             else path.stat().st_size)
+            except OSError:
+                # Removed while we were looking
+                continue
+    return size
+# ---
+
+def kill_tree(pid: int, sig: int):
+    """Send the signal to the process and all its descendants."""
+    for process in process_tree(pid):
+        try:
+            os.kill(process, sig)
+        except ProcessLookupError:
+            continue
+# ---
+
+def watchdog(pid: int,
+             outputs: List[str],
+             stall_minutes: float,
+             finished: threading.Event,
+             stalled: threading.Event):
+    """Kill the process if its outputs and CPU time stop growing.
+
+    Input:
+        pid: The process executing the command.
+        outputs: The output files of the command.
+        stall_minutes: Minutes without progress before killing the process.
+        finished: Set when the process finishes, stops the watchdog.
+        stalled: Set by the watchdog when it kills the process.
+    """
+    last_check = last_progress = time.monotonic()
+    last_size = output_size(outputs)
+    last_cpu = sum(process_tree(pid).values())
+
+    while not finished.wait(WATCHDOG_INTERVAL):
+        now = time.monotonic()
+        size = output_size(outputs)
+        cpu = sum(process_tree(pid).values())
+
+        if size > last_size or cpu - last_cpu > STALL_CPU_USAGE * (now - last_check):
+            last_progress = now
+        last_check, last_size, last_cpu = now, size, cpu
+
+        if now - last_progress > stall_minutes * 60:
+            print(f'WARNING: No progress in {stall_minutes} minutes '
+                  f'(output size {size} bytes), killing the command.', flush=True)
+            stalled.set()
+            kill_tree(pid, signal.SIGTERM)
+            finished.wait(KILL_GRACE)
+            kill_tree(pid, signal.SIGKILL)
+            return
+# ---
+
+def run_command(command: str,
+                outputs: Optional[List[str]] = None,
+                stall_minutes: Optional[float] = None) -> Tuple[int, dict]:
+    """Execute the command, measuring the resources it uses.
+
+    Input:
+        command: The command to execute.
+        outputs: The output files of the command, watched for progress.
+        stall_minutes: If given, the command is killed when neither its outputs 
+                       nor its CPU time grow in this many minutes.
+    Output: A tuple with the exit code and a dictionary with the resources
+            used by the command (and all the processes it started), and 
+            whether it was killed for being stalled.
+    """
+    if '|' in command.split():
+        # Piped commands are passed to bash. With 'pipefail' the command
+        # fails if any of the programs fails.
+        args = ['bash', '-o', 'pipefail', '-c', command]
+    else:
+        args = command.split() # <-- Splitting is necessary to pass the 
+                               #     arguments appropriately
+    start = time.monotonic()
+    process = subprocess.Popen(args) # <-- Here it is executed
+
+    finished, stalled = threading.Event(), threading.Event()
+    if stall_minutes:
+        guard = threading.Thread(target=watchdog,
+                                 args=(process.pid, outputs or [], stall_minutes, 
+                                       finished, stalled),
+                                 daemon=True)
+        guard.start()
+
+    # Wait for the process to finish but don't reap it yet, so the I/O
+    # counters can still be read. Then reap it to get the resource usage.
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    io = process_io(process.pid)
+    finished.set()
+    if stall_minutes:
+        # The process id can't be reused by another process until it is reaped.
+        guard.join()
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+
+    # Negative exit code if the process was killed by a signal, as in 'subprocess'.
+    exit_code = (os.WEXITSTATUS(status) 
+                     if os.WIFEXITED(status) 
+                     else -os.WTERMSIG(status))
+    process.returncode = exit_code
+
+    if io is None:
+        # Fall back to the blocks read and written to disk (512 bytes each)
+        io = {'read_bytes': rusage.ru_inblock * 512,
+              'write_bytes': rusage.ru_oublock * 512}
+
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    usage = dict(wall_time=round(wall_time, 3),
+                 user_time=round(rusage.ru_utime, 3),
+                 sys_time=round(rusage.ru_stime, 3),
+                 cpu_usage=round(cpu_time / wall_time, 3) if wall_time else None,
+                 max_rss_mb=round(rusage.ru_maxrss / 1024, 1), # <-- In Kb in Linux
+                 **io,
+                 stalled=stalled.is_set())
+
+    return exit_code, usage
+# ---
+
+def accounting_file(stage: str) -> Path:
+    """The resource accounting of the stage, in the working directory of the job."""
+    return Path(f'accounting.{stage}.jsonl')
+# ---
+
+def record_usage(stage: str, task_id: int, command: str, exit_code: int, usage: dict):
+    """Append the resources used by a command to the accounting of the stage."""
+    reads = reads_of(command)
+    input_bytes = sum(size for size, _ in filter(None, fingerprint_files(reads).values()))
+
+    record = dict(stage=stage,
+                  task_id=task_id,
+                  host=socket.gethostname(),
+                  time=str(maya.now()),
+                  command=command,
+                  input_bytes=input_bytes,
+                  exit_code=exit_code,
+                  **usage)
+
+    append_record(accounting_file(stage), record)
+# ---
+
+def stalls_in_a_row(stage: str, command: str) -> int:
+    """How many times the command stalled since its last successful execution."""
+    stalls = 0
+
+    if accounting_file(stage).exists():
+        for line in accounting_file(stage).read_text().split('\n'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Empty or incomplete line
+                continue
+            if record['command'] != command:
+                continue
+            stalls = stalls + 1 if record.get('stalled') else 0
+
+    return stalls
+# ---
+
+def execute(command: str, 
+            task_id: int, 
+            stage: str, 
+            stall_minutes: Optional[float] = STALL_MINUTES,
+            replace: Optional[Dict[str, str]] = None,
+            scratch: Optional[Union[str, Path]] = None,
+            staged: Optional[Dict[str, str]] = None,
+            prepare: Optional[Callable[[str], str]] = None) -> int:
+    """Execute the command of a task, unless its outputs are up to date.
+
+    Input:
+        command: The command to execute.
+        task_id: The id of the task in the job array.
+        stage: The name of the stage, identifies the manifest.
+        stall_minutes: Minutes without progress before killing the command.
+        replace: Strings replaced in the command right before executing it
+                 (e.g. the paths of files that have a local copy). The manifest
+                 and the accounting still refer to the original command.
+        scratch: A local directory where to copy the inputs and write the
+                 outputs of the command. Removed afterwards.
+        staged: The copies of the inputs already made in the scratch 
+                directory (see 'stage_inputs').
+        prepare: Gives the command actually executed, with the same inputs
+                 and outputs (e.g. a cheaper one, see 'probe_command' in
+                 `trim.py`). Only called when the outputs are not up to date.
+                 The manifest and the accounting refer to the original
+                 command, and its outputs are only up to date for tasks that
+                 prepare it too.
+    Output: The exit code of the command (0 if it was skipped). If the command
+            was killed for being stalled, REQUEUE_EXIT_CODE, unless it stalled
+            too many times in a row. ABORTED_EXIT_CODE if the command gave
+            up on its inputs.
+    """
+    _, outputs = files_of(command)
+    fingerprint = fingerprint_task(command, prepare)
+
+    if outputs and is_up_to_date(stage, outputs, fingerprint):
+        print(f'Task {task_id}. Output files are up to date:', ' '.join(outputs), flush=True)
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+        return 0
+
+    executed = prepare(command) if prepare else command
+    if executed != command:
+        print(f'Task {task_id}. Executing instead:', executed, flush=True)
+
+    tmp_command, tmp_outputs = temporary_command(executed)
+    prepare_outputs(tmp_outputs)
+
+    for old, new in (replace or dict()).items():
+        tmp_command = tmp_command.replace(old, new)
+
+    watched = [tmp for tmp, _ in tmp_outputs]
+    if scratch:
+        staged = staged if staged is not None else stage_inputs(command, scratch)
+        local_outputs = scratch_outputs(tmp_outputs, scratch)
+        tmp_command = replace_paths(tmp_command, dict(staged, **local_outputs))
+        watched = [local_outputs[tmp] for tmp in watched]
+
+    print(f'Task {task_id}. Executing command @', maya.now(), ':', command, flush=True)
+
+    exit_code, usage = run_command(tmp_command, watched, stall_minutes)
+
+    if scratch:
+        unstage_outputs(tmp_outputs, local_outputs)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print(f'Task {task_id}. Finished execution @', maya.now(),
+          f'with exit code {exit_code}', flush=True)
+    print(f'Task {task_id}. Resources used:', 
+          ', '.join(f'{key}={value}' for key,value in usage.items()), flush=True)
+    record_usage(stage, task_id, command, exit_code, usage)
+
+    if usage['stalled']:
+        if stalls_in_a_row(stage, command) <= MAX_REQUEUES:
+            print(f'Task {task_id}. Command stalled, requeueing the task.', flush=True)
+            exit_code = REQUEUE_EXIT_CODE
+        else:
+            print(f'Task {task_id}. ERROR: Command stalled more than {MAX_REQUEUES} '
+                   'times in a row, giving up.', flush=True)
+
+    if exit_code == ABORTED_EXIT_CODE:
+        print(f'Task {task_id}. ABORTED: The command gave up on its inputs (see the '
+               'messages above). Fix them before executing the task again.', flush=True)
+
+    missing = [final for tmp, final in tmp_outputs if not Path(tmp).exists()]
+    if exit_code == 0 and missing:
+        print(f'Task {task_id}. ERROR: Missing output files:', ' '.join(missing), flush=True)
+        exit_code = 1
+
+    if exit_code == 0:
+        commit_outputs(tmp_outputs)
+        if outputs:
+            record_task(stage, outputs, dict(fingerprint, **({'executed': executed}
+                                                            if executed != command else {})))
+    else:
+        discard_outputs(tmp_outputs)
+
+    return exit_code
+# ---
+
+def execute_batch(commands: List[str], 
+                  task_id: int, 
+                  stage: str, 
+                  concurrency: int = 1,
+                  stall_minutes: Optional[float] = STALL_MINUTES,
+                  replace: Optional[Dict[str, str]] = None,
+                  scratch: bool = False,
+                  prepare: Optional[Callable[[str], str]] = None) -> int:
+    """Execute several commands in the same task.
+
+    Input:
+        commands: The commands to execute.
+        task_id: The id of the task in the job array.
+        stage: The name of the stage, identifies the manifest.
+        concurrency: How many of the commands are executed at the same time.
+        stall_minutes: Minutes without progress before killing a command.
+        replace: Strings replaced in the commands right before executing them.
+        scratch: Whether to execute the commands in the local scratch 
+                 directory of the node ($TMPDIR).
+        prepare: Gives the command actually executed for each command whose
+                 outputs are not up to date (see 'execute').
+    Output: 0 if all the commands succeeded, REQUEUE_EXIT_CODE if any of them
+            has to be executed again, otherwise the first non-zero exit code.
+
+    Packing many small commands in a task saves the overhead of scheduling
+    and starting a task for each one of them.
+    """
+    if scratch:
+        # A directory for each command. 'tempfile' uses $TMPDIR if it is set.
+        scratch_dir = Path(tempfile.mkdtemp(prefix=f'{stage}.{task_id}.'))
+        scratch_dirs = [scratch_dir / str(i) for i in range(len(commands))]
+        prefetched = dict()
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        lock = threading.Lock()
+
+    def prefetch(i):
+        """Start copying the inputs of the i-th command, unless it is up to date."""
+        def stage_if_needed():
+            if command_up_to_date(commands[i], stage, prepare):
+                return dict()
+            return stage_inputs(commands[i], scratch_dirs[i])
+        # ---
+        with lock:
+            if i < len(commands) and i not in prefetched:
+                prefetched[i] = prefetcher.submit(stage_if_needed)
+    # ---
+
+    def execute_command(i):
+        if not scratch:
+            return execute(commands[i], task_id, stage, stall_minutes, replace,
+                           prepare=prepare)
+
+        prefetch(i)
+        # The inputs of the command executed after this one are copied meanwhile
+        prefetch(i + concurrency)
+        return execute(commands[i], task_id, stage, stall_minutes, replace,
+                       scratch_dirs[i], prefetched[i].result(), prepare)
+    # ---
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        exit_codes = list(pool.map(execute_command, range(len(commands))))
+
+    if scratch:
+        prefetcher.shutdown()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if REQUEUE_EXIT_CODE in exit_codes:
+        # The commands that succeeded are skipped when the task is executed again
+        return REQUEUE_EXIT_CODE
+    return next((code for code in exit_codes if code != 0), 0)
+# ---
+
+def task_exit_code(exit_code: int) -> int:
+    """The exit code of the job array task that executed the commands, from
+    the one of 'execute_batch'.
+
+    SGE releases the tasks depending on a task (qsub -hold_jid_ad) whatever
+    its exit code, except 100 (HOLD_EXIT_CODE) and REQUEUE_EXIT_CODE. So, an
+    aborted command (ABORTED_EXIT_CODE) makes the task exit with code 100,
+    and the next stages are not run on the outputs it didn't write.
+    """
+    return HOLD_EXIT_CODE if exit_code == ABORTED_EXIT_CODE else exit_code
+# ---
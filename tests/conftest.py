@@ -0,0 +1,6 @@
+"""The modules of the analysis are at the root of the repository, next to the scripts."""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,30 @@
+#! /bin/bash
+
+# The expected outputs of 'test_same_as_trimmomatic' (tests/test_trim.py):
+# the inputs of each case of 'cases.tsv' trimmed by Trimmomatic 0.38, written
+# to 'expected/'. Commit them after running, from this directory:
+#
+#     ./make_golden.sh                                   # 'trimmomatic' in the PATH
+#     ./make_golden.sh java -jar trimmomatic-0.38.jar
+
+set -euo pipefail
+
+trimmomatic=("${@:-trimmomatic}")
+
+version=$("${trimmomatic[@]}" -version)
+if [ "$version" != 0.38 ]; then
+    echo "Trimmomatic 0.38 is needed, found $version" >&2
+    exit 1
+fi
+
+mkdir -p expected
+
+grep -v '^#' cases.tsv | while IFS=$'\t' read -r name mode inputs steps; do
+    if [ "$mode" = SE ]; then
+        outputs="expected/$name.fastq"
+    else
+        outputs=$(printf "expected/${name}_%s.fastq " paired1 unpaired1 paired2 unpaired2)
+    fi
+    # shellcheck disable=SC2086
+    "${trimmomatic[@]}" "$mode" -phred33 $inputs $outputs $steps
+done
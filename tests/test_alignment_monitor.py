@@ -0,0 +1,85 @@
+"""
+Checking the alignment rate of the first reads with `alignment_monitor.py`.
+"""
+
+import io
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from alignment_monitor import monitor_alignments
+from tasks import ABORTED_EXIT_CODE
+
+
+SCRIPT = Path(__file__).resolve().parent.parent / 'script.alignment_monitor.py'
+
+HEADER = b'@HD\tVN:1.0\tSO:unsorted\n@SQ\tSN:chr1\tLN:1000\n'
+
+
+def record(qname, flag):
+    reference, position = (b'*', 0) if flag & 0x4 else (b'chr1', 100)
+    return b'%s\t%d\t%s\t%d\t60\t4M\t*\t0\t0\tACGT\t*\n' % (qname.encode(), flag, reference, position)
+
+
+def sam(flags):
+    return HEADER + b''.join(record(f'read{i}', flag) for i, flag in enumerate(flags))
+
+
+def monitor(sam_bytes, min_rate, check_reads):
+    sam_out = io.BytesIO()
+    counts = monitor_alignments(io.BytesIO(sam_bytes), sam_out, min_rate, check_reads)
+    return counts, sam_out.getvalue()
+
+
+def test_below_rate():
+    # 1 of the first 4 reads aligns, the rest would align
+    sam_bytes = sam([4, 0, 4, 4] + [0] * 100)
+    counts, copied = monitor(sam_bytes, 0.5, 4)
+
+    assert counts == {'reads': 4, 'aligned': 1, 'rate': 0.25, 'passed': False}
+    assert copied == sam([4, 0, 4, 4])
+
+
+def test_above_rate():
+    sam_bytes = sam([0, 0, 4, 0] + [4] * 100)
+    counts, copied = monitor(sam_bytes, 0.5, 4)
+
+    assert counts == {'reads': 4, 'aligned': 3, 'rate': 0.75, 'passed': True}
+    assert copied == sam_bytes
+
+
+def test_fewer_reads_than_checked():
+    sam_bytes = sam([0, 4, 0])
+    assert monitor(sam_bytes, 0.5, 100) == ({'reads': 3, 'aligned': 2, 'rate': 2 / 3, 'passed': True},
+                                            sam_bytes)
+    assert monitor(HEADER, 0.5, 100)[0]['passed']
+
+
+def test_copies_and_secondary():
+    # A collapsed read counts its copies, the secondary and supplementary
+    # alignments don't count.
+    sam_bytes = (HEADER + record('many_x6', 4) + record('read1', 0) + record('read1', 0x100)
+                     + record('read2', 0x800) + record('few_x2', 0) + record('read3', 0))
+    counts, copied = monitor(sam_bytes, 0.5, 9)
+
+    assert (counts['reads'], counts['aligned']) == (9, 3)
+    assert not counts['passed']
+
+    counts, copied = monitor(sam_bytes, 0.3, 9)
+    assert counts['passed'] and copied == sam_bytes
+
+
+@pytest.mark.parametrize('min_rate, exit_code', [('50', ABORTED_EXIT_CODE), ('20', 0)])
+def test_command_line(tmp_path, min_rate, exit_code):
+    sam_bytes = sam([4, 0, 4, 4] + [0] * 100)
+    output = tmp_path / 'out.sam'
+    finished = subprocess.run([sys.executable, str(SCRIPT), '-o', str(output), '-m', min_rate, '-n', '4'],
+                              input=sam_bytes, capture_output=True)
+
+    assert finished.returncode == exit_code
+    if exit_code:
+        assert b'Aborting the mapping' in finished.stderr
+    else:
+        assert output.read_bytes() == sam_bytes
@@ -0,0 +1,103 @@
+"""
+Collapsing the duplicate reads with `collapse.py`, and restoring their counts.
+"""
+
+import io
+import random
+from collections import Counter
+
+import pytest
+
+from collapse import read_pairs, keyed_reads, collapse_reads, tag_counts, copies_name
+from fastq import open_binary, read_interleaved
+
+
+def write_fastq(path, sequences, mate):
+    with open(path, 'w') as fastq:
+        for i, sequence in enumerate(sequences):
+            fastq.write(f'@read{i}/{mate} comment\n{sequence}\n+\n{"I" * len(sequence)}\n')
+    return str(path)
+
+
+@pytest.fixture
+def pairs(tmp_path):
+    """210 pairs of 20 different pairs, each one repeated from 1 to 20 times."""
+    generator = random.Random(5)
+    unique = [(''.join(generator.choice('ACGT') for _ in range(30)),
+               ''.join(generator.choice('ACGT') for _ in range(30))) for _ in range(20)]
+    copies = list(range(1, 21))
+    chosen = [pair for pair, n in zip(unique, copies) for _ in range(n)]
+    generator.shuffle(chosen)
+
+    return (write_fastq(tmp_path / 'R1.fastq', [p1 for p1, _ in chosen], 1),
+            write_fastq(tmp_path / 'R2.fastq', [p2 for _, p2 in chosen], 2),
+            Counter(chosen))
+
+
+def read_output(stream):
+    stream.seek(0)
+    return list(keyed_reads(read_interleaved(stream, 2)))
+
+
+def to_sam(reads):
+    """SAM records for the collapsed pairs, as HISAT2 would write them."""
+    lines = [b'@HD\tVN:1.0\tSO:unsorted\n']
+    for _, lines_of_pair in reads:
+        for flag, (header, sequence) in zip((99, 147), (lines_of_pair[0:2], lines_of_pair[4:6])):
+            qname = header[1:].split()[0].rsplit(b'/', 1)[0]
+            lines.append(b'%s\t%d\tchr1\t100\t60\t30M\t=\t200\t130\t%s\t*\n' % (qname, flag, sequence))
+    return io.BytesIO(b''.join(lines))
+
+
+@pytest.mark.parametrize('max_table_bytes', [2 * 1024**3, 2000])
+def test_collapse_and_tag(pairs, tmp_path, max_table_bytes):
+    r1, r2, expected = pairs
+    output = io.BytesIO()
+    counts = collapse_reads(read_pairs([r1, r2]), [output], max_table_bytes, tmp_path)
+
+    assert counts['reads'] == 210 and counts['unique'] == 20
+    assert (counts['spills'] > 0) == (max_table_bytes < 10000)
+
+    reads = read_output(output)
+    collapsed = {tuple(key.decode().split('\t')): int(lines[0].split()[0].split(b'_x')[1].split(b'/')[0])
+                     for key, lines in reads}
+    assert collapsed == dict(expected)
+
+    # The copies go back to the tag of every alignment
+    sam_out = io.BytesIO()
+    tagged = tag_counts(to_sam(reads), sam_out)
+    assert tagged == {'alignments': 40, 'copies': 2 * 210}
+
+    records = sam_out.getvalue().decode().splitlines()
+    assert records[0].startswith('@HD')
+    for record in records[1:]:
+        qname, *_, tag = record.split('\t')
+        assert qname.startswith('read') and '_x' not in qname
+        assert tag.startswith('XC:i:')
+
+
+def test_separate_mates(pairs, tmp_path):
+    r1, r2, _ = pairs
+    outputs = [open_binary(tmp_path / 'out1.fastq', 'wb'), open_binary(tmp_path / 'out2.fastq', 'wb')]
+    collapse_reads(read_pairs([r1, r2]), outputs)
+    for output in outputs:
+        output.close()
+
+    out1 = (tmp_path / 'out1.fastq').read_text().splitlines()
+    out2 = (tmp_path / 'out2.fastq').read_text().splitlines()
+    assert len(out1) == len(out2) == 4 * 20
+    for header1, header2 in zip(out1[0::4], out2[0::4]):
+        assert header1.endswith('/1 comment') and header2.endswith('/2 comment')
+        assert header1[:-len('/1 comment')] == header2[:-len('/2 comment')]
+
+
+def test_copies_name():
+    assert copies_name(b'@read7/1 comment', 3) == b'@read7_x3/1 comment'
+    assert copies_name(b'@read7', 12) == b'@read7_x12'
+
+
+def test_tag_counts_not_collapsed():
+    sam_out = io.BytesIO()
+    counts = tag_counts(io.BytesIO(b'read1\t0\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\t*\n'), sam_out)
+    assert counts == {'alignments': 1, 'copies': 1}
+    assert sam_out.getvalue().endswith(b'\tXC:i:1\n')
@@ -0,0 +1,166 @@
+"""
+Reading, sampling and summarizing FASTQ files with `fastq.py`.
+"""
+
+import io
+
+import numpy as np
+import pytest
+
+from fastq import (reservoir_sample, read_records, read_mates, read_interleaved, sample_of, group_of,
+                   file_stats, merge_stats, new_stats, summarize)
+
+
+def write_fastq(path, sequences, name='read'):
+    with open(path, 'w') as fastq:
+        for i, sequence in enumerate(sequences):
+            fastq.write(f'@{name}{i}\n{sequence}\n+\n{"I" * len(sequence)}\n')
+    return str(path)
+
+
+def random_sequences(n, length, seed=0):
+    rng = np.random.default_rng(seed)
+    return [''.join(rng.choice(list('ACGT'), length)) for _ in range(n)]
+
+
+def write_records(path, records):
+    with open(path, 'w') as fastq:
+        for i, (sequence, qualities) in enumerate(records):
+            fastq.write(f'@read{i}\n{sequence}\n+\n{qualities}\n')
+    return str(path)
+
+
+def names(records):
+    return [record.split(b'\n')[0][1:].decode() for record in records]
+
+
+def test_read_records(tmp_path):
+    path = write_fastq(tmp_path / 'reads.fastq', random_sequences(10, 20))
+    chunks = list(read_records(path, 4))
+    assert [len(lines) // 4 for lines in chunks] == [4, 4, 2]
+    assert chunks[0][0] == b'@read0'
+
+
+def test_file_stats(tmp_path):
+    # 300 copies of a sequence, 100 GC-only reads and 600 random ones
+    records = ([('A' * 20, 'I' * 20)] * 300 + [('GC' * 15, '5' * 30)] * 100
+               + [(sequence, '#' * 20) for sequence in random_sequences(600, 20)])
+    path = write_records(tmp_path / 'reads.fastq', records)
+
+    stats = file_stats(path)
+    assert (stats['reads'], stats['bases'], stats['sampled']) == (1000, 21000, 1000)
+    assert stats['length'][20] == 900 and stats['length'][30] == 100
+    assert stats['gc'][100] >= 100 and stats['gc'][0] >= 300
+
+    report = summarize(stats)
+    first, last = report['per_position_quality'][0], report['per_position_quality'][-1]
+    assert first['mean'] == round((300 * 40 + 100 * 20 + 600 * 2) / 1000, 2)
+    assert (first['p10'], first['median'], first['p90']) == (2, 2, 40)
+    assert last['position'] == 30 and last['mean'] == 20
+    assert report['per_position_composition'][0]['A'] >= 30
+    assert report['per_position_composition'][24]['G'] == 100
+    assert report['length_distribution'] == {20: 900, 30: 100}
+
+    overrepresented = {o['sequence']: o for o in report['overrepresented_sequences']}
+    assert overrepresented['A' * 20]['count'] == 300
+    assert overrepresented['A' * 20]['percent'] == 30.0
+    assert overrepresented['GC' * 15]['count'] == 100
+    assert not report['overrepresented_lower_bounds']
+
+    # The chunks don't change the statistics
+    chunked = file_stats(path, chunk_reads=7)
+    for key in ('quality', 'composition', 'length', 'gc'):
+        assert np.array_equal(chunked[key], stats[key])
+    assert chunked['sequences'] == stats['sequences']
+
+
+def test_merged_stats_lower_bounds(tmp_path):
+    # The sequence is overrepresented in the first file (5 of 1000 reads),
+    # not in the second one (1 of 1000), where it is not kept.
+    sequence = 'ACGT' * 5
+    first = write_records(tmp_path / 'first.fastq',
+                          [(sequence, 'I' * 20)] * 5
+                          + [(s, 'I' * 20) for s in random_sequences(995, 20, 1)])
+    second = write_records(tmp_path / 'second.fastq',
+                           [(sequence, 'I' * 20)]
+                           + [(s, 'I' * 20) for s in random_sequences(999, 20, 2)])
+
+    merged = merge_stats(merge_stats(new_stats(), file_stats(first)), file_stats(second))
+    assert merged['reads'] == 2000 and merged['files'] == 2
+
+    report = summarize(merged)
+    assert report['overrepresented_lower_bounds']
+    counts = {o['sequence']: o['count'] for o in report['overrepresented_sequences']}
+    assert counts == {sequence: 5}
+
+
+def test_reservoir_sample_small(tmp_path):
+    path = write_fastq(tmp_path / 'reads.fastq', random_sequences(5, 20))
+    records, seen = reservoir_sample([path], 10)
+    assert seen == 5
+    assert names(records) == [f'read{i}' for i in range(5)]
+
+
+def test_reservoir_sample_uniform(tmp_path):
+    # The reads of two files, in chunks smaller than the sample, are all
+    # drawn about as often (100 of 1000 reads, 300 times).
+    first = write_fastq(tmp_path / 'first.fastq', ['ACGT'] * 600, name='a')
+    second = write_fastq(tmp_path / 'second.fastq', ['ACGT'] * 400, name='b')
+
+    drawn = np.zeros(1000)
+    for seed in range(300):
+        records, seen = reservoir_sample([first, second], 100, seed, chunk_reads=64)
+        assert seen == 1000
+        assert len(set(records)) == 100
+        for name in names(records):
+            drawn[int(name[1:]) + (600 if name[0] == 'b' else 0)] += 1
+
+    # 3000 draws for each block of 100 reads, with a deviation of about 52
+    blocks = drawn.reshape(10, 100).sum(axis=1)
+    assert np.all(np.abs(blocks - 3000) < 250)
+    assert drawn.min() > 10 and drawn.max() < 55
+
+
+@pytest.mark.parametrize('seed', [0, 7])
+def test_reservoir_sample_mates(tmp_path, seed):
+    # The same seed draws the same reads from both mates
+    forward = write_fastq(tmp_path / 'R1.fastq', random_sequences(500, 20, 1))
+    reverse = write_fastq(tmp_path / 'R2.fastq', random_sequences(500, 20, 2))
+
+    records1, _ = reservoir_sample([forward], 50, seed, chunk_reads=32)
+    records2, _ = reservoir_sample([reverse], 50, seed, chunk_reads=32)
+    assert names(records1) == names(records2)
+
+    other, _ = reservoir_sample([forward], 50, seed + 1, chunk_reads=32)
+    assert names(other) != names(records1)
+
+
+def test_sample_of():
+    assert sample_of('mm1L_ATCACG_L003_R1_001.fastq') == 'mm1L'
+    assert sample_of('/data/trimmed/mm12R_ATCACG_L003_R2_paired_004.fastq') == 'mm12R'
+    assert sample_of('mm3L_ATCACG_L003_R1_001_fastqc.zip') == 'mm3L'
+    assert sample_of('control_ATCACG_L001_R1_001.fastq') == 'control'
+
+
+def test_group_of():
+    # The lanes and chunks of a sample and mate go together
+    files = ['mm1L_ATCACG_L003_R1_001.fastq', 'mm1L_ATCACG_L004_R1_012.fastq',
+             '/data/mm1L_ATCACG_L003_R2_001.fastq', 'mm12R_CGATGT_L003_R1_001.fastq']
+    assert [group_of(f) for f in files] == ['mm1L_R1', 'mm1L_R1', 'mm1L_R2', 'mm12R_R1']
+    assert group_of('mm3L.fastq') == 'mm3L'
+
+
+def test_read_interleaved(tmp_path):
+    r1 = write_fastq(tmp_path / 'r1.fastq', random_sequences(5, 20, seed=1), 'pair')
+    r2 = write_fastq(tmp_path / 'r2.fastq', random_sequences(5, 20, seed=2), 'pair')
+    with open(r1, 'rb') as mate1, open(r2, 'rb') as mate2:
+        records = [mate1.read().splitlines(), mate2.read().splitlines()]
+    # The pairs interleaved, with an incomplete pair at the end left out
+    interleaved = b''.join(b'\n'.join(records[mate][i:i+4]) + b'\n'
+                               for i in range(0, 20, 4) for mate in (0, 1)) + b'@pair5\nACGT\n+\nIIII\n'
+
+    chunks = list(read_interleaved(io.BytesIO(interleaved), 2, 2))
+    assert chunks == list(read_mates([r1, r2], 2))
+    assert [len(mate1) for mate1, _ in chunks] == [8, 8, 4]
+    lines = interleaved.splitlines()
+    assert list(read_interleaved(io.BytesIO(interleaved), 1, 10)) == [(lines[:40],), (lines[40:],)]
@@ -0,0 +1,135 @@
+"""
+Filtering the contaminant reads by their k-mers with `kmer_filter.py`.
+"""
+
+import io
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from kmer_filter import load_index, index_file, canonical_kmers, filter_reads, K
+from fastq import read_mates, read_interleaved, BASE_INDEX
+
+
+SCRIPT = Path(__file__).resolve().parent.parent / 'script.kmer_filter.py'
+
+
+def random_bases(n, seed):
+    generator = random.Random(seed)
+    return ''.join(generator.choice('ACGT') for _ in range(n))
+
+
+def revcomp(sequence):
+    return sequence[::-1].translate(str.maketrans('ACGTN', 'TGCAN'))
+
+
+def other_base(base):
+    return 'C' if base == 'A' else 'A'
+
+
+def write_fastq(path, reads):
+    with open(path, 'w') as fastq:
+        for name, sequence in reads:
+            fastq.write(f'@{name}\n{sequence}\n+\n{"I" * len(sequence)}\n')
+    return str(path)
+
+
+def names(fastq):
+    return [line[1:] for line in fastq.decode().splitlines()[0::4]]
+
+
+CONTAMINANT = random_bases(1000, 1)
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    path = tmp_path / 'contaminants.fa'
+    path.write_text(f'>rRNA\n{CONTAMINANT[:600]}\n{CONTAMINANT[600:]}\n')
+    return str(path)
+
+
+def one_hit(start, seed):
+    """A read sharing a single k-mer with the contaminant, at its start."""
+    return (CONTAMINANT[start:start+K] + other_base(CONTAMINANT[start+K])
+                + random_bases(50 - K - 1, seed))
+
+
+def reads():
+    return [('forward', CONTAMINANT[100:150]),
+            ('reverse', revcomp(CONTAMINANT[500:550])),
+            ('random', random_bases(50, 2)),
+            ('one_hit', one_hit(200, 3)),
+            # The N leaves a single k-mer without it
+            ('with_n', CONTAMINANT[300:331] + 'N' + CONTAMINANT[332:350])]
+
+
+def split(chunks, index, min_hits=2):
+    output, contaminants = io.BytesIO(), io.BytesIO()
+    counts = filter_reads(chunks, index, output, contaminants, min_hits)
+    return names(output.getvalue()), names(contaminants.getvalue()), counts
+
+
+def test_single_reads(tmp_path, fasta):
+    index = load_index(fasta)
+    assert len(index['kmers']) == 1000 - K + 1
+
+    path = write_fastq(tmp_path / 'reads.fastq', reads())
+    kept, dropped, counts = split(read_mates([path], 2), index)
+    assert kept == ['random', 'one_hit', 'with_n']
+    assert dropped == ['forward', 'reverse']
+    assert counts == {'reads': 5, 'contaminants': 2}
+
+    kept, dropped, _ = split(read_mates([path]), index, min_hits=1)
+    assert kept == ['random']
+    assert dropped == ['forward', 'reverse', 'one_hit', 'with_n']
+
+
+def test_pairs(tmp_path, fasta):
+    # A single hit in each mate filters the pair out
+    forward = [('clean/1', random_bases(50, 4)), ('hits/1', one_hit(10, 5)), ('half/1', one_hit(700, 6))]
+    reverse = [('clean/2', random_bases(50, 7)), ('hits/2', revcomp(one_hit(800, 8))), ('half/2', random_bases(50, 9))]
+    inputs = [write_fastq(tmp_path / 'R1.fastq', forward), write_fastq(tmp_path / 'R2.fastq', reverse)]
+
+    kept, dropped, counts = split(read_mates(inputs), load_index(fasta))
+    assert kept == ['clean/1', 'clean/2', 'half/1', 'half/2']
+    assert dropped == ['hits/1', 'hits/2']
+    assert counts == {'reads': 3, 'contaminants': 1}
+
+    # The same pairs, interleaved
+    interleaved = io.BytesIO(Path(write_fastq(tmp_path / 'interleaved.fastq',
+                                              [read for pair in zip(forward, reverse) for read in pair]))
+                                 .read_bytes())
+    assert split(read_interleaved(interleaved, 2, 2), load_index(fasta)) == (kept, dropped, counts)
+
+
+def test_canonical_kmers():
+    sequence = random_bases(40, 10)
+    codes = BASE_INDEX[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)][None, :]
+    kmers, valid = canonical_kmers(codes, 5)
+
+    def value(kmer):
+        return int(''.join(str('ACGT'.index(base)) for base in kmer), 4)
+
+    expected = [min(value(sequence[i:i+5]), value(revcomp(sequence[i:i+5]))) for i in range(36)]
+    assert kmers[0].tolist() == expected
+    assert valid.all()
+
+
+def test_load_index_saved(fasta):
+    index = load_index(fasta)
+    assert index_file(fasta).exists()
+    assert np.array_equal(load_index(fasta)['kmers'], index['kmers'])
+
+
+def test_command_line(tmp_path, fasta):
+    path = write_fastq(tmp_path / 'reads.fastq', reads())
+    output, side = tmp_path / 'clean.fastq', tmp_path / 'side.fastq'
+    subprocess.run([sys.executable, str(SCRIPT), '-c', fasta, '-s', str(side), '-o', str(output), path],
+                   check=True, capture_output=True)
+
+    assert names(output.read_bytes()) == ['random', 'one_hit', 'with_n']
+    assert names(side.read_bytes()) == ['forward', 'reverse']
@@ -0,0 +1,94 @@
+"""
+Extrapolating the resources of a pilot run to the full run with `pilot.py`.
+"""
+
+import json
+
+import pytest
+
+from pilot import fit_line, calibrate_stage, calibrate, representative_chunks
+from jobs import memory_request
+from tasks import accounting_file
+
+
+def test_fit_line():
+    assert fit_line([1, 2, 3], [12, 14, 16]) == pytest.approx((10, 2))
+    # Noise: no cost per byte
+    assert fit_line([1, 2, 3], [16, 14, 12]) == pytest.approx((14, 0))
+    # No negative fixed cost, the line goes through the origin
+    assert fit_line([10, 20, 30], [5, 25, 45]) == pytest.approx((0, 75 / 60))
+    # A single size
+    assert fit_line([4, 4], [8, 12]) == pytest.approx((0, 20 / 8))
+
+
+def record(tmp_path, i, size, **usage):
+    """The accounting of a command sorting a SAM file of the given size into a BAM file of half its size."""
+    sam, bam = tmp_path / f'{i}.sam', tmp_path / f'{i}.bam'
+    sam.write_bytes(b'@' * size)
+    bam.write_bytes(b'@' * (size // 2))
+    return dict({'command': f'samtools sort -o {bam} {sam}',
+                 'exit_code': 0,
+                 'input_bytes': size,
+                 'cpu_usage': 1.0},
+                **usage)
+
+
+def pilot_records(tmp_path):
+    # CPU: 10 s + 2 s/kB. Wall: 20 s + 1 s/kB. Memory: 100 Mb + 0.05 Mb/kB.
+    return [record(tmp_path, i, size,
+                   user_time=8 + 2 * size / 1000, sys_time=2.0,
+                   wall_time=20 + size / 1000,
+                   max_rss_mb=100 + 0.05 * size / 1000)
+                for i, size in enumerate([1000, 2000, 4000])]
+
+
+def test_calibrate_stage(tmp_path):
+    stage = calibrate_stage(pilot_records(tmp_path), n_tasks=100,
+                            stage_bytes=10**6, largest_input=20_000)
+
+    assert stage['tasks'] == 100
+    assert stage['cpu_hours'] == round((100 * 10 + 2 * 1000) / 3600, 2)
+    assert stage['max_task_hours'] == round((20 + 20) / 3600, 2)
+    assert stage['output_gb'] == round(0.5 * 10**6 / 1024**3, 2)
+    assert stage['baseline_mb'] == 100
+    assert stage['mb_per_byte'] == pytest.approx(0.05 / 1000)
+    assert stage['ram'] == memory_request(100, 0.05 / 1000, 20_000)
+    assert stage['cores'] == 1
+    assert stage['largest_input_bytes'] == 20_000
+
+
+def test_calibrate_once_per_command(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    records = pilot_records(tmp_path)
+
+    # A command executed again (after its task was requeued) counts once,
+    # its last successful execution.
+    failed = dict(records[0], exit_code=99, wall_time=1000.0)
+    first = dict(records[0], wall_time=500.0)
+    with open(accounting_file('sam_to_bam'), 'w') as accounting:
+        for r in [failed, first] + records[1:] + [records[0]]:
+            accounting.write(json.dumps(r) + '\n')
+
+    pilot_bytes = sum(r['input_bytes'] for r in records)
+    calibration = calibrate({'sam_to_bam': 100}, pilot_bytes, 100 * pilot_bytes,
+                            largest_chunk=4000, n_chunks=100)
+
+    stage = calibration['stages']['sam_to_bam']
+    assert stage['input_gb'] == round(100 * pilot_bytes / 1024**3, 2)
+    assert stage == calibrate_stage(records, 100, 100 * pilot_bytes, 4000)
+
+
+def test_representative_chunks(tmp_path):
+    chunks = []
+    for i, size in enumerate([5, 1, 3, 4, 2]):
+        (tmp_path / f'{i}.fastq').write_bytes(b'@' * size)
+        chunks.append((str(tmp_path / f'{i}.fastq'),))
+    # The pairs count both of their files
+    (tmp_path / 'R1.fastq').write_bytes(b'@' * 3)
+    (tmp_path / 'R2.fastq').write_bytes(b'@' * 3)
+    chunks.append((str(tmp_path / 'R1.fastq'), str(tmp_path / 'R2.fastq')))
+
+    sizes = lambda sampled: [sum(len(open(f, 'rb').read()) for f in chunk) for chunk in sampled]
+    assert sizes(representative_chunks(chunks, 3)) == [1, 3, 6]
+    assert sizes(representative_chunks(chunks, 1)) == [4]
+    assert len(representative_chunks(chunks, 10)) == 6
@@ -0,0 +1,47 @@
+"""
+Checking random samples of the reads with `script.quality_check.py`.
+"""
+
+from jobs import load_script
+
+
+quality_check = load_script('script.quality_check.py')
+
+
+def write_fastq(path, n_reads, name):
+    with open(path, 'w') as fastq:
+        for i in range(n_reads):
+            fastq.write(f'@{name}.{i}\nACGTACGTAC\n+\nIIIIIIIIII\n')
+    return str(path)
+
+
+# Two lanes of two chunks of each mate of mm1L, and a chunk of mm2R
+FILES = [f'mm1L_ATCACG_{lane}_{mate}_{chunk}.fastq'
+             for lane in ('L003', 'L004') for mate in ('R1', 'R2') for chunk in ('001', '002')]
+FILES += ['mm2R_CGATGT_L003_R1_001.fastq']
+
+
+def test_sample_groups():
+    by_sample = quality_check.sample_groups(FILES, 'sample')
+    assert by_sample == {'mm1L_R1': [f for f in FILES if f.startswith('mm1L') and '_R1_' in f],
+                         'mm1L_R2': [f for f in FILES if '_R2_' in f],
+                         'mm2R_R1': [FILES[-1]]}
+    assert len(by_sample['mm1L_R1']) == 4
+
+    by_file = quality_check.sample_groups(FILES)
+    assert list(by_file) == [f[:-len('.fastq')] for f in FILES]
+
+
+def test_sample_across_lanes(tmp_path):
+    # A single sample of the reads of every lane and chunk of the sample and mate
+    files = [write_fastq(tmp_path / f, 100, f.split('.')[0]) for f in FILES]
+    (name, group), = [(n, g) for n, g in quality_check.sample_groups(files, 'sample').items()
+                          if n == 'mm1L_R1']
+
+    sampled_file, report = quality_check.sample_reads(name, group, 200, tmp_path)
+    assert sampled_file == str(tmp_path / 'mm1L_R1.sample200.fastq')
+    assert report['confidence']['total_reads'] == 400
+
+    with open(sampled_file) as fastq:
+        chunks = {line[1:].split('.')[0] for line in fastq.read().splitlines()[0::4]}
+    assert chunks == {f.split('.')[0] for f in FILES[:2] + FILES[4:6]}
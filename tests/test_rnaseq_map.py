@@ -0,0 +1,58 @@
+"""
+Assembling the mapping commands with `script.rnaseq_map.py`.
+"""
+
+from jobs import load_script
+
+
+rnaseq_map = load_script('script.rnaseq_map.py')
+pipeline = load_script('script.pipeline.py')
+
+FILES = {'paired': [('trimmed/mm1L_ATCACG_L003_R1_paired_001.fastq',
+                     'trimmed/mm1L_ATCACG_L003_R2_paired_001.fastq')],
+         'unpaired': ['trimmed/mm1L_ATCACG_L003_R1_unpaired_001.fastq']}
+
+
+def commands(**kwargs):
+    return list(rnaseq_map.assemble_commands(FILES, 'index/genome', 'mapped', **kwargs))
+
+
+def test_hisat2_uses_the_cores():
+    unpaired, paired = commands(n_cores=8)
+    assert unpaired.startswith('hisat2 -p 8 --dta -x index/genome -U trimmed/')
+    assert paired.startswith('hisat2 -p 8 --dta -x index/genome -1 trimmed/')
+    assert paired.endswith('-S mapped/mm1L_ATCACG_L003_paired_001.sam')
+
+
+def test_sorting_leaves_a_core():
+    _, paired = commands(n_cores=8, sort=True, collapse=True, min_alignment_rate=20)
+    programs = [part.split() for part in paired.split('|')]
+    hisat2 = next(p for p in programs if p[0] == 'hisat2')
+    assert hisat2[1:3] == ['-p', '7']
+    assert programs[-1][:4] == ['samtools', 'sort', '-@', '1']
+
+    _, paired = commands(n_cores=1, sort=True)
+    assert paired.startswith('hisat2 -p 1 ')
+
+
+def test_with_threads():
+    _, paired = commands(n_cores=1, sort=True)
+    assert rnaseq_map.with_threads(paired, 4).startswith('hisat2 -p 3 ')
+    assert '-@ 1 ' in rnaseq_map.with_threads(paired, 4)
+
+    _, paired = commands(n_cores=1)
+    assert rnaseq_map.with_threads(paired, 4).startswith('hisat2 -p 4 ')
+
+
+def test_fused_commands_share_the_cores():
+    trimming = ('script.trim.py PE -threads 4 -phred33 raw/mm1L_R1_001.fastq raw/mm1L_R2_001.fastq'
+                f' {FILES["paired"][0][0]} trimmed/u1.fastq {FILES["paired"][0][1]} trimmed/u2.fastq'
+                ' LEADING:3')
+    _, mapping = commands(n_cores=8, sort=True)
+    fused, = pipeline.fuse_commands([trimming], [mapping], n_cores=6)
+
+    programs = [part.split() for part in fused.split('|')]
+    assert programs[0][programs[0].index('-threads') + 1] == '1'
+    assert programs[1][:3] == ['hisat2', '-p', '5'] and programs[1].count('-p') == 1
+    assert programs[1][-2:] == ['--interleaved', '-']
+    assert programs[2][:4] == ['samtools', 'sort', '-@', '1']
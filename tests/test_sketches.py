@@ -0,0 +1,82 @@
+"""
+Sketching the duplication of the reads with `sketches.py`.
+"""
+
+import numpy as np
+import pytest
+
+from sketches import (file_sketch, merge_sketches, distinct_reads, estimate_copies,
+                      summarize_sketch, hash_reads, leading_zeros, HLL_BITS)
+from fastq import read_chunks
+
+
+def random_sequences(n, length, seed=0):
+    rng = np.random.default_rng(seed)
+    bases = np.array(list(b'ACGT'), dtype=np.uint8)[rng.integers(0, 4, (n, length))]
+    return [row.tobytes().decode() for row in bases]
+
+
+def write_fastq(path, sequences):
+    with open(path, 'w') as fastq:
+        for i, sequence in enumerate(sequences):
+            fastq.write(f'@read{i}\n{sequence}\n+\n{"I" * len(sequence)}\n')
+    return str(path)
+
+
+# The relative error of the HyperLogLog, 1.04 / sqrt(2^HLL_BITS)
+ERROR = 1.04 / np.sqrt(2**HLL_BITS)
+
+
+@pytest.mark.parametrize('n_distinct', [1000, 50_000])
+def test_distinct_reads(tmp_path, n_distinct):
+    # Each read is repeated 3 times, in order and shuffled
+    sequences = random_sequences(n_distinct, 40) * 3
+    np.random.default_rng(1).shuffle(sequences)
+    sketch = file_sketch(write_fastq(tmp_path / 'reads.fastq', sequences), chunk_reads=4096)
+
+    assert sketch['reads'] == 3 * n_distinct
+    assert abs(distinct_reads(sketch['registers']) / n_distinct - 1) < 3 * ERROR
+
+    summary = summarize_sketch(sketch)
+    assert abs(summary['distinct_fraction'] - 1 / 3) < ERROR
+
+
+def test_merge_sketches(tmp_path):
+    # Two files sharing half of their reads
+    sequences = random_sequences(30_000, 40)
+    first = write_fastq(tmp_path / 'first.fastq', sequences[:20_000])
+    second = write_fastq(tmp_path / 'second.fastq', sequences[10_000:])
+    both = write_fastq(tmp_path / 'both.fastq', sequences[:20_000] + sequences[10_000:])
+
+    merged = merge_sketches(file_sketch(first), file_sketch(second))
+    together = file_sketch(both, chunk_reads=7000)
+
+    assert merged['reads'] == together['reads'] == 40_000
+    assert np.array_equal(merged['registers'], together['registers'])
+    assert np.array_equal(merged['counts'], together['counts'])
+    assert abs(distinct_reads(merged['registers']) / 30_000 - 1) < 3 * ERROR
+
+
+def test_duplicated_sequences(tmp_path):
+    # 500 copies of one read and 50 of another, among 10000 distinct reads,
+    # in chunks with only a few copies each.
+    frequent, rare = 'A' * 40, 'ACGT' * 10
+    sequences = random_sequences(10_000, 40) + [frequent] * 500 + [rare] * 50
+    np.random.default_rng(2).shuffle(sequences)
+    sketch = file_sketch(write_fastq(tmp_path / 'reads.fastq', sequences), chunk_reads=1000)
+
+    # The count-min sketch never underestimates the copies
+    (chunk, _, lengths), = read_chunks(write_fastq(tmp_path / 'query.fastq', [frequent, rare]))
+    copies = estimate_copies(sketch, hash_reads(chunk, lengths))
+    assert copies[0] >= 500 and copies[1] >= 50
+    assert copies[0] - 500 <= 0.01 * sketch['reads']
+
+    summary = summarize_sketch(sketch, top=2)
+    assert [d['sequence'] for d in summary['duplicated_sequences']] == [frequent, rare]
+    assert summary['duplicated_sequences'][0]['copies'] == copies[0]
+    assert summary['duplicated_sequences'][0]['fraction'] == round(int(copies[0]) / 10_550, 6)
+
+
+def test_leading_zeros():
+    values = np.array([0, 1, 2**63, 2**40 + 5, 2**64 - 1], dtype=np.uint64)
+    assert leading_zeros(values).tolist() == [64, 63, 0, 23, 0]
@@ -0,0 +1,69 @@
+"""
+Executing the commands of the job array tasks with `tasks.py`.
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from tasks import task_exit_code, ABORTED_EXIT_CODE, HOLD_EXIT_CODE, REQUEUE_EXIT_CODE
+from jobs import load_script, run_local_chain
+
+
+MONITOR = Path(__file__).resolve().parent.parent / 'script.alignment_monitor.py'
+
+HEADER = b'@HD\tVN:1.0\tSO:unsorted\n'
+
+
+def write_sam(path, flags):
+    records = [b'read%d\t%d\t*\t0\t0\t*\t*\t0\t0\tACGT\t*\n' % (i, flag) for i, flag in enumerate(flags)]
+    path.write_bytes(HEADER + b''.join(records))
+    return str(path)
+
+
+def test_task_exit_code():
+    assert task_exit_code(ABORTED_EXIT_CODE) == HOLD_EXIT_CODE == 100
+    for code in (0, 1, REQUEUE_EXIT_CODE):
+        assert task_exit_code(code) == code
+
+
+@pytest.fixture
+def mapping_script(tmp_path, monkeypatch):
+    """A mapping job array whose first task aborts (its reads don't align) and
+    the second one doesn't."""
+    monkeypatch.chdir(tmp_path)
+    unaligned = write_sam(tmp_path / 'unaligned.sam', [4] * 10)
+    aligned = write_sam(tmp_path / 'aligned.sam', [0] * 10)
+    commands = [f'cat {sam} | {MONITOR} -m 50 -n 4 -o {tmp_path / name}.out.sam'
+                    for sam, name in ((unaligned, 'unaligned'), (aligned, 'aligned'))]
+
+    script = tmp_path / 'rnaseq_map_jobs.py'
+    script.write_text(load_script('script.rnaseq_map.py').assemble_script(commands))
+    return script
+
+
+def test_aborted_task_holds_sge(tmp_path, mapping_script):
+    # As SGE runs the tasks: the aborted one exits with the code that keeps
+    # the tasks depending on it (qsub -hold_jid_ad) on hold.
+    exit_codes = [subprocess.run([sys.executable, str(mapping_script)],
+                                 env=dict(os.environ, SGE_TASK_ID=str(task_id)),
+                                 capture_output=True).returncode
+                      for task_id in (1, 2)]
+
+    assert exit_codes == [HOLD_EXIT_CODE, 0]
+    assert not (tmp_path / 'unaligned.out.sam').exists()
+    assert (tmp_path / 'aligned.out.sam').read_bytes() == (tmp_path / 'aligned.sam').read_bytes()
+
+
+def test_aborted_task_stops_local_chain(tmp_path, mapping_script):
+    next_stage = tmp_path / 'next_stage.py'
+    next_stage.write_text('import os\n'
+                          'open(f"next.{os.environ[\'SGE_TASK_ID\']}", "w").close()\n')
+
+    exit_codes = run_local_chain([(mapping_script, 1, 1), (next_stage, 1, 1)], 2)
+
+    assert exit_codes == [[HOLD_EXIT_CODE, 0], [None, 0]]
+    assert not (tmp_path / 'next.1').exists() and (tmp_path / 'next.2').exists()
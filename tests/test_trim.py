@@ -0,0 +1,249 @@
+"""
+Trimming small FASTQ files with `trim.py`, as Trimmomatic.
+
+The expected outputs are worked out by hand from the steps of Trimmomatic
+(its manual and source, 0.38), on reads built so that they don't depend on
+the details of each implementation: the adapters overlap the reads by 20
+bases or more, and the windows of SLIDINGWINDOW go from good bases to bad
+bases at once. The same reads are in 'data/trimmomatic', with the outputs
+of Trimmomatic 0.38 itself for several steps, which the outputs of `trim.py`
+must match ('test_same_as_trimmomatic'). The known differences between both
+(see `trim.py`) don't show on these reads.
+"""
+
+import random
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from trim import (trim_files, parse_steps, apply_steps, parse_arguments, write_summary,
+                  to_reads, reverse_complement, encode)
+
+
+# The TruSeq adapters, as in Trimmomatic's TruSeq3-PE-2.fa
+PREFIX1 = 'TACACTCTTTCCCTACACGACGCTCTTCCGATCT'
+PREFIX2 = 'GTGACTGGAGTTCAGACGTGTGCTCTTCCGATCT'
+ADAPTER = 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC'
+
+GOOD, LOW, BAD, BEST = 'I', '+', '#', 'Z'   # Phred 40, 10, 2 and 57
+
+
+def revcomp(sequence):
+    return sequence[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+
+
+def random_bases(n, seed):
+    generator = random.Random(seed)
+    return ''.join(generator.choice('ACGT') for _ in range(n))
+
+
+def write_fastq(path, reads):
+    with open(path, 'w') as fastq:
+        for name, sequence, qualities in reads:
+            fastq.write(f'@{name}\n{sequence}\n+\n{qualities}\n')
+    return str(path)
+
+
+def read_fastq(path):
+    with open(path) as fastq:
+        lines = fastq.read().split('\n')
+    return [(name[1:], sequence, qualities)
+                for name, sequence, qualities in zip(lines[0::4], lines[1::4], lines[3::4])]
+
+
+def trim(tmp_path, mode, reads, steps):
+    """Trim the reads (a list, or two for pairs) and return the outputs and counts."""
+    inputs = [write_fastq(tmp_path / f'input{i}.fastq', mate_reads)
+                  for i, mate_reads in enumerate(reads, start=1)]
+    names = ['trimmed'] if mode == 'SE' else ['paired1', 'unpaired1', 'paired2', 'unpaired2']
+    outputs = [str(tmp_path / f'{name}.fastq') for name in names]
+
+    counts = trim_files(mode, inputs, outputs, steps)
+    return [read_fastq(output) for output in outputs], counts
+
+
+def test_leading_trailing_crop_headcrop():
+    qualities = BAD * 3 + GOOD * 20 + BAD * 2
+    lines = [b'@r', random_bases(25, 1).encode(), b'+', qualities.encode()]
+    reads = [to_reads(lines)]
+
+    def cut(*steps):
+        (start, end, kept), = apply_steps(reads, parse_steps(list(steps)))
+        return int(start[0]), int(end[0]), bool(kept[0])
+
+    assert cut('LEADING:3') == (3, 25, True)
+    assert cut('TRAILING:3') == (0, 23, True)
+    assert cut('LEADING:3', 'TRAILING:3') == (3, 23, True)
+    assert cut('HEADCROP:5') == (5, 25, True)
+    assert cut('CROP:10') == (0, 10, True)
+    assert cut('HEADCROP:5', 'CROP:10') == (5, 15, True)
+    assert cut('CROP:10', 'HEADCROP:5') == (5, 10, True)
+    assert cut('LEADING:3', 'TRAILING:3', 'MINLEN:20') == (3, 23, True)
+    assert cut('LEADING:3', 'TRAILING:3', 'MINLEN:21')[2] is False
+    # A read with no good base is removed entirely
+    assert cut('HEADCROP:25')[2] is False
+
+
+def test_sliding_window():
+    # The window at 21 (4 bad bases) is the first one below 15; the one at
+    # 20 has a mean of (57 + 3 * 2) / 4 = 15.75.
+    qualities = GOOD * 20 + BEST + BAD * 8
+    lines = [b'@r', random_bases(29, 2).encode(), b'+', qualities.encode()]
+    (start, end, kept), = apply_steps([to_reads(lines)], parse_steps(['SLIDINGWINDOW:4:15']))
+    assert (start[0], end[0], kept[0]) == (0, 21, True)
+
+    # Good windows up to the end: nothing is cut
+    lines[3] = (GOOD * 29).encode()
+    (_, end, _), = apply_steps([to_reads(lines)], parse_steps(['SLIDINGWINDOW:4:15']))
+    assert end[0] == 29
+
+    # A bad first window removes the read
+    lines[3] = (BAD * 4 + GOOD * 25).encode()
+    (_, _, kept), = apply_steps([to_reads(lines)], parse_steps(['SLIDINGWINDOW:4:15', 'MINLEN:1']))
+    assert not kept[0]
+
+
+@pytest.fixture
+def adapters(tmp_path):
+    path = tmp_path / 'adapters.fa'
+    path.write_text(f'>PrefixPE/1\n{PREFIX1}\n>PrefixPE/2\n{PREFIX2}\n'
+                    f'>PE1\n{PREFIX1}\n>PE1_rc\n{revcomp(PREFIX1)}\n'
+                    f'>PE2\n{PREFIX2}\n>PE2_rc\n{revcomp(PREFIX2)}\n'
+                    f'>Universal\n{ADAPTER}\n')
+    return str(path)
+
+
+def se_reads():
+    """Single reads: an adapter at 30, low quality ends, a low quality window,
+    a short read and a clean one."""
+    return [('adapter', random_bases(30, 3) + ADAPTER[:20], GOOD * 50),
+            ('ends', random_bases(50, 4), BAD * 2 + GOOD * 45 + BAD * 3),
+            ('window', random_bases(50, 5), GOOD * 35 + BEST + LOW * 14),
+            ('short', random_bases(50, 6), GOOD * 10 + BAD * 40),
+            ('clean', random_bases(50, 7), GOOD * 50)]
+
+
+SE_STEPS = ['LEADING:3', 'TRAILING:3', 'SLIDINGWINDOW:4:15', 'MINLEN:20']
+
+
+def test_single_end(tmp_path, adapters):
+    reads = se_reads()
+    (trimmed,), counts = trim(tmp_path, 'SE', [reads], [f'ILLUMINACLIP:{adapters}:2:30:10'] + SE_STEPS)
+
+    expected = [('adapter', reads[0][1][:30], GOOD * 30),
+                ('ends', reads[1][1][2:47], GOOD * 45),
+                ('window', reads[2][1][:36], GOOD * 35 + BEST),
+                ('clean', reads[4][1], GOOD * 50)]
+    assert trimmed == expected
+    assert counts == {'input': 5, 'surviving': [4]}
+
+
+def test_single_end_crop(tmp_path):
+    reads = se_reads()
+    (trimmed,), _ = trim(tmp_path, 'SE', [reads], ['HEADCROP:5', 'CROP:30', 'MINLEN:31'])
+    assert trimmed == []
+
+    (trimmed,), _ = trim(tmp_path, 'SE', [reads], ['HEADCROP:5', 'CROP:30', 'MINLEN:30'])
+    assert trimmed == [(name, sequence[5:35], qualities[5:35]) for name, sequence, qualities in reads]
+
+
+def pe_reads():
+    """Pairs: a short insert (30) read into the adapters, a pair with a bad
+    reverse read, a pair with a bad forward read, a bad pair and a clean pair."""
+    insert = random_bases(30, 8)
+    forward = [('insert/1', insert + revcomp(PREFIX2)[:20], GOOD * 50)]
+    reverse = [('insert/2', revcomp(insert) + revcomp(PREFIX1)[:20], GOOD * 50)]
+
+    for i, (quality1, quality2) in enumerate([(GOOD, BAD), (BAD, GOOD), (BAD, BAD), (GOOD, GOOD)]):
+        name = ['forward_only', 'reverse_only', 'dropped', 'clean'][i]
+        forward.append((f'{name}/1', random_bases(50, 10 + i), quality1 * 50))
+        reverse.append((f'{name}/2', random_bases(50, 20 + i), quality2 * 50))
+
+    return forward, reverse
+
+
+def test_paired_end_palindrome(tmp_path, adapters):
+    forward, reverse = pe_reads()
+    steps = [f'ILLUMINACLIP:{adapters}:2:30:10'] + SE_STEPS
+    (paired1, unpaired1, paired2, unpaired2), counts = trim(tmp_path, 'PE', [forward, reverse], steps)
+
+    # The reverse read of a palindrome is dropped, it only repeats the forward one
+    assert paired1 == [forward[4]]
+    assert paired2 == [reverse[4]]
+    assert unpaired1 == [('insert/1', forward[0][1][:30], GOOD * 30), forward[1]]
+    assert unpaired2 == [reverse[2]]
+    assert counts == {'input': 5, 'surviving': [1, 2, 1, 1]}
+
+
+def test_paired_end_keep_both(tmp_path, adapters):
+    forward, reverse = pe_reads()
+    steps = [f'ILLUMINACLIP:{adapters}:2:30:10:8:true', 'MINLEN:20']
+    (paired1, _, paired2, _), _ = trim(tmp_path, 'PE', [forward, reverse], steps)
+
+    assert paired1[0] == ('insert/1', forward[0][1][:30], GOOD * 30)
+    assert paired2[0] == ('insert/2', reverse[0][1][:30], GOOD * 30)
+    assert len(paired1) == len(paired2) == 5
+
+
+def test_paired_end_simple(tmp_path, adapters):
+    # Without the prefixes only the simple mode clips the reads
+    forward, reverse = pe_reads()
+    simple = tmp_path / 'simple.fa'
+    simple.write_text(f'>Universal\n{ADAPTER}\n>Universal_rc\n{revcomp(ADAPTER)}\n')
+    (paired1, _, paired2, _), _ = trim(tmp_path, 'PE', [forward, reverse],
+                                       [f'ILLUMINACLIP:{simple}:2:30:10'])
+
+    assert paired1[0] == ('insert/1', forward[0][1][:30], GOOD * 30)
+    assert paired2[0] == reverse[0]
+
+
+def test_summary(tmp_path):
+    summary = tmp_path / 'summary.txt'
+    write_summary(summary, {'input': 5, 'surviving': [1, 2, 1, 1]})
+    lines = summary.read_text().splitlines()
+    assert 'Input Read Pairs: 5' in lines
+    assert 'Both Surviving Reads: 1' in lines
+    assert 'Forward Only Surviving Reads: 2' in lines
+    assert 'Reverse Only Surviving Reads: 1' in lines
+    assert 'Dropped Reads: 1' in lines
+
+
+def test_arguments():
+    args = ('PE -threads 4 -phred33 -summary s.txt -trimlog log.txt a1 a2 p1 u1 p2 u2 '
+            'LEADING:3 MINLEN:36').split()
+    assert parse_arguments(args) == ('PE', 4, 33, ['a1', 'a2'], ['p1', 'u1', 'p2', 'u2'],
+                                     ['LEADING:3', 'MINLEN:36'], 's.txt')
+    with pytest.raises(ValueError):
+        parse_steps(['AVGQUAL:20'])
+
+
+def test_reverse_complement():
+    codes = encode('AACGTN')
+    assert np.array_equal(reverse_complement(codes), encode('NACGTT'))
+
+
+# The golden outputs of Trimmomatic 0.38, see 'data/trimmomatic/make_golden.sh'
+GOLDEN = Path(__file__).resolve().parent / 'data' / 'trimmomatic'
+
+
+def golden_cases():
+    with open(GOLDEN / 'cases.tsv') as cases:
+        return [line.rstrip('\n').split('\t') for line in cases if not line.startswith('#')]
+
+
+@pytest.mark.parametrize('name, mode, inputs, steps', golden_cases())
+def test_same_as_trimmomatic(tmp_path, monkeypatch, name, mode, inputs, steps):
+    names = [name] if mode == 'SE' else [f'{name}_{output}' for output in
+                                         ('paired1', 'unpaired1', 'paired2', 'unpaired2')]
+    expected = [GOLDEN / 'expected' / f'{output}.fastq' for output in names]
+    if not all(path.exists() for path in expected):
+        pytest.xfail('The outputs of Trimmomatic 0.38 are not generated yet'
+                     ' (tests/data/trimmomatic/make_golden.sh).')
+
+    # The inputs and the adapters are named relative to the fixture
+    monkeypatch.chdir(GOLDEN)
+    outputs = [str(tmp_path / f'{output}.fastq') for output in names]
+    trim_files(mode, inputs.split(), outputs, steps.split())
+
+    assert [read_fastq(output) for output in outputs] == [read_fastq(path) for path in expected]
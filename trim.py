@@ -0,0 +1,972 @@
+"""
+Trimming the reads with NumPy.
+==============================
+
+Author: Andrés García García @ Sept 2018
+
+The trimming (`script.trimming.py`) runs Trimmomatic on every FASTQ chunk,
+each time starting a Java virtual machine, with the steps:
+
+    ILLUMINACLIP:<adapters>:2:30:10 LEADING:3 TRAILING:3 SLIDINGWINDOW:4:15 MINLEN:36
+
+This module applies the same steps to chunks of many reads at once, as NumPy
+arrays (see `fastq.py`). Each step only moves the start and the end of each
+read; the reads are cut (and the ones too short dropped) when writing them.
+The chunks are trimmed by a pool of processes and written in order as they
+are done, so the memory used doesn't depend on the size of the files.
+
+See `script.trim.py` for the command line interface, which takes the same
+arguments as Trimmomatic.
+
+Adapters
+--------
+As in Trimmomatic, an adapter (or its reverse complement) laid over the read
+at some offset scores log10(4) for each matching base and -Q/10 for each
+mismatch of quality Q, and the read is clipped at the first offset scoring
+more than the 'simple clip' threshold. Instead of trying every offset of
+every adapter, the k-mers of the adapters are indexed ('adapter_index'), and
+only the offsets where a k-mer of the read is found in an adapter are scored.
+
+With pairs of reads, the adapters named 'Prefix.../1' and 'Prefix.../2' are
+used to find the pairs whose insert is shorter than the reads ("palindrome"
+mode): the forward read, with its prefix, is laid over the reverse
+complement of the reverse read, with its prefix, and if they score more than
+the 'palindrome clip' threshold both reads are clipped to the length of the
+insert. As in Trimmomatic, the reverse read is then dropped, unless
+'keepBothReads' is given.
+
+Differences with Trimmomatic
+----------------------------
+The outputs of Trimmomatic 0.38 for a few small files are kept with the
+tests ('tests/data/trimmomatic'). The known differences, none of which shows
+on those files, are:
+
+    - ILLUMINACLIP: The seeds are exact k-mers (SEED_LENGTH bases) instead
+      of 16 bases with up to 'seed mismatches' mismatches, and that
+      parameter is ignored. An adapter with a mismatch in every SEED_LENGTH
+      bases is missed, and one overlapping the read by less than SEED_LENGTH
+      bases is never found (it can't score above a simple threshold of 5 or
+      more anyway).
+    - ILLUMINACLIP, palindrome mode: Only the k-mers of the forward read
+      that don't overlap each other are seeds, so inserts shorter than twice
+      SEED_LENGTH may be missed. A mismatch is penalized by the lower quality
+      of its two bases, and the bases of the prefixes count as the best
+      quality of the chunk.
+    - SLIDINGWINDOW: The read is cut at the start of the first window whose
+      mean quality is below the threshold, and only there: the good bases at
+      the start of that window are not kept, and the bases before it are
+      kept whatever their quality. Reads shorter than the window are left as
+      they are. So reads whose quality drops gradually may be cut at a
+      different base than by Trimmomatic.
+    - Only the steps ILLUMINACLIP, LEADING, TRAILING, SLIDINGWINDOW, CROP,
+      HEADCROP and MINLEN are known (any other one is an error), and
+      '-trimlog' is ignored. The qualities are Phred+33 unless '-phred64' is
+      given; they are not guessed from the reads.
+
+The reads trimmed by both tools can be compared with 'compare_trimming'
+(`script.trim.py compare`).
+
+Detecting the adapters
+----------------------
+Every read is tested against every adapter of the file given to ILLUMINACLIP,
+and the default file has the adapters of every TruSeq and Nextera kit. But
+only the adapters of one kit were used in each library. 'detect_adapters'
+looks for the k-mers (DETECTION_LENGTH) of each adapter in a sample of the
+reads, and keeps the adapters found in enough of them, so that a minimal
+adapters file can be written for each sample.
+
+Probing the reads
+-----------------
+Many chunks of a good library are barely changed by the trimming, but they
+are still read and written again in full. 'probe' applies the adapter and
+the quality steps to the first reads of a chunk and measures how many reads
+they would change. If both rates are below the given thresholds, the command
+is replaced ('probe_command') by a cheap one: the output files are just
+links to the input files (when no read would be dropped by MINLEN either),
+or only the MINLEN step is applied.
+
+"""
+
+import sys
+import gzip
+import math
+from pathlib import Path
+from functools import partial
+from multiprocessing import Pool
+from typing import Union, List, Tuple, Dict, Optional
+
+import numpy as np
+
+from fastq import read_records, to_arrays, BASE_INDEX, CHUNK_READS, PHRED_OFFSET
+
+
+# Reported by '-version', and part of the fingerprint of the trimming tasks
+VERSION = '0.1'
+
+# The length of the k-mers used to find the candidate adapters
+SEED_LENGTH = 8
+
+# Score of a matching base, as in Trimmomatic
+MATCH_SCORE = math.log10(4)
+
+# The code of the bases (as in 'fastq.BASES'), N is 4. Used to pad the adapters.
+PADDING = 5
+
+# The length of the k-mers used to detect the adapters in the reads
+DETECTION_LENGTH = 16
+
+# How many reads are looked at to detect the adapters of a sample
+DETECTION_READS = 200_000
+
+# The fraction of the reads above which an adapter is present
+DETECTION_FRACTION = 0.001
+
+# How many reads of a chunk are probed
+PROBE_READS = 10_000
+
+# The fractions of the probed reads with adapters and with low quality ends
+# below which a chunk is clean (see 'probe_command')
+CLEAN_ADAPTER_RATE = 0.001
+CLEAN_LOW_QUALITY_RATE = 0.01
+
+# The trimming steps used by the current process (see 'set_steps')
+_steps = []
+
+
+#### <<<<<< ADAPTERS >>>>>>> ####
+
+def read_fasta(path: Union[str, Path]) -> List[Tuple[str, str]]:
+    """Read the (name, sequence) of each sequence of a FASTA file.
+
+    The names may repeat, e.g. in a file made by joining the adapter files of
+    several kits.
+    """
+    sequences = []
+
+    for line in Path(path).read_text().split('\n'):
+        line = line.strip()
+        if line.startswith('>'):
+            sequences.append((line[1:].split()[0], ''))
+        elif line and sequences:
+            name, sequence = sequences[-1]
+            sequences[-1] = (name, sequence + line.upper())
+
+    return sequences
+# ---
+
+def write_fasta(sequences: List[Tuple[str, str]], path: Union[str, Path]):
+    """Write the (name, sequence) of each sequence to a FASTA file.
+
+    An existing file with the same contents is left untouched, so that the
+    commands using it are not executed again (see `tasks.py`).
+    """
+    contents = ''.join(f'>{name}\n{sequence}\n' for name, sequence in sequences)
+    if not (Path(path).exists() and Path(path).read_text() == contents):
+        Path(path).write_text(contents)
+# ---
+
+def encode(sequence: Union[str, bytes]) -> np.ndarray:
+    """The codes of the bases of the sequence (A 0, C 1, G 2, T 3, anything else 4)."""
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+    return BASE_INDEX[np.frombuffer(sequence, dtype=np.uint8)]
+# ---
+
+def reverse_complement(codes: np.ndarray) -> np.ndarray:
+    """The reverse complement of the encoded sequence (N stays N)."""
+    return np.where(codes < 4, 3 - codes, codes)[::-1].astype(np.uint8)
+# ---
+
+def pad(sequences: List[np.ndarray]) -> np.ndarray:
+    """Put the encoded sequences in the rows of a matrix, padded with PADDING."""
+    width = max((len(s) for s in sequences), default=0)
+    matrix = np.full((len(sequences), width), PADDING, dtype=np.uint8)
+    for i, sequence in enumerate(sequences):
+        matrix[i, :len(sequence)] = sequence
+    return matrix
+# ---
+
+def kmer_codes(codes: np.ndarray, k: int = SEED_LENGTH) -> np.ndarray:
+    """The k-mers starting at each position of the encoded sequences (rows), as integers.
+
+    The k-mers with an N (or past the end of the sequence) are -1.
+    """
+    n_kmers = codes.shape[1] - k + 1
+    if n_kmers <= 0:
+        return np.full((codes.shape[0], 0), -1, dtype=np.int32)
+
+    bases = (codes & 3).astype(np.int32 if k < 16 else np.int64)
+    kmers = bases[:, :n_kmers].copy()
+    for j in range(1, k):
+        kmers <<= 2
+        kmers |= bases[:, j:j+n_kmers]
+
+    invalid = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=np.int32)
+    np.cumsum(codes > 3, axis=1, out=invalid[:, 1:])
+    kmers[invalid[:, k:] - invalid[:, :n_kmers] > 0] = -1
+
+    return kmers
+# ---
+
+def adapter_index(adapters: List[np.ndarray], k: int = SEED_LENGTH) -> Dict[str, np.ndarray]:
+    """Index the k-mers of the encoded adapters.
+
+    Output: A dictionary with:
+        adapter, position: The adapter and the position of each k-mer of the
+                           adapters, sorted by k-mer.
+        first: The first entry of each k-mer (all the possible ones) in the
+               sorted k-mers, so that the entries of the k-mer x go from
+               first[x] to first[x+1].
+        codes: The adapters (a row each, padded).
+    """
+    codes = pad(adapters)
+    kmers = kmer_codes(codes, k)
+    adapter, position = np.nonzero(kmers >= 0)
+    kmers = kmers[adapter, position]
+
+    order = np.argsort(kmers, kind='stable')
+    first = np.zeros(4**k + 1, dtype=np.int64)
+    np.cumsum(np.bincount(kmers, minlength=4**k), out=first[1:])
+
+    return {'adapter': adapter[order],
+            'position': position[order],
+            'first': first,
+            'codes': codes}
+# ---
+
+def seed_matches(kmers: np.ndarray,
+                 index: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the k-mers of the reads in the k-mers of the adapters.
+
+    Output: The read, the position in the read and the entry of the index of
+            every match (a k-mer found several times in the adapters gives a
+            match for each time).
+    """
+    valid = np.maximum(kmers, 0)
+    counts = np.where(kmers >= 0, index['first'][valid + 1] - index['first'][valid], 0)
+    rows, positions = np.nonzero(counts)
+
+    first = index['first'][kmers[rows, positions]]
+    counts = counts[rows, positions]
+
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    entries = np.repeat(first, counts) + np.arange(counts.sum()) - starts
+
+    return np.repeat(rows, counts), np.repeat(positions, counts), entries
+# ---
+
+def alignment_scores(codes: np.ndarray,
+                     qualities: np.ndarray,
+                     lengths: np.ndarray,
+                     other: np.ndarray,
+                     offsets: np.ndarray,
+                     other_qualities: Optional[np.ndarray] = None) -> np.ndarray:
+    """Score the encoded sequences laid over the reads at the given offsets.
+
+    Input:
+        codes, qualities, lengths: The reads (a row each).
+        other: The sequences laid over the reads (a row each, padded).
+        offsets: The position of the reads where each sequence starts (may be
+                 negative, when the sequence starts before the read).
+        other_qualities: The qualities of the other sequences, if they are
+                         reads too. The penalty of a mismatch uses the lowest
+                         quality of the two bases.
+    Output: The score of each read, log10(4) for each matching base and -Q/10
+            for each mismatch.
+    """
+    positions = offsets[:, np.newaxis] + np.arange(other.shape[1])
+    inside = (positions >= 0) & (positions < lengths[:, np.newaxis]) & (other != PADDING)
+    positions = np.clip(positions, 0, max(codes.shape[1] - 1, 0))
+
+    read_bases = np.take_along_axis(codes, positions, axis=1)
+    penalties = np.take_along_axis(qualities, positions, axis=1)
+    if other_qualities is not None:
+        penalties = np.minimum(penalties, other_qualities)
+
+    matches = (read_bases == other) & (read_bases < 4)
+    scores = np.where(matches, MATCH_SCORE, -np.maximum(penalties, 0) / 10)
+
+    return (scores * inside).sum(axis=1)
+# ---
+
+def simple_clip(codes: np.ndarray,
+                qualities: np.ndarray,
+                ends: np.ndarray,
+                index: Dict[str, np.ndarray],
+                threshold: float) -> np.ndarray:
+    """Clip the reads at the first adapter found ("simple" mode of Trimmomatic).
+
+    Input:
+        codes, qualities: The reads.
+        ends: The current end of each read.
+        index: The index of the adapters (see 'adapter_index').
+        threshold: The score above which an adapter is found.
+    Output: The new end of each read.
+    """
+    ends = ends.copy()
+    if not len(index['adapter']):
+        return ends
+
+    rows, positions, entries = seed_matches(kmer_codes(codes), index)
+    adapters = index['adapter'][entries]
+    offsets = positions - index['position'][entries]
+    if not len(rows):
+        return ends
+
+    # Each read, adapter and offset is scored once
+    n_adapters, n_offsets = len(index['codes']), codes.shape[1] + index['codes'].shape[1]
+    keys = np.unique((rows * n_adapters + adapters) * n_offsets + offsets + index['codes'].shape[1])
+    rows, adapters = np.divmod(keys // n_offsets, n_adapters)
+    offsets = keys % n_offsets - index['codes'].shape[1]
+
+    scores = alignment_scores(codes[rows], qualities[rows], ends[rows],
+                              index['codes'][adapters], offsets)
+    found = scores > threshold
+    np.minimum.at(ends, rows[found], np.maximum(offsets[found], 0))
+
+    return ends
+# ---
+
+def reverse_reads(codes: np.ndarray,
+                  qualities: np.ndarray,
+                  lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The reverse complement of the reads (and their qualities reversed), padded."""
+    positions = lengths[:, np.newaxis] - 1 - np.arange(codes.shape[1])
+    inside = positions >= 0
+    positions = np.maximum(positions, 0)
+
+    reversed_codes = np.take_along_axis(codes, positions, axis=1)
+    reversed_codes = np.where(reversed_codes < 4, 3 - reversed_codes, reversed_codes)
+    reversed_codes = np.where(inside, reversed_codes, PADDING).astype(np.uint8)
+    reversed_qualities = np.where(inside, np.take_along_axis(qualities, positions, axis=1), 0)
+
+    return reversed_codes, reversed_qualities
+# ---
+
+def palindrome_clip(forward: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                    reverse: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                    prefixes: Tuple[np.ndarray, np.ndarray],
+                    threshold: float,
+                    min_length: int = 8) -> np.ndarray:
+    """Find the pairs of reads with an insert shorter than the reads ("palindrome" mode).
+
+    Input:
+        forward, reverse: The codes, qualities and lengths of each read of the pairs.
+        prefixes: The encoded adapters ligated before the forward and the
+                  reverse reads ('Prefix.../1' and 'Prefix.../2').
+        threshold: The score above which the reads overlap.
+        min_length: The shortest insert considered.
+    Output: The length of the insert of each pair (-1 where the reads don't
+            overlap past their ends).
+    """
+    codes1, qualities1, lengths1 = forward
+    codes2, qualities2, lengths2 = reverse
+    prefix1, prefix2 = prefixes
+
+    inserts = np.full(len(lengths1), -1, dtype=np.int64)
+    if not len(lengths1):
+        return inserts
+
+    # The forward read is laid over the reverse complement of the reverse read
+    # where their k-mers match. In the reverse complement the insert ends
+    # where the read does, so a match of the position i of the forward read
+    # with the position j of the other means an insert of length2 - j + i.
+    # Only the k-mers of the forward read that don't overlap each other are
+    # looked for, an insert of twice their length has at least one of them.
+    reversed2, reversed_qualities2 = reverse_reads(codes2, qualities2, lengths2)
+    kmers1 = kmer_codes(codes1)
+    kmers2 = kmer_codes(reversed2)
+
+    rows, lengths = [], []
+    for position in range(0, kmers1.shape[1], SEED_LENGTH):
+        kmer = kmers1[:, position:position+1]
+        match_rows, other_positions = np.nonzero((kmers2 == kmer) & (kmer >= 0))
+        rows.append(match_rows)
+        lengths.append(lengths2[match_rows] - other_positions + position)
+    rows, lengths = np.concatenate(rows), np.concatenate(lengths)
+
+    # Each pair and length is scored once, if the reads go past the insert
+    n_lengths = codes1.shape[1] + codes2.shape[1]
+    keys = np.unique(rows * n_lengths + lengths)
+    rows, lengths = np.divmod(keys, n_lengths)
+    candidates = (((lengths < lengths1[rows]) | (lengths < lengths2[rows]))
+                      & (lengths >= min_length))
+    rows, lengths = rows[candidates], lengths[candidates]
+    if not len(rows):
+        return inserts
+
+    # The prefix of the forward read against the reverse complement of the
+    # prefix of the reverse read, past the end of the insert, are scored too.
+    tail = reverse_complement(prefix2)
+    width = reversed2.shape[1] + len(tail)
+    other = np.full((len(rows), width), PADDING, dtype=np.uint8)
+    other_qualities = np.zeros((len(rows), width), dtype=qualities2.dtype)
+    other[:, :reversed2.shape[1]] = reversed2[rows]
+    other_qualities[:, :reversed2.shape[1]] = reversed_qualities2[rows]
+    tail_positions = lengths2[rows, np.newaxis] + np.arange(len(tail))
+    np.put_along_axis(other, tail_positions, tail[np.newaxis, :], axis=1)
+    np.put_along_axis(other_qualities, tail_positions, qualities2.max(initial=0), axis=1)
+
+    # ... and laid, in turn, over the forward read with its prefix
+    front = prefix1
+    codes = np.concatenate([np.tile(front, (len(rows), 1)), codes1[rows]], axis=1)
+    qualities = np.concatenate([np.full((len(rows), len(front)), qualities1.max(initial=0),
+                                        dtype=qualities1.dtype),
+                                qualities1[rows]], axis=1)
+
+    offsets = len(front) + lengths - lengths2[rows]
+    scores = alignment_scores(codes, qualities, len(front) + lengths1[rows],
+                              other, offsets, other_qualities)
+
+    # The shortest insert found, if several
+    found = scores > threshold
+    shortest = np.full(len(inserts), np.iinfo(np.int64).max)
+    np.minimum.at(shortest, rows[found], lengths[found])
+
+    return np.where(shortest < np.iinfo(np.int64).max, shortest, inserts)
+# ---
+
+
+#### <<<<<< QUALITY >>>>>>> ####
+
+def leading(qualities: np.ndarray, starts: np.ndarray, ends: np.ndarray, quality: int) -> np.ndarray:
+    """Remove the bases from the start of the reads while their quality is below the given one.
+
+    Output: The new start of each read.
+    """
+    positions = np.arange(qualities.shape[1])
+    good = (qualities >= quality) & (positions >= starts[:, np.newaxis]) & (positions < ends[:, np.newaxis])
+    return np.where(good.any(axis=1), good.argmax(axis=1), ends)
+# ---
+
+def trailing(qualities: np.ndarray, starts: np.ndarray, ends: np.ndarray, quality: int) -> np.ndarray:
+    """Remove the bases from the end of the reads while their quality is below the given one.
+
+    Output: The new end of each read.
+    """
+    positions = np.arange(qualities.shape[1])
+    good = (qualities >= quality) & (positions >= starts[:, np.newaxis]) & (positions < ends[:, np.newaxis])
+    last = qualities.shape[1] - 1 - good[:, ::-1].argmax(axis=1)
+    return np.where(good.any(axis=1), last + 1, starts)
+# ---
+
+def sliding_window(qualities: np.ndarray,
+                   starts: np.ndarray,
+                   ends: np.ndarray,
+                   window: int,
+                   quality: float) -> np.ndarray:
+    """Cut the reads at the first window of bases whose mean quality is below the given one.
+
+    Output: The new end of each read.
+    """
+    n_windows = qualities.shape[1] - window + 1
+    if n_windows <= 0:
+        return ends
+
+    cumulative = np.zeros((qualities.shape[0], qualities.shape[1] + 1), dtype=np.int64)
+    np.cumsum(qualities, axis=1, out=cumulative[:, 1:])
+    sums = cumulative[:, window:] - cumulative[:, :n_windows]
+
+    positions = np.arange(n_windows)
+    low = ((sums < quality * window)
+               & (positions >= starts[:, np.newaxis])
+               & (positions + window <= ends[:, np.newaxis]))
+
+    return np.where(low.any(axis=1), low.argmax(axis=1), ends)
+# ---
+
+
+#### <<<<<< STEPS >>>>>>> ####
+
+def parse_steps(steps: List[str], mode: str = 'SE') -> List[Tuple[str, list]]:
+    """Parse the trimming steps, given as in Trimmomatic (e.g. 'SLIDINGWINDOW:4:15').
+
+    The adapters of the ILLUMINACLIP step are read and indexed: for the
+    forward (or single) reads and for the reverse reads, and the prefixes for
+    the palindrome mode.
+    """
+    parsed = []
+
+    for step in steps:
+        name, *params = step.split(':')
+
+        if name == 'ILLUMINACLIP':
+            adapters_file, _, palindrome, simple, *extra = params
+            min_length = int(extra[0]) if extra else 8
+            keep_both = len(extra) > 1 and extra[1].lower() == 'true'
+
+            adapters = read_fasta(adapters_file)
+            prefixes = {name[-1]: encode(sequence) for name, sequence in adapters
+                                                       if name.startswith('Prefix') and name[-2:] in ('/1', '/2')}
+            simple_adapters = {'1': [], '2': []}
+            seen = set()
+            for adapter, sequence in adapters:
+                if adapter.startswith('Prefix'):
+                    continue
+                codes = encode(sequence)
+                for read in ('1', '2'):
+                    # The same adapter may be in the file several times
+                    if not adapter.endswith('/1' if read == '2' else '/2') and (read, sequence) not in seen:
+                        simple_adapters[read] += [codes, reverse_complement(codes)]
+                        seen.add((read, sequence))
+
+            use_palindrome = mode == 'PE' and '1' in prefixes and '2' in prefixes
+            parsed.append((name, [adapter_index(simple_adapters['1']),
+                                  adapter_index(simple_adapters['2']),
+                                  (prefixes['1'], prefixes['2']) if use_palindrome else None,
+                                  float(palindrome), float(simple), min_length, keep_both]))
+
+        elif name in ('LEADING', 'TRAILING', 'MINLEN', 'CROP', 'HEADCROP'):
+            parsed.append((name, [int(params[0])]))
+
+        elif name == 'SLIDINGWINDOW':
+            parsed.append((name, [int(params[0]), float(params[1])]))
+
+        else:
+            raise ValueError(f'Unknown trimming step: {step}')
+
+    return parsed
+# ---
+
+def apply_steps(reads: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                steps: List[Tuple[str, list]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Apply the trimming steps to the reads (single reads, or the reads of the pairs).
+
+    Input:
+        reads: The codes, qualities and lengths of the reads; one tuple for
+               single reads, two for pairs (forward and reverse).
+        steps: The steps, as returned from 'parse_steps'.
+    Output: For each tuple of the input, the start and end of each read and
+            whether it is kept.
+    """
+    starts = [np.zeros(len(lengths), dtype=np.int64) for _, _, lengths in reads]
+    ends = [lengths.copy() for _, _, lengths in reads]
+    kept = [np.ones(len(lengths), dtype=bool) for _, _, lengths in reads]
+
+    for name, params in steps:
+        if name == 'ILLUMINACLIP':
+            indices = params[:2]
+            prefixes, palindrome, simple, min_length, keep_both = params[2:]
+
+            if prefixes is not None and len(reads) == 2:
+                inserts = palindrome_clip(reads[0], reads[1], prefixes, palindrome, min_length)
+                overlapped = inserts >= 0
+                for r in range(2):
+                    ends[r] = np.where(overlapped, np.minimum(ends[r], inserts), ends[r])
+                if not keep_both:
+                    kept[1] &= ~overlapped
+
+            for r, (codes, qualities, _) in enumerate(reads):
+                ends[r] = simple_clip(codes, qualities, ends[r], indices[r], simple)
+
+        for r, (_, qualities, _) in enumerate(reads):
+            if name == 'LEADING':
+                starts[r] = leading(qualities, starts[r], ends[r], params[0])
+            elif name == 'TRAILING':
+                ends[r] = trailing(qualities, starts[r], ends[r], params[0])
+            elif name == 'SLIDINGWINDOW':
+                ends[r] = sliding_window(qualities, starts[r], ends[r], *params)
+            elif name == 'CROP':
+                ends[r] = np.minimum(ends[r], starts[r] + params[0])
+            elif name == 'HEADCROP':
+                starts[r] = np.minimum(starts[r] + params[0], ends[r])
+            elif name == 'MINLEN':
+                kept[r] &= ends[r] - starts[r] >= params[0]
+
+            starts[r] = np.minimum(starts[r], ends[r])
+
+    return [(start, end, keep & (end > start))
+                for start, end, keep in zip(starts, ends, kept)]
+# ---
+
+def cut_records(lines: List[bytes],
+                starts: np.ndarray,
+                ends: np.ndarray,
+                kept: np.ndarray) -> List[bytes]:
+    """The FASTQ records of the kept reads, cut to their start and end."""
+    return [b'\n'.join((lines[4*i], lines[4*i+1][start:end], b'+', lines[4*i+3][start:end]))
+                for i, start, end in zip(np.flatnonzero(kept), starts[kept], ends[kept])]
+# ---
+
+def to_reads(lines: List[bytes],
+             phred_offset: int = PHRED_OFFSET) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The codes, qualities and lengths of the reads of the lines of a FASTQ chunk."""
+    sequences, qualities, lengths = to_arrays(lines)
+    return BASE_INDEX[sequences], qualities - (phred_offset - PHRED_OFFSET), lengths
+# ---
+
+def trim_chunk(chunk: Tuple[List[bytes], ...],
+               phred_offset: int = PHRED_OFFSET) -> Tuple[int, List[List[bytes]]]:
+    """Trim a chunk of single reads (a list of lines), or of pairs of reads (two lists).
+
+    Output: The number of reads (or pairs) of the chunk, and the records to
+            write to each output file: the trimmed reads, or the forward
+            paired, forward unpaired, reverse paired and reverse unpaired
+            reads (as Trimmomatic).
+    """
+    reads = [to_reads(lines, phred_offset) for lines in chunk]
+    trimmed = apply_steps(reads, _steps)
+    n_reads = len(chunk[0]) // 4
+
+    if len(chunk) == 1:
+        return n_reads, [cut_records(chunk[0], *trimmed[0])]
+
+    (starts1, ends1, kept1), (starts2, ends2, kept2) = trimmed
+    both = kept1 & kept2
+    return n_reads, [cut_records(chunk[0], starts1, ends1, both),
+                     cut_records(chunk[0], starts1, ends1, kept1 & ~kept2),
+                     cut_records(chunk[1], starts2, ends2, both),
+                     cut_records(chunk[1], starts2, ends2, kept2 & ~kept1)]
+# ---
+
+def set_steps(steps: List[Tuple[str, list]]):
+    """Set the trimming steps of the process (the initializer of the pool)."""
+    _steps[:] = steps
+# ---
+
+
+#### <<<<<< FILES >>>>>>> ####
+
+def parse_arguments(args: List[str]) -> Tuple[str, int, int, List[str], List[str], List[str], Optional[str]]:
+    """Split the arguments of a trimming command, as Trimmomatic.
+
+    Output: The mode ('SE' or 'PE'), threads, Phred offset, input files,
+            output files, steps and summary file (None if not given).
+    """
+    mode, *args = args
+
+    threads, phred_offset, summary = 1, PHRED_OFFSET, None
+    files, steps = [], []
+    skip = False
+    for i, arg in enumerate(args):
+        if skip:
+            skip = False
+        elif arg == '-threads':
+            threads = int(args[i+1])
+            skip = True
+        elif arg in ('-phred33', '-phred64'):
+            phred_offset = int(arg[-2:])
+        elif arg == '-summary':
+            summary = args[i+1]
+            skip = True
+        elif arg == '-trimlog':
+            # Not supported, ignored
+            skip = True
+        elif ':' in arg:
+            steps.append(arg)
+        else:
+            files.append(arg)
+
+    n_inputs = 1 if mode == 'SE' else 2
+    return mode, threads, phred_offset, files[:n_inputs], files[n_inputs:], steps, summary
+# ---
+
+def link_files(inputs: List[str], outputs: List[str]):
+    """Make the output files links to the input files, as if no read was trimmed.
+
+    The unpaired output files of pairs (the second and fourth) are left empty.
+    """
+    linked = outputs[:1] if len(inputs) == 1 else [outputs[0], outputs[2]]
+
+    for output in outputs:
+        if output not in linked:
+            open_output(output).close()
+    for input_file, output in zip(inputs, linked):
+        Path(output).symlink_to(Path(input_file).resolve())
+# ---
+
+def open_output(path: Union[str, Path]):
+    """Open the FASTQ file for writing in binary mode, compressing it if named '.gz'.
+
+    '-' is the standard output.
+    """
+    if str(path) == '-':
+        return open(sys.stdout.fileno(), 'wb', buffering=1024**2, closefd=False)
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'wb', compresslevel=4)
+    return open(path, 'wb', buffering=1024**2)
+# ---
+
+def trim_files(mode: str,
+               inputs: List[str],
+               outputs: List[str],
+               steps: List[str],
+               threads: int = 1,
+               phred_offset: int = PHRED_OFFSET,
+               chunk_reads: int = CHUNK_READS) -> Dict[str, object]:
+    """Trim the reads of the FASTQ files, as Trimmomatic.
+
+    Input:
+        mode: 'SE' for single reads, 'PE' for pairs.
+        inputs: The input file (SE) or the forward and reverse files (PE).
+        outputs: The output file (SE) or the forward paired, forward unpaired,
+                 reverse paired and reverse unpaired files (PE). Or just '-'
+                 to stream the kept reads to the standard output; with pairs,
+                 the pairs are interleaved and the unpaired reads discarded.
+        steps: The trimming steps, as given to Trimmomatic.
+        threads: The number of processes trimming chunks at the same time.
+        phred_offset: 33 or 64.
+        chunk_reads: The number of reads in each chunk.
+    Output: The number of input reads (or pairs), 'input', and the number of
+            reads kept in each category of 'trim_chunk', 'surviving'.
+    """
+    set_steps(parse_steps(steps, mode))
+
+    chunks = zip(*(read_records(path, chunk_reads) for path in inputs))
+    counts = {'input': 0, 'surviving': [0] * (1 if mode == 'SE' else 4)}
+    interleaved = mode == 'PE' and outputs == ['-']
+
+    pool = Pool(threads, initializer=set_steps, initargs=(_steps,)) if threads > 1 else None
+    try:
+        trim = partial(trim_chunk, phred_offset=phred_offset)
+        trimmed_chunks = pool.imap(trim, chunks) if pool else map(trim, chunks)
+
+        output_files = [open_output(output) for output in outputs]
+        try:
+            for n_reads, records in trimmed_chunks:
+                counts['input'] += n_reads
+                for category, category_records in enumerate(records):
+                    counts['surviving'][category] += len(category_records)
+                if interleaved:
+                    records = [[record for pair in zip(records[0], records[2]) for record in pair]]
+                for output_file, output_records in zip(output_files, records):
+                    if output_records:
+                        output_file.write(b'\n'.join(output_records) + b'\n')
+        finally:
+            for output_file in output_files:
+                output_file.close()
+    finally:
+        if pool:
+            pool.terminate()
+
+    return counts
+# ---
+
+def write_summary(summary: Union[str, Path], counts: Dict[str, object]):
+    """Write the counts of 'trim_files' to the summary file, as Trimmomatic's '-summary'."""
+    total = counts['input']
+    percent = lambda n: f'{100 * n / max(total, 1):.2f}'
+
+    if len(counts['surviving']) == 1:
+        kept, = counts['surviving']
+        lines = [f'Input Reads: {total}',
+                 f'Surviving Reads: {kept}',
+                 f'Surviving Read Percent: {percent(kept)}']
+    else:
+        both, forward, _, reverse = counts['surviving']
+        kept = both + forward + reverse
+        lines = [f'Input Read Pairs: {total}',
+                 f'Both Surviving Reads: {both}',
+                 f'Both Surviving Read Percent: {percent(both)}',
+                 f'Forward Only Surviving Reads: {forward}',
+                 f'Forward Only Surviving Read Percent: {percent(forward)}',
+                 f'Reverse Only Surviving Reads: {reverse}',
+                 f'Reverse Only Surviving Read Percent: {percent(reverse)}']
+
+    lines += [f'Dropped Reads: {total - kept}',
+              f'Dropped Read Percent: {percent(total - kept)}']
+
+    with open(summary, 'w') as summary_file:
+        summary_file.write('\n'.join(lines) + '\n')
+# ---
+
+def compare_trimming(reference: Union[str, Path],
+                     trimmed: Union[str, Path],
+                     chunk_reads: int = CHUNK_READS) -> Dict[str, float]:
+    """Compare the reads trimmed by two tools (e.g. Trimmomatic and this module).
+
+    Input: Two FASTQ files, trimmed from the same input.
+    Output: The number of reads kept in each one and in both, the fraction of
+            the reads in both trimmed to the same length, and the mean
+            absolute difference of their lengths.
+    """
+    def lengths_by_name(path):
+        lengths = dict()
+        for lines in read_records(path, chunk_reads):
+            for header, sequence in zip(lines[0::4], lines[1::4]):
+                lengths[header.split()[0]] = len(sequence)
+        return lengths
+    # ---
+
+    reference_lengths = lengths_by_name(reference)
+    trimmed_lengths = lengths_by_name(trimmed)
+
+    common = [name for name in reference_lengths if name in trimmed_lengths]
+    differences = np.array([abs(reference_lengths[name] - trimmed_lengths[name])
+                                for name in common])
+
+    return {'reference_reads': len(reference_lengths),
+            'trimmed_reads': len(trimmed_lengths),
+            'common_reads': len(common),
+            'same_length_fraction': float((differences == 0).mean()) if len(common) else 1.0,
+            'mean_length_difference': float(differences.mean()) if len(common) else 0.0}
+# ---
+
+
+#### <<<<<< DETECTING THE ADAPTERS >>>>>>> ####
+
+def detect_adapters(paths: List[Union[str, Path]],
+                    adapters: List[Tuple[str, str]],
+                    n_reads: int = DETECTION_READS,
+                    min_fraction: float = DETECTION_FRACTION) -> List[Tuple[str, str, float]]:
+    """Find the adapters present in the reads of the FASTQ files.
+
+    Input:
+        paths: The FASTQ files (e.g. all the chunks of a sample).
+        adapters: The (name, sequence) of the known adapters (see 'read_fasta').
+        n_reads: How many reads to look at, the first ones of each file in
+                 equal parts.
+        min_fraction: The fraction of the reads above which an adapter (or its
+                      reverse complement) is found.
+    Output: The (name, sequence, fraction of the reads) of each adapter found.
+            The 'Prefix' adapters of the palindrome mode are kept in pairs
+            (/1 and /2), if any of the two is found. The same sequence is
+            only given once.
+    """
+    # The k-mers of the adapters and of their reverse complements
+    kmers, owners = [], []
+    for i, (_, sequence) in enumerate(adapters):
+        codes = encode(sequence)
+        for strand in (codes, reverse_complement(codes)):
+            strand_kmers = kmer_codes(strand[np.newaxis, :], DETECTION_LENGTH).ravel()
+            strand_kmers = strand_kmers[strand_kmers >= 0]
+            kmers.append(strand_kmers)
+            owners.append(np.full(len(strand_kmers), i))
+    kmers, owners = np.concatenate(kmers), np.concatenate(owners)
+    order = np.argsort(kmers, kind='stable')
+    kmers, owners = kmers[order], owners[order]
+
+    # The reads with each adapter
+    found = np.zeros(len(adapters), dtype=np.int64)
+    total = 0
+    per_file = max(1, n_reads // max(len(paths), 1))
+    for path in paths:
+        lines = next(read_records(path, per_file), [])
+        if not lines:
+            continue
+        codes, _, _ = to_reads(lines)
+        total += len(codes)
+
+        read_kmers = kmer_codes(codes, DETECTION_LENGTH)
+        rows, positions = np.nonzero(np.isin(read_kmers, kmers))
+        values = read_kmers[rows, positions]
+        first = np.searchsorted(kmers, values, side='left')
+        counts = np.searchsorted(kmers, values, side='right') - first
+        entries = (np.repeat(first, counts) + np.arange(counts.sum())
+                       - np.repeat(np.cumsum(counts) - counts, counts))
+
+        # Each read counts once for each adapter
+        pairs = np.unique(np.repeat(rows, counts) * len(adapters) + owners[entries])
+        found += np.bincount(pairs % len(adapters), minlength=len(adapters))
+
+    fractions = found / max(total, 1)
+    detected = set(np.flatnonzero(fractions > min_fraction))
+
+    # The palindrome mode needs both prefixes, the partner of a prefix is the
+    # closest one in the file (the files of several kits may be joined).
+    for i in list(detected):
+        name = adapters[i][0]
+        if name.startswith('Prefix') and name[-2:] in ('/1', '/2'):
+            partner = name[:-1] + ('2' if name[-1] == '1' else '1')
+            partners = [j for j, (other, _) in enumerate(adapters) if other == partner]
+            if partners:
+                detected.add(min(partners, key=lambda j: abs(j - i)))
+
+    # The same adapter, for the same reads, only once. Both strands of the
+    # simple adapters are tested, so an adapter and its reverse complement
+    # are the same.
+    kept, seen = [], set()
+    for i in sorted(detected):
+        name, sequence = adapters[i]
+        prefix = name.startswith('Prefix')
+        codes = encode(sequence)
+        strand = codes if prefix else min(codes.tobytes(), reverse_complement(codes).tobytes())
+        role = (prefix, name[-2:] if name[-2:] in ('/1', '/2') else '', bytes(strand))
+        if role not in seen:
+            seen.add(role)
+            kept.append((name, sequence, float(fractions[i])))
+
+    return kept
+# ---
+
+
+#### <<<<<< PROBING THE READS >>>>>>> ####
+
+def probe(mode: str,
+          inputs: List[str],
+          steps: List[str],
+          phred_offset: int = PHRED_OFFSET,
+          n_reads: int = PROBE_READS) -> Dict[str, float]:
+    """Measure how many reads of the files the trimming steps would change.
+
+    Input:
+        mode: 'SE' for single reads, 'PE' for pairs.
+        inputs: The input file (SE) or the forward and reverse files (PE).
+        steps: The trimming steps, as given to Trimmomatic.
+        phred_offset: 33 or 64.
+        n_reads: How many reads to probe, the first ones of the files.
+    Output: A dictionary with the number of reads probed and the fraction of
+            them (or of the pairs) that would be clipped by ILLUMINACLIP
+            ('adapter_rate'), trimmed by LEADING, TRAILING or SLIDINGWINDOW
+            ('low_quality_rate'), or dropped by MINLEN ('short_rate').
+    """
+    parsed = parse_steps(steps, mode)
+    chunk = [next(read_records(path, n_reads), []) for path in inputs]
+    reads = [to_reads(lines, phred_offset) for lines in chunk]
+    n_probed = len(chunk[0]) // 4
+
+    def changed_fraction(names):
+        """The fraction of the reads changed by the steps with the given names."""
+        trimmed = apply_steps(reads, [step for step in parsed if step[0] in names])
+        changed = np.zeros(n_probed, dtype=bool)
+        for (start, end, kept), (_, _, lengths) in zip(trimmed, reads):
+            changed |= (start > 0) | (end < lengths) | ~kept
+        return float(changed.mean()) if n_probed else 0.0
+    # ---
+
+    return {'reads': n_probed,
+            'adapter_rate': changed_fraction({'ILLUMINACLIP'}),
+            'low_quality_rate': changed_fraction({'LEADING', 'TRAILING', 'SLIDINGWINDOW'}),
+            'short_rate': changed_fraction({'MINLEN'})}
+# ---
+
+def probe_command(command: str,
+                  max_adapter_rate: float,
+                  max_low_quality_rate: float,
+                  link: bool = True) -> str:
+    """Replace the trimming command by a cheap one if its reads are clean.
+
+    Input:
+        command: The trimming command (Trimmomatic or `script.trim.py`).
+        max_adapter_rate, max_low_quality_rate: The fraction of the reads with
+            adapters and with low quality ends below which the reads are clean
+            (see 'probe').
+        link: Whether the outputs can be links to the inputs. Otherwise, or
+              if some reads are too short, only the MINLEN step is applied.
+    Output: The command to execute: the given one, or a `script.trim.py`
+            command with no steps (links) or only MINLEN.
+    """
+    program, *args = command.split()
+    mode, threads, phred_offset, inputs, outputs, steps, summary = parse_arguments(args)
+    rates = probe(mode, inputs, steps, phred_offset)
+
+    clean = (rates['adapter_rate'] <= max_adapter_rate
+                 and rates['low_quality_rate'] <= max_low_quality_rate)
+    print(f'Probed {rates["reads"]} reads of {" ".join(inputs)}: '
+          f'{100 * rates["adapter_rate"]:.2f}% with adapters, '
+          f'{100 * rates["low_quality_rate"]:.2f}% with low quality ends, '
+          f'{100 * rates["short_rate"]:.2f}% too short. '
+          f'{"Clean" if clean else "Trimming"}.', flush=True)
+
+    if not clean:
+        return command
+
+    trim_program = str(Path(__file__).resolve().parent / 'script.trim.py')
+    min_length = [step for step in steps if step.startswith('MINLEN:')]
+    if link and not (min_length and rates['short_rate'] > 0):
+        min_length = []
+
+    return ' '.join([trim_program, mode, '-threads', str(threads), f'-phred{phred_offset}']
+                    + (['-summary', summary] if summary else [])
+                    + inputs + outputs + min_length)
+# ---